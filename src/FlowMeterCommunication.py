@@ -1,16 +1,36 @@
 from sensirion_shdlc_driver import ShdlcSerialPort, ShdlcConnection
+from sensirion_shdlc_driver.errors import ShdlcTimeoutError
 from sensirion_shdlc_sfc5xxx import Sfc5xxxShdlcDevice, Sfc5xxxScaling, \
     Sfc5xxxValveInputSource, Sfc5xxxUnitPrefix, Sfc5xxxUnit, \
     Sfc5xxxUnitTimeBase, Sfc5xxxMediumUnit
+from sensirion_shdlc_sfc5xxx.commands import Sfc5xxxCmdReadMeasuredValueBuffer
+from struct import unpack
 import time
 import numpy as np
 
+
+class Sfc5xxxCmdReadMeasuredValueBufferArray(Sfc5xxxCmdReadMeasuredValueBuffer):
+    """
+    "Read Measured Value Buffer" command (0x09) returning the flow values as a NumPy
+    float32 array decoded straight from the response frame, instead of a list with one
+    Python float per sample.
+    """
+    @staticmethod
+    def interpret_response(data):
+        lost_value_count, remaining_value_count = unpack(">II", data[0:8])
+        sampling_time = unpack(">f", data[8:12])[0]
+        measured_values = np.frombuffer(data, dtype='>f4', offset=12)
+        return lost_value_count, remaining_value_count, sampling_time, measured_values
+
+
 class FlowMeter(object):
     """
     This class represents the flowmeter device and handles its I/O with the APIs provided by manufacturer
     Sensirion.
     """
-    def __init__(self, port='/dev/ttyUSB0', baudrate=460800, slave_address=2):
+    BUFFER_READ_SIZE = 60   # samples returned by one buffer read transaction at most
+
+    def __init__(self, port='/dev/ttyUSB0', baudrate=460800, slave_address=2, calibration=3, shdlc_port=None):
         """
         Initialize connection to the flow meter and other configurations.
         
@@ -20,45 +40,110 @@ class FlowMeter(object):
         baudrate : Baud rate for serial communication. Default is the current baud rate setup for the device.
         slave_address : Address of the device in the master-slave model of the device control model.
             Typically no need to change.
+        calibration : Index of the gas calibration block to activate.
+        shdlc_port : Already opened ShdlcSerialPort shared with other devices on the same RS485 bus.
+            The port is owned by the caller and is not closed by this object.
+        """
+        self.shared_port = shdlc_port
+        self.port_name = port
+        self.baudrate = baudrate
+        self.slave_address = slave_address
+        self.calibration = calibration
+        self.unit = Sfc5xxxMediumUnit(
+            Sfc5xxxUnitPrefix.ONE,
+            Sfc5xxxUnit.STANDARD_LITER,
+            Sfc5xxxUnitTimeBase.MINUTE
+        )
+        self.device_info = None  # cached by _print_device_info() on first connection
+        self.reconnect_count = 0
+
+        # Buffer read statistics
+        self.sampling_time = 1e-3    # time between buffered samples, updated on every buffer read
+        self.buffer_reads = 0        # number of buffer read transactions
+        self.lost_samples = 0        # samples dropped by the device because its buffer overran
+        self.overflow_samples = 0    # samples read but dropped because the output array was full
+        self.max_backlog = 0         # largest number of samples left in the device buffer after a read
+        self.backlog = 0             # samples left in the device buffer after the last read
+        self.open()
+
+    def open(self):
+        """
+        Open the serial port and configure the device.
+        Device information is only queried on the first connection; afterwards the
+        cached copy is used, so a reconnect costs two SHDLC transactions instead of a dozen.
         """
         try:
-            self.port = ShdlcSerialPort(port=port, baudrate=baudrate)
-            self.device = Sfc5xxxShdlcDevice(ShdlcConnection(self.port), slave_address=slave_address)
+            if self.shared_port is None:
+                self.port = ShdlcSerialPort(port=self.port_name, baudrate=self.baudrate)
+            else:
+                self.port = self.shared_port
+            self.device = Sfc5xxxShdlcDevice(ShdlcConnection(self.port), slave_address=self.slave_address)
             
-            # Print device information upon initialization
-            self._print_device_info()
+            # Print device information upon first initialization
+            if self.device_info is None:
+                self._print_device_info()
             
-            self.device.activate_calibration(3)
-            self.unit = Sfc5xxxMediumUnit(
-                Sfc5xxxUnitPrefix.ONE,
-                Sfc5xxxUnit.STANDARD_LITER,
-                Sfc5xxxUnitTimeBase.MINUTE
-            )
+            # Re-applied on every connection in case the device was power cycled
+            self.device.activate_calibration(self.calibration)
             self.device.set_user_defined_medium_unit(self.unit)
         except Exception as e:
-            if hasattr(self, 'port'):
-                self.port.close()
-            raise RuntimeError(f"Failed to initialize flow meter: {str(e)}")
+            self.close()
+            raise RuntimeError(f"Failed to initialize flow meter: {str(e)}") from e
+
+    def reconnect(self):
+        """Close and reopen the session after an I/O failure."""
+        self.close()
+        self.reconnect_count += 1
+        print(f"Reconnecting flow meter at {self.port_name} (slave address: {self.slave_address}), "
+              f"attempt {self.reconnect_count}")
+        self.open()
+
+    @property
+    def is_open(self):
+        """True if the serial port of the session is open."""
+        return hasattr(self, 'port') and self.port.is_open
+
+    @staticmethod
+    def is_io_error(exc):
+        """
+        True if the exception indicates a real I/O failure (serial port gone, device
+        not answering) that requires reopening the session. Device errors and garbled
+        frames are left to the caller and do not tear down the connection.
+        """
+        if isinstance(exc, RuntimeError) and exc.__cause__ is not None:
+            exc = exc.__cause__
+        return isinstance(exc, (OSError, ShdlcTimeoutError))
 
     def _print_device_info(self):
-        """Print device information and available calibration blocks."""
+        """Print device information and available calibration blocks, and cache it in self.device_info."""
         try:
-            print(f"\nFlow meter at {self.port.port} (slave address: {self.device.slave_address})")
-            print("Version:", self.device.get_version())
-            print("Product Name:", self.device.get_product_name())
-            print("Article Code:", self.device.get_article_code())
-            print("Serial Number:", self.device.get_serial_number())
-            
-            print("\nAvailable gas calibration blocks:")
+            info = {
+                'version': str(self.device.get_version()),
+                'product_name': self.device.get_product_name(),
+                'article_code': self.device.get_article_code(),
+                'serial_number': self.device.get_serial_number(),
+                'calibrations': {},
+            }
             for i in range(self.device.get_number_of_calibrations()):
                 if self.device.get_calibration_validity(i):
-                    gas = self.device.get_calibration_gas_description(i)
-                    fullscale = self.device.get_calibration_fullscale(i)
-                    unit = self.device.get_calibration_gas_unit(i)
-                    print(f" - {i}: {fullscale:.2f} {unit} {gas}")
-            print()
+                    info['calibrations'][i] = (self.device.get_calibration_fullscale(i),
+                                               str(self.device.get_calibration_gas_unit(i)),
+                                               self.device.get_calibration_gas_description(i))
+            self.device_info = info
         except Exception as e:
             print(f"Warning: Could not get device info: {str(e)}")
+            return
+
+        print(f"\nFlow meter at {self.port_name} (slave address: {self.slave_address})")
+        print("Version:", info['version'])
+        print("Product Name:", info['product_name'])
+        print("Article Code:", info['article_code'])
+        print("Serial Number:", info['serial_number'])
+        
+        print("\nAvailable gas calibration blocks:")
+        for i, (fullscale, unit, gas) in info['calibrations'].items():
+            print(f" - {i}: {fullscale:.2f} {unit} {gas}")
+        print()
 
     def set_baudrate(self, baudrate):
         """
@@ -79,15 +164,87 @@ class FlowMeter(object):
         Retrieve flow readings from the flow meter for a fixed duration
         by repeatedly reading from its buffer. Duration in unit of seconds.
         """
-        reading = []
-        # dump what's already inside the buffer. this is only useful for low overhead
-        #buffer = self.device.read_measured_value_buffer(Sfc5xxxScaling.USER_DEFINED)
-        while len(reading) <= duration * 1000: # flow meter reads at 1kHz
-            buffer = self.device.read_measured_value_buffer(Sfc5xxxScaling.USER_DEFINED)
-            #print(buffer.sampling_time) # the only "time" returned from read buffer command
-            reading.extend(buffer.values)
-        return reading
-    
+        return self.acquire(int(round(duration / self.sampling_time)))
+
+    def read_buffer_once(self, scaling=Sfc5xxxScaling.USER_DEFINED):
+        """
+        Send one buffer read transaction (up to BUFFER_READ_SIZE samples).
+
+        Returns
+        -------
+        lost : int
+            Samples the device dropped before the returned values.
+        remaining : int
+            Samples still in the device buffer.
+        values : ndarray
+            Read-only big-endian float32 view of the response.
+        """
+        lost, remaining, sampling_time, values = self.device.execute(
+            Sfc5xxxCmdReadMeasuredValueBufferArray(int(scaling)))
+        self.buffer_reads += 1
+        self.lost_samples += lost
+        self.backlog = remaining
+        self.max_backlog = max(self.max_backlog, remaining)
+        if sampling_time > 0:
+            self.sampling_time = sampling_time
+        return lost, remaining, values
+
+    def read_buffer_into(self, out, start=0, max_reads=5, scaling=Sfc5xxxScaling.USER_DEFINED):
+        """
+        Read the device buffer into out[start:] until the device buffer is empty, out is
+        full, or max_reads transactions were sent. Samples lost by the device between two
+        transactions are written as NaN. Returns the number of samples written.
+        """
+        pos = start
+        for i in range(max_reads):
+            lost, remaining, values = self.read_buffer_once(scaling)
+            if lost and pos > start:
+                n_lost = min(lost, len(out) - pos)
+                out[pos:pos + n_lost] = np.nan
+                pos += n_lost
+            n = min(len(values), len(out) - pos)
+            out[pos:pos + n] = values[:n]
+            self.overflow_samples += len(values) - n
+            pos += n
+            if remaining == 0 or pos >= len(out):
+                break
+        return pos - start
+
+    def acquire(self, n_samples, out=None, timeout=None, scaling=Sfc5xxxScaling.USER_DEFINED):
+        """
+        Acquire n_samples consecutive samples from the device buffer.
+
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples to acquire.
+        out : ndarray, optional
+            Preallocated float32 array with at least n_samples elements; allocated if None.
+        timeout : float, optional
+            Seconds after which the acquisition stops; unfilled samples are NaN.
+
+        Returns a view out[:n_samples].
+        """
+        if out is None:
+            out = np.empty(n_samples, dtype=np.float32)
+        view = out[:n_samples]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pos = 0
+        while pos < n_samples:
+            pos += self.read_buffer_into(view, pos, max_reads=1, scaling=scaling)
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                view[pos:] = np.nan
+                break
+            if pos < n_samples and self.backlog < self.BUFFER_READ_SIZE:
+                # Pace the reads to the sample clock: wait until a full read (or the rest of the
+                # acquisition) has built up in the device buffer, which holds 85 samples or more
+                wait = (min(self.BUFFER_READ_SIZE, n_samples - pos) - self.backlog) * self.sampling_time
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                time.sleep(max(wait, 0))
+        return view
+
     def get_single_buffer(self):
         #dump = self.device.read_measured_value_buffer(Sfc5xxxScaling.USER_DEFINED)
         buffer = self.device.read_measured_value_buffer(Sfc5xxxScaling.USER_DEFINED, max_reads=1)
@@ -119,10 +276,9 @@ class FlowMeter(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if hasattr(self, 'port'):
-            self.port.close()
+        self.close()
 
     def close(self):
-        """Explicitly close the port connection"""
-        if hasattr(self, 'port'):
+        """Explicitly close the port connection (unless the port is shared)"""
+        if hasattr(self, 'port') and self.shared_port is None:
             self.port.close()
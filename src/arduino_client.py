@@ -0,0 +1,246 @@
+"""
+Client of the Arduino trigger/valve firmware (arduino_src/routine.ino).
+
+The firmware takes one message per TCP connection on port 80, "high,low,duration" (DAC
+codes 0-4096 and the signal duration in ms), answers with one or more lines and closes
+the connection:
+    "Message received and processed"   settings stored
+    "Message format incorrect"         rejected
+    "... value out of range!"          rejected (one line per bad value)
+    "Operation timed out"              the message did not arrive inside the client window
+It only serves clients between shots: the interrupt handler blocks for about 25 ms with
+interrupts disabled, and the client window is limited by the last inter-shot interval
+minus the signal duration (at most 1 s).
+
+ArduinoValve keeps track of the shot phase from the trigger timestamps (on_trigger()), and
+sends each message inside the safe window between two shots: after the interrupt handler
+and the puff of the last shot, and early enough to finish before the next one. A timed
+out or failed transaction is retried in the window after the next shot (at once while
+the shot phase is unknown, e.g. before two triggers were seen). apply() has the interface of
+GasPuffValve.apply(), so the scan scheduler (valve_scan.py) can drive either. The firmware
+cannot be queried: the settings it holds are given to ArduinoValve() if known, and the
+first apply() must set the ones that are not.
+
+Note: the firmware as committed never updates lastInterruptTime/prevInterruptTime, so
+its client window and duration limit stay at 0 and every message is answered with
+"Operation timed out" or "SignalDuration value out of range!" until that is fixed there.
+
+Usage:
+    python arduino_client.py 192.168.7.70 --high 2.5 --low 0 --puff-time 5
+"""
+import time
+import socket
+import argparse
+import numpy as np
+
+from kernel import GasPuffValve, check_settings
+
+
+class ArduinoError(Exception):
+    """The firmware rejected a message, or no transaction succeeded after all retries."""
+
+
+class ShotPhase:
+    """Shot period and phase estimated from the trigger timestamps."""
+    def __init__(self, history=16):
+        self.history = history
+        self.timestamps = []
+
+    def update(self, timestamp):
+        self.timestamps = (self.timestamps + [timestamp])[-self.history:]
+
+    @property
+    def last(self):
+        return self.timestamps[-1] if self.timestamps else None
+
+    @property
+    def period(self):
+        """Median interval between triggers, or None before two triggers."""
+        if len(self.timestamps) < 2:
+            return None
+        return float(np.median(np.diff(self.timestamps)))
+
+    def window(self, now, busy, guard, since=None):
+        """
+        The current or next safe window (start, end) in time.time() seconds: from `busy`
+        after a shot to `guard` before the next one. None while the period is unknown or
+        the shots have stopped (no trigger for two periods before `since`, default now):
+        any time is safe then.
+        """
+        period = self.period
+        since = now if since is None else since
+        if period is None or since - self.last > 2 * period:
+            return None
+        n = max(0, int((now - self.last) // period))   # shots predicted since the last one
+        start = self.last + n * period + busy
+        end = self.last + (n + 1) * period - guard
+        return start, end
+
+
+class ArduinoValve:
+    """Gas-puff valve settings over the Arduino firmware protocol."""
+    PORT = 80
+    DAC_CODES = 4096        # firmware accepts codes 0 ... 4096 (12-bit output)
+    DAC_VREF = 5.0          # V, full-scale DAC output of the board
+    MAX_LEVEL = DAC_VREF
+    ISR_TIME = 0.025        # s, interrupt handler busy loop
+    OK = "Message received and processed"
+    TIMED_OUT = "Operation timed out"
+
+    _log_settings = GasPuffValve._log_settings
+
+    def __init__(self, host, port=PORT, timeout=1.0, retries=3, guard=0.05, settings_log=None,
+                 high=None, low=None, puff_time=None):
+        """
+        Parameters
+        ----------
+        host : str
+            IP address of the Arduino.
+        port : int
+            Firmware server port.
+        timeout : float
+            Seconds to wait for the connection and the response.
+        retries : int
+            Transactions tried (in successive windows) before apply() raises ArduinoError.
+        guard : float
+            Margin in seconds kept clear before a shot and after the end of a puff.
+        settings_log : str
+            Optional CSV settings log (see kernel.GasPuffValve).
+        high, low, puff_time : float
+            Settings the firmware holds now (V, V, ms), if known; None for unknown.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.guard = guard
+        self.settings_log = settings_log
+        self.phase = ShotPhase()
+        self.transaction_time = 0.05   # running estimate, s
+        self._puff_time = None if puff_time is None else float(puff_time)
+        self._high_voltage = None if high is None else float(high)
+        self._low_voltage = None if low is None else float(low)
+
+    def on_trigger(self, timestamp):
+        """Record a shot trigger (time.time() seconds, e.g. Trigger.timestamp)."""
+        self.phase.update(timestamp)
+
+    def settings(self):
+        """
+        Last settings applied, as {'high', 'low', 'puff_time'}; None for a setting not known
+        yet (the firmware cannot be queried).
+        """
+        return {'high': self._high_voltage, 'low': self._low_voltage, 'puff_time': self._puff_time}
+
+    def close(self):
+        """Nothing to close: every transaction has its own connection."""
+
+    def code(self, level):
+        """Level in volts as a DAC code."""
+        return int(round(level / self.DAC_VREF * (self.DAC_CODES - 1)))
+
+    def _wait_for_window(self, puff_time, since, next_window=False):
+        # Sleep until the rest of the safe window is long enough for a transaction; puff_time
+        # is the signal duration in ms the firmware uses for the shots. No trigger is recorded
+        # while apply() runs, so the shots count as running if they were at `since`, the start
+        # of apply(). next_window skips the window that is open now (the last transaction
+        # failed in it).
+        busy = self.ISR_TIME + puff_time * 1e-3 + self.guard
+        while True:
+            now = time.time()
+            window = self.phase.window(now, busy, self.guard, since)
+            if window is None:
+                return
+            start, end = window
+            if next_window and now >= start:
+                time.sleep(max(end + 2 * self.guard - now, 0))   # until after the next shot
+                next_window = False
+                continue
+            next_window = False
+            if end - start < self.transaction_time:
+                return  # no window is long enough; rely on the retries
+            if now < start:
+                time.sleep(start - now)
+            elif now + self.transaction_time <= end:
+                return
+            else:
+                # Too late in this window: wait for the one after the next shot
+                time.sleep(end + 2 * self.guard - now)
+
+    def send(self, high, low, duration):
+        """
+        One transaction: send DAC codes and the signal duration in ms. Returns the response
+        lines; raises OSError if the connection fails.
+        """
+        t0 = time.perf_counter()
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as s:
+            s.sendall(f"{high},{low},{duration}\n".encode())
+            response = b''
+            while True:
+                chunk = s.recv(256)
+                if not chunk:
+                    break   # the firmware closes the connection after its answer
+                response += chunk
+        self.transaction_time = 0.8 * self.transaction_time + 0.2 * (time.perf_counter() - t0)
+        return [line.strip() for line in response.decode(errors='replace').splitlines() if line.strip()]
+
+    def apply(self, high=None, low=None, puff_time=None):
+        """
+        Change the settings in the next safe window; settings not given stay as they are,
+        and must be given if they are not known yet. Levels are in volts at the DAC output,
+        puff_time in ms. The target is validated as in GasPuffValve.apply() and a
+        ValueError raised before anything is sent.
+
+        Returns the time taken in seconds, including the wait for the window.
+        """
+        t0 = time.perf_counter()
+        started = time.time()
+        high = self._high_voltage if high is None else float(high)
+        low = self._low_voltage if low is None else float(low)
+        puff_time = self._puff_time if puff_time is None else float(puff_time)
+        unknown = [name for name, value in (('high', high), ('low', low), ('puff_time', puff_time)) if value is None]
+        if unknown:
+            raise ValueError(f"Arduino at {self.host}: current {', '.join(unknown)} unknown (the firmware "
+                             f"cannot be queried); set them in apply() or give them to ArduinoValve()")
+        check_settings(high, low, puff_time, self.MAX_LEVEL)
+        period = self.phase.period
+        if period is not None and puff_time * 1e-3 >= period:
+            raise ValueError(f'Invalid puff time: {puff_time} ms is longer than the shot period ({period * 1e3:.0f} ms)')
+
+        message = (self.code(high), self.code(low), int(round(puff_time)))
+        for attempt in range(1, self.retries + 1):
+            self._wait_for_window(puff_time if self._puff_time is None else max(puff_time, self._puff_time),
+                                  started, next_window=attempt > 1)
+            try:
+                lines = self.send(*message)
+            except OSError as e:
+                print(f"Arduino at {self.host}: transaction failed ({str(e)}), attempt {attempt}/{self.retries}")
+                continue
+            if self.OK in lines:
+                break
+            if self.TIMED_OUT in lines or not lines:
+                print(f"Arduino at {self.host}: {self.TIMED_OUT if lines else 'no response'}, "
+                      f"attempt {attempt}/{self.retries}")
+                continue
+            raise ArduinoError(f"Arduino at {self.host} rejected {message}: {'; '.join(lines)}")
+        else:
+            raise ArduinoError(f"Arduino at {self.host}: no transaction succeeded in {self.retries} attempts")
+
+        changed = (high, low, puff_time) != (self._high_voltage, self._low_voltage, self._puff_time)
+        self._high_voltage, self._low_voltage, self._puff_time = high, low, puff_time
+        if changed:
+            self._log_settings()
+        return time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send valve settings to the Arduino firmware.")
+    parser.add_argument('host', help="IP address of the Arduino")
+    parser.add_argument('--port', type=int, default=ArduinoValve.PORT)
+    parser.add_argument('--high', type=float, required=True, help="high level (V at the DAC output)")
+    parser.add_argument('--low', type=float, default=0.0, help="low level (V at the DAC output)")
+    parser.add_argument('--puff-time', type=float, required=True, help="signal duration (ms)")
+    args = parser.parse_args()
+
+    valve = ArduinoValve(args.host, args.port)
+    print(f"Applied in {valve.apply(args.high, args.low, args.puff_time) * 1e3:.1f} ms")
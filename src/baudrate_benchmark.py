@@ -0,0 +1,291 @@
+"""
+Baud rate throughput benchmark and auto-tuning for the SFC5xxx flow meters.
+
+For every baud rate of the sweep, all flow meters on the serial port of the selected meter
+are switched to that rate (a baud rate applies to the whole RS485 bus), and the selected
+meter's buffer is read for a fixed time at several read sizes. The device always returns
+what is in its buffer (up to 60 samples per transaction), so the read size is set by the
+polling interval: a read size of 30 means one transaction every 30 sample periods.
+
+Per baud rate and read size the report holds the sustained sample throughput, the
+transaction latency distribution, the bus utilisation, and the counts of CRC errors
+(wrong checksum or garbled frames), timeouts, device errors and samples lost by the
+device. A setting is reliable if no sample was lost and the error rate stays below a
+threshold; the fastest reliable baud rate is the one with the lowest bus utilisation. With --commit, it is stored in the devices and in flowmeters.json;
+otherwise the original baud rate is restored.
+
+Usage:
+    python baudrate_benchmark.py East --duration 5 --report baudrate_report.json
+    python baudrate_benchmark.py East --commit
+"""
+import json
+import time
+import datetime
+import argparse
+import numpy as np
+
+from sensirion_shdlc_driver import ShdlcSerialPort, ShdlcConnection
+from sensirion_shdlc_driver.errors import ShdlcError, ShdlcTimeoutError, ShdlcResponseError, ShdlcDeviceError
+from sensirion_shdlc_sfc5xxx import Sfc5xxxShdlcDevice
+
+from FlowMeterCommunication import FlowMeter
+from flowmeter_config import CONFIG_PATH, load_config, group_by_port, set_port_baudrate
+
+BAUDRATES = (19200, 38400, 57600, 115200, 230400, 460800)
+READ_SIZES = (10, 30, 60)
+
+
+def find_baudrate(port, address, baudrates=BAUDRATES, tries=2):
+    """
+    Find the baud rate a device currently uses by trying each rate in turn (each one
+    `tries` times, since a late response to an earlier request can spoil the first try).
+    The port bitrate is left at the rate found; returns None if the device does not answer.
+    """
+    device = Sfc5xxxShdlcDevice(ShdlcConnection(port), slave_address=address)
+    for baudrate in sorted(baudrates, key=lambda b: b != port.bitrate):  # current rate first
+        port.bitrate = baudrate
+        for i in range(tries):
+            try:
+                device.get_baudrate()
+                return baudrate
+            except ShdlcError:
+                continue
+    return None
+
+def switch_baudrate(port, fms, baudrate):
+    """Switch every device on the bus and then the host port to a new baud rate."""
+    for fm in fms:
+        fm.device.set_baudrate(baudrate, update_driver=False)
+        fm.baudrate = baudrate
+    port.bitrate = baudrate
+
+def recover_baudrate(port, fms, baudrate):
+    """
+    Bring all devices back to `baudrate` after a failed switch, whatever rate each one is
+    at now. Raises RuntimeError if a device cannot be found at any rate.
+    """
+    for fm in fms:
+        found = find_baudrate(port, fm.slave_address)
+        if found is None:
+            raise RuntimeError(f"Flow meter at address {fm.slave_address} on {fm.port_name} not answering at any baud rate")
+        if found != baudrate:
+            fm.device.set_baudrate(baudrate, update_driver=False)
+        fm.baudrate = baudrate
+    port.bitrate = baudrate
+
+
+class _DeviceHandle:
+    """Minimal stand-in for a FlowMeter before it can be opened (used by recover_baudrate)."""
+    def __init__(self, port, spec):
+        self.device = Sfc5xxxShdlcDevice(ShdlcConnection(port), slave_address=spec.address)
+        self.slave_address = spec.address
+        self.port_name = spec.port
+        self.baudrate = None
+
+
+def run_benchmark(fm, read_size, duration=2.0, max_consecutive_timeouts=5):
+    """
+    Read the device buffer for `duration` seconds, one transaction every read_size
+    sample periods (immediately while the device has a backlog). Returns a result dict.
+    """
+    latencies = []
+    samples = crc_errors = timeouts = device_errors = 0
+    busy = 0.0
+    consecutive_timeouts = 0
+    aborted = False
+
+    # Start with an empty device buffer, so the first read is not a backlog
+    try:
+        fm.read_buffer_once()
+    except ShdlcError:
+        pass
+    lost_before = fm.lost_samples
+    interval = read_size * fm.sampling_time
+
+    t_start = time.monotonic()
+    while time.monotonic() - t_start < duration:
+        t0 = time.perf_counter()
+        try:
+            n_lost, remaining, values = fm.read_buffer_once()
+        except ShdlcTimeoutError:
+            timeouts += 1
+            consecutive_timeouts += 1
+            if consecutive_timeouts >= max_consecutive_timeouts:
+                aborted = True
+                break
+            continue
+        except ShdlcResponseError:
+            crc_errors += 1
+            continue
+        except ShdlcDeviceError:
+            device_errors += 1
+            continue
+        finally:
+            dt = time.perf_counter() - t0
+            busy += dt
+        consecutive_timeouts = 0
+        latencies.append(dt)
+        samples += len(values)
+        if remaining < read_size:
+            time.sleep(max(0.0, interval - dt))
+    elapsed = time.monotonic() - t_start
+    lost = fm.lost_samples - lost_before
+
+    transactions = len(latencies) + crc_errors + timeouts + device_errors
+    latencies_ms = 1e3 * np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        'baudrate': fm.baudrate,
+        'read_size': read_size,
+        'duration': elapsed,
+        'samples': samples,
+        'samples_per_s': samples / elapsed,
+        'device_rate': 1.0 / fm.sampling_time,
+        'transactions': transactions,
+        'utilisation': busy / elapsed,
+        'latency_ms': {
+            'mean': float(np.mean(latencies_ms)),
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p90': float(np.percentile(latencies_ms, 90)),
+            'p99': float(np.percentile(latencies_ms, 99)),
+            'max': float(np.max(latencies_ms)),
+        },
+        'crc_errors': crc_errors,
+        'timeouts': timeouts,
+        'device_errors': device_errors,
+        'lost_samples': lost,
+        'aborted': aborted,
+    }
+
+def is_reliable(result, max_error_rate=0.001):
+    errors = result['crc_errors'] + result['timeouts'] + result['device_errors']
+    return (not result['aborted'] and result['lost_samples'] == 0 and result['samples'] > 0
+            and errors <= max_error_rate * result['transactions'])
+
+def best_baudrate(results, max_error_rate=0.001):
+    """
+    Fastest baud rate that is reliable at every read size tested. A reliable setting keeps
+    up with the device sample rate (no lost samples), so the rates are ranked by the bus
+    utilisation they need for it. Returns None if no baud rate is reliable.
+    """
+    by_rate = {}
+    for r in results:
+        by_rate.setdefault(r['baudrate'], []).append(r)
+    candidates = [(np.mean([r['utilisation'] for r in rs]), baudrate) for baudrate, rs in by_rate.items()
+                  if all(is_reliable(r, max_error_rate) for r in rs)]
+    if not candidates:
+        return None
+    return min(candidates)[1]
+
+def sweep(specs, meter, baudrates=BAUDRATES, read_sizes=READ_SIZES, duration=2.0,
+          max_error_rate=0.001, commit=False, config_path=CONFIG_PATH):
+    """
+    Run the benchmark for every baud rate and read size on the port of `meter`.
+
+    Parameters
+    ----------
+    specs : list of flowmeter_config.FlowMeterSpec
+        Flow meter registry; all meters on the port of `meter` are switched together.
+    meter : str
+        Name of the flow meter to read.
+    commit : bool
+        Keep the fastest reliable baud rate in the devices and in the config file.
+
+    Returns the report dict.
+    """
+    group = group_by_port(specs)[[s for s in specs if s.name == meter][0].port]
+    port_name = group[0].port
+    original = group[0].baudrate
+    print(f"Benchmarking {meter} on {port_name} ({len(group)} device(s) on the bus), baud rate {original}")
+
+    port = ShdlcSerialPort(port=port_name, baudrate=original)
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'meter': meter,
+        'port': port_name,
+        'devices_on_port': [s.name for s in group],
+        'original_baudrate': original,
+        'max_error_rate': max_error_rate,
+        'results': [],
+        'best_baudrate': None,
+        'committed': False,
+    }
+    try:
+        # The devices may have been left at another rate by an interrupted run
+        fms = []
+        for spec in group:
+            recover_baudrate(port, [_DeviceHandle(port, spec)], original)
+            fms.append(FlowMeter(port=port_name, baudrate=original, slave_address=spec.address,
+                                 calibration=spec.calibration, shdlc_port=port))
+        fm = fms[[s.name for s in group].index(meter)]
+
+        for baudrate in baudrates:
+            try:
+                switch_baudrate(port, fms, baudrate)
+            except ShdlcError as e:
+                print(f"Could not switch to {baudrate} bit/s: {str(e)}")
+                recover_baudrate(port, fms, original)
+                continue
+            for read_size in read_sizes:
+                result = run_benchmark(fm, read_size, duration)
+                report['results'].append(result)
+                print(f"{baudrate:>7} bit/s, read size {read_size:>2}: "
+                      f"{result['samples_per_s']:7.1f} samples/s, "
+                      f"latency p50 {result['latency_ms']['p50']:.2f} ms p99 {result['latency_ms']['p99']:.2f} ms, "
+                      f"utilisation {100 * result['utilisation']:.1f}%, "
+                      f"{result['crc_errors']} CRC errors, {result['timeouts']} timeouts, "
+                      f"{result['lost_samples']} lost")
+                if result['aborted']:
+                    print(f"Device stopped answering at {baudrate} bit/s")
+                    recover_baudrate(port, fms, original)
+                    break
+
+        best = best_baudrate(report['results'], max_error_rate)
+        report['best_baudrate'] = best
+        if best is None:
+            print("No reliable baud rate found")
+        else:
+            print(f"Fastest reliable baud rate: {best}")
+
+        final = best if commit and best is not None else original
+        try:
+            switch_baudrate(port, fms, final)
+        except ShdlcError:
+            recover_baudrate(port, fms, final)
+        if final != original:
+            set_port_baudrate(port_name, final, config_path)
+            report['committed'] = True
+            print(f"Baud rate {final} stored in the devices and in {config_path}")
+    finally:
+        port.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flow meter throughput at several baud rates.")
+    parser.add_argument('meter', help="flow meter name in the config file")
+    parser.add_argument('--config', default=CONFIG_PATH, help="flow meter config file")
+    parser.add_argument('--baudrates', type=int, nargs='+', default=list(BAUDRATES))
+    parser.add_argument('--read-sizes', type=int, nargs='+', default=list(READ_SIZES),
+                        help="samples per buffer read (1-60)")
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds per baud rate and read size")
+    parser.add_argument('--max-error-rate', type=float, default=0.001,
+                        help="largest fraction of failed transactions of a reliable setting")
+    parser.add_argument('--commit', action='store_true',
+                        help="keep the fastest reliable baud rate in the devices and the config file")
+    parser.add_argument('--report', help="JSON report file (default: baudrate_report_<time>.json)")
+    args = parser.parse_args()
+
+    specs = load_config(args.config)['flow_meters']
+    if args.meter not in [s.name for s in specs]:
+        parser.error(f"Unknown flow meter {args.meter}; configured: {[s.name for s in specs]}")
+    report = sweep(specs, args.meter, args.baudrates, args.read_sizes, args.duration,
+                   args.max_error_rate, args.commit, args.config)
+
+    report_path = args.report or f"baudrate_report_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {report_path}")
+
+
+if __name__ == '__main__':
+    main()
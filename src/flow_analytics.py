@@ -0,0 +1,203 @@
+"""
+Per-shot flow features computed from the shot windows.
+
+The features of all shots of a batch are computed at once on the (shots, samples) array:
+    baseline   : flow offset before the puff (median of the pre-trigger samples), slm
+    peak       : highest flow above the baseline, slm
+    peak_time  : time of the peak relative to the trigger, s
+    integrated : gas delivered per puff (flow above the baseline integrated over the
+                 post-trigger samples), standard liters
+    rise_time  : time from 10% to 90% of the peak, s
+    duration   : time between the first and the last sample above 10% of the peak, s
+Shots without data (NaN rows) get NaN features. A shot only counts as a puff if its peak
+stands out of the baseline noise (robust standard deviation of the baseline samples);
+noise-only shots get a baseline and an integrated flow, and NaN for the other features.
+
+The writer stores the features of every shot in the compound dataset "summary" next to
+flow_data, so shot statistics are read without loading the traces. Files written before
+the summary existed are processed with reprocess(), one file per worker process.
+
+Usage:
+    python flow_analytics.py /home/pi/flow_meter/data/flow_data_*.hdf5 --processes 4
+"""
+import os
+import glob
+import argparse
+import multiprocessing as mp
+import numpy as np
+import h5py
+
+SUMMARY_DTYPE = np.dtype([('baseline', np.float32), ('peak', np.float32), ('peak_time', np.float32),
+                          ('integrated', np.float32), ('rise_time', np.float32), ('duration', np.float32)])
+SUMMARY_UNITS = "baseline, peak: slm; integrated: standard liter; peak_time, rise_time, duration: s"
+
+
+def shot_features(flow, sampling_time=1e-3, pretrigger_samples=0, threshold=0.1, noise_factor=6.0,
+                  min_peak=0.05):
+    """
+    Compute the features of a batch of shots.
+
+    Parameters
+    ----------
+    flow : ndarray
+        Shot windows, shape (n_shots, data_length), in slm.
+    sampling_time : float
+        Time between samples in seconds.
+    pretrigger_samples : int
+        Number of samples before the trigger in each window. Without pre-trigger samples
+        the baseline is taken from the last 10% of the window, after the puff.
+    threshold : float
+        Fraction of the peak that marks the start and end of the puff.
+    noise_factor : float
+        A puff needs a peak above noise_factor times the baseline noise.
+    min_peak : float
+        Smallest peak counted as a puff, in slm (for baselines without visible noise).
+
+    Returns a structured array of SUMMARY_DTYPE with one entry per shot.
+    """
+    flow = np.atleast_2d(np.asarray(flow, dtype=np.float32))
+    n, length = flow.shape
+    summary = np.full(n, np.nan, dtype=SUMMARY_DTYPE)
+    if n == 0 or length == 0:
+        return summary
+
+    valid = ~np.all(np.isnan(flow), axis=1)
+    if not np.any(valid):
+        return summary
+    flow = flow[valid]
+
+    if pretrigger_samples > 0:
+        quiet = flow[:, :pretrigger_samples]
+    else:
+        quiet = flow[:, -max(1, length // 10):]
+    baseline = np.nanmedian(quiet, axis=1)
+    baseline = np.where(np.isnan(baseline), 0.0, baseline)
+    # Robust standard deviation (scaled median absolute deviation) of the baseline samples
+    noise = 1.4826 * np.nanmedian(np.abs(quiet - baseline[:, None]), axis=1)
+    noise = np.where(np.isnan(noise), 0.0, noise)
+    signal = flow - baseline[:, None]
+
+    filled = np.where(np.isnan(signal), -np.inf, signal)
+    peak_idx = np.argmax(filled, axis=1)
+    peak = filled[np.arange(len(flow)), peak_idx]
+
+    # Crossing indices; the rise is searched before the peak only
+    idx = np.arange(length)
+    before_peak = idx[None, :] <= peak_idx[:, None]
+    above_start = (filled >= threshold * peak[:, None]) & before_peak
+    above_90 = (filled >= 0.9 * peak[:, None]) & before_peak
+    above = filled >= threshold * peak[:, None]
+    i_start = np.argmax(above_start, axis=1)
+    i_90 = np.argmax(above_90, axis=1)
+    i_end = length - 1 - np.argmax(above[:, ::-1], axis=1)
+
+    has_puff = peak > np.maximum(noise_factor * noise, min_peak)
+    post = signal[:, pretrigger_samples:]
+    out = summary[valid]
+    out['baseline'] = baseline
+    out['peak'] = np.where(has_puff, peak, np.nan)
+    out['peak_time'] = np.where(has_puff, (peak_idx - pretrigger_samples) * sampling_time, np.nan)
+    out['integrated'] = np.nansum(post, axis=1) * sampling_time / 60.0  # slm * s -> standard liter
+    out['rise_time'] = np.where(has_puff, (i_90 - i_start) * sampling_time, np.nan)
+    out['duration'] = np.where(has_puff, (i_end - i_start + 1) * sampling_time, np.nan)
+    summary[valid] = out
+    return summary
+
+def create_summary_dataset(grp, chunk_rows=64, n=0):
+    """Create the summary dataset of a flow meter group."""
+    ds = grp.create_dataset("summary", (n,), maxshape=(None,), chunks=(chunk_rows,), dtype=SUMMARY_DTYPE)
+    ds.attrs['units'] = SUMMARY_UNITS
+    return ds
+
+def reprocess_file(file_name, overwrite=False, block_rows=4096):
+    """
+    Compute the summary datasets of a closed flow data file.
+
+    Files written by the current writer already have them; they are only recomputed with
+    overwrite=True. Returns the number of shots processed, or None if the file could not be
+    opened (e.g. it is still being written).
+    """
+    try:
+        f = h5py.File(file_name, 'a')
+    except OSError as e:
+        print(f"Skipping {file_name}: {str(e)}")
+        return None
+    with f:
+        sampling_time = float(f.attrs.get('sampling_time', 1e-3))
+        pretrigger_samples = int(f.attrs.get('pretrigger_samples', 0))
+        n_shots = 0
+        for key in f:
+            if not key.startswith("FlowMeter_"):
+                continue
+            grp = f[key]
+            flow = grp['flow_data']
+            n = flow.shape[0]
+            if "summary" in grp:
+                if not overwrite and grp['summary'].shape[0] == n:
+                    continue
+                del grp['summary']
+            ds = create_summary_dataset(grp, chunk_rows=flow.chunks[0] if flow.chunks else 64, n=n)
+            for start in range(0, n, block_rows):
+                ds[start:start + block_rows] = shot_features(flow[start:start + block_rows],
+                                                             sampling_time, pretrigger_samples)
+            n_shots += n
+    return n_shots
+
+def _reprocess_one(args):
+    file_name, overwrite = args
+    return file_name, reprocess_file(file_name, overwrite)
+
+def reprocess(file_names, overwrite=False, processes=None):
+    """
+    Reprocess several files in parallel, one file per worker process.
+    Returns {file name: number of shots processed (None if skipped)}.
+    """
+    results = {}
+    with mp.Pool(processes) as pool:
+        for file_name, n in pool.imap_unordered(_reprocess_one, [(fn, overwrite) for fn in file_names]):
+            results[file_name] = n
+            if n:
+                print(f"{file_name}: {n} shots")
+    return results
+
+def load_summary(file_names, name):
+    """
+    Concatenate the summaries of flow meter `name` over several files, in file order.
+    Returns (timestamp, shot_id, summary) arrays; files without that flow meter are skipped.
+    """
+    timestamps, shot_ids, summaries = [], [], []
+    for file_name in file_names:
+        with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+            key = f"FlowMeter_{name}"
+            if key not in f or "summary" not in f[key]:
+                continue
+            grp = f[key]
+            n = min(grp['summary'].shape[0], grp['timestamp'].shape[0])
+            timestamps.append(grp['timestamp'][:n])
+            # Files written before the shot IDs were stored: use the row number
+            shot_ids.append(grp['shot_id'][:n] if 'shot_id' in grp else np.arange(n, dtype=np.int64))
+            summaries.append(grp['summary'][:n])
+    if not summaries:
+        return np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=SUMMARY_DTYPE)
+    return np.concatenate(timestamps), np.concatenate(shot_ids), np.concatenate(summaries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the per-shot summary datasets of flow data files.")
+    parser.add_argument('files', nargs='+', help="flow data files or directories")
+    parser.add_argument('--overwrite', action='store_true', help="recompute existing summaries")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    file_names = []
+    for path in args.files:
+        if os.path.isdir(path):
+            file_names.extend(sorted(glob.glob(os.path.join(path, "flow_data_*.hdf5"))))
+        else:
+            file_names.append(path)
+    results = reprocess(file_names, args.overwrite, args.processes)
+    print(f"{sum(n for n in results.values() if n)} shots in {len(results)} files processed")
+
+
+if __name__ == '__main__':
+    main()
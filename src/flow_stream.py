@@ -0,0 +1,141 @@
+"""
+Continuous flow meter acquisition into a pre-trigger ring buffer.
+
+Instead of sleeping a fixed time after the trigger and reading whatever is left in the
+device buffer, the flow meter buffer is drained continuously into a preallocated NumPy
+ring buffer. Every sample gets a running sample index, and the host time of each sample
+index is estimated from the read timing. When a trigger arrives, a fixed window of
+pre- and post-trigger samples is cut around the trigger time.
+"""
+import time
+import numpy as np
+
+
+class FlowRingBuffer:
+    """
+    Preallocated ring buffer of flow samples addressed by a running sample index.
+    Sample k is stored at data[k % capacity]; lost samples are stored as NaN.
+    """
+    def __init__(self, capacity=8192, dtype=np.float32):
+        self.capacity = int(capacity)
+        self.data = np.full(self.capacity, np.nan, dtype=dtype)
+        self.head = 0  # index of the next sample to be written (= total samples seen)
+
+    @property
+    def oldest(self):
+        """Index of the oldest sample still held in the buffer."""
+        return max(0, self.head - self.capacity)
+
+    def append(self, values, lost=0):
+        """
+        Append samples to the buffer.
+
+        Parameters
+        ----------
+        values : array_like
+            New samples, oldest first.
+        lost : int
+            Number of samples the device dropped before these values; stored as NaN so
+            that sample indices stay aligned with device time.
+        """
+        if lost > 0:
+            self._write(np.full(min(lost, self.capacity), np.nan), self.head + max(0, lost - self.capacity))
+            self.head += lost
+        values = np.asarray(values, dtype=self.data.dtype)
+        if len(values) > 0:
+            self._write(values[-self.capacity:], self.head + max(0, len(values) - self.capacity))
+            self.head += len(values)
+
+    def _write(self, values, start):
+        i = start % self.capacity
+        n = min(len(values), self.capacity - i)
+        self.data[i:i + n] = values[:n]
+        self.data[:len(values) - n] = values[n:]
+
+    def window(self, start, stop):
+        """
+        Return a copy of samples [start, stop), or None if part of the window has not been
+        acquired yet or was already overwritten.
+        """
+        if start < self.oldest or stop > self.head:
+            return None
+        idx = np.arange(start, stop) % self.capacity
+        return self.data[idx]
+
+
+class FlowStream:
+    """
+    Drains the buffer of a FlowMeter continuously and cuts shot windows around triggers.
+
+    The host time of sample k is modelled as t0 + k * sampling_time. Every read gives an
+    estimate of t0 from the midpoint of the transaction and the newest sample index; the
+    estimate is low-pass filtered so that serial jitter does not move the shot windows.
+    """
+    def __init__(self, fm, pretrigger_samples=50, posttrigger_samples=250, capacity=8192, smoothing=0.05):
+        """
+        Parameters
+        ----------
+        fm : FlowMeter
+            Open flow meter session.
+        pretrigger_samples, posttrigger_samples : int
+            Number of samples before and after the trigger in each shot window.
+        capacity : int
+            Ring buffer length in samples (8192 samples is about 8 s at 1 kHz).
+        smoothing : float
+            Weight of each new read in the running estimate of the sample clock offset.
+        """
+        self.fm = fm
+        self.pretrigger_samples = pretrigger_samples
+        self.posttrigger_samples = posttrigger_samples
+        self.ring = FlowRingBuffer(capacity)
+        self.smoothing = smoothing
+        self.sampling_time = 1e-3  # updated from the device on every read
+        self.t0 = None             # estimated host time of sample index 0
+        self.lost_values = 0
+
+    @property
+    def data_length(self):
+        """Number of samples in each shot window."""
+        return self.pretrigger_samples + self.posttrigger_samples
+
+    def poll(self, max_reads=5):
+        """
+        Read everything currently in the device buffer into the ring buffer.
+        Returns the number of samples still remaining in the device buffer.
+        """
+        for i in range(max_reads):
+            t_start = time.time()
+            lost, remaining, values = self.fm.read_buffer_once()
+            t_end = time.time()
+
+            self.sampling_time = self.fm.sampling_time
+            self.lost_values += lost
+            self.ring.append(values, lost=lost)
+
+            # The newest sample in the device (including the ones not read yet) was taken
+            # around the time the device handled the request
+            t0_est = 0.5 * (t_start + t_end) - (self.ring.head - 1 + remaining) * self.sampling_time
+            if self.t0 is None:
+                self.t0 = t0_est
+            else:
+                self.t0 += self.smoothing * (t0_est - self.t0)
+            if remaining == 0:
+                break
+        return remaining
+
+    def index_at(self, t):
+        """Sample index closest to host time t."""
+        return int(round((t - self.t0) / self.sampling_time))
+
+    def cut(self, trigger_time):
+        """
+        Return the shot window around trigger_time, or None if the post-trigger part has
+        not been acquired yet. Raises ValueError if the window is no longer in the buffer.
+        """
+        if self.t0 is None:
+            return None
+        start = self.index_at(trigger_time) - self.pretrigger_samples
+        stop = start + self.data_length
+        if start < self.ring.oldest:
+            raise ValueError(f"Shot window starting at sample {start} was overwritten")
+        return self.ring.window(start, stop)
@@ -0,0 +1,176 @@
+"""
+Supervisor of the flow meter worker processes.
+
+Every worker stamps a heartbeat (a shared double holding time.monotonic()) each time round
+its loop. The trigger loop calls check() once per iteration, so without blocking it:
+    - a worker that exited (crash, USB unplugged, uncaught exception) is restarted,
+    - a worker whose heartbeat is older than hang_timeout is terminated (killed if it does
+      not exit within `grace` seconds) and then restarted.
+Restarts are delayed by an exponential backoff (backoff, 2*backoff, ... up to max_backoff),
+which is reset once a worker has run for stable_time seconds. A restarted worker gets a
+fresh trigger queue, so it does not replay the triggers queued while it was down.
+
+Triggers only go to the healthy workers; the devices of the other workers are recorded as
+missing for those shots (NaN data, no latency), so one faulty line costs a few shots while
+the other flow meters keep acquiring.
+
+Note that a worker killed while it is putting a result on the shared data queue can leave
+the queue lock held; workers hang in serial I/O, not there, in practice.
+"""
+import time
+import multiprocessing as mp
+
+
+class _Worker:
+    def __init__(self, worker_id, device_ids, target, args):
+        self.worker_id = worker_id
+        self.device_ids = list(device_ids)
+        self.target = target
+        self.args = args
+        self.process = None
+        self.heartbeat = mp.RawValue('d', 0.0)
+        self.state = 'stopped'  # 'running', 'stopping' (terminated, not exited yet) or 'waiting' (backoff)
+        self.started = 0.0
+        self.deadline = 0.0     # kill time when stopping, restart time when waiting
+        self.backoff = 0.0
+        self.restarts = 0
+
+    @property
+    def name(self):
+        return '/'.join(self.device_ids)
+
+
+class WorkerSupervisor:
+    """Starts the flow meter workers and restarts the ones that die or hang."""
+    def __init__(self, broadcaster, q_data, hang_timeout=10.0, backoff=1.0, max_backoff=60.0,
+                 stable_time=60.0, grace=1.0):
+        """
+        Parameters
+        ----------
+        broadcaster : shot_dispatch.TriggerBroadcaster
+            Trigger fan-out; the supervisor registers the trigger queue of every worker.
+        q_data : multiprocessing.Queue
+            Shared data queue passed to every worker.
+        hang_timeout : float
+            Seconds without heartbeat after which a worker is considered hung.
+        backoff, max_backoff : float
+            First and largest delay before a restart, in seconds.
+        stable_time : float
+            Seconds a restarted worker has to run before the backoff is reset.
+        grace : float
+            Seconds a terminated worker gets to exit before it is killed.
+        """
+        self.broadcaster = broadcaster
+        self.q_data = q_data
+        self.hang_timeout = hang_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.grace = grace
+        self.workers = {}
+
+    def add(self, worker_id, device_ids, target, args=()):
+        """
+        Register a worker. It is started as target(q_trigger, q_data, *args, heartbeat=heartbeat)
+        and serves the flow meters device_ids.
+        """
+        self.workers[worker_id] = _Worker(worker_id, device_ids, target, args)
+
+    def start(self):
+        """Start all registered workers."""
+        for w in self.workers.values():
+            w.backoff = self.backoff
+            self._start(w)
+
+    def _start(self, w):
+        old = self.broadcaster.queues.get(w.worker_id)
+        if old is not None:
+            # Triggers queued for the old process are stale; do not wait on its feeder thread
+            old.cancel_join_thread()
+            old.close()
+        q_trigger = self.broadcaster.register(w.worker_id)
+        w.heartbeat.value = time.monotonic()
+        w.process = mp.Process(target=w.target, args=(q_trigger, self.q_data) + tuple(w.args),
+                               kwargs={'heartbeat': w.heartbeat})
+        w.process.start()
+        w.state = 'running'
+        w.started = time.monotonic()
+
+    def _schedule_restart(self, w, now):
+        w.process.join()
+        w.process.close()
+        w.process = None
+        w.state = 'waiting'
+        w.deadline = now + w.backoff
+        print(f"\nRestarting {w.name} process in {w.backoff:.0f} s")
+        w.backoff = min(2 * w.backoff, self.max_backoff)
+
+    def check(self):
+        """
+        Detect dead and hung workers and restart the ones whose backoff has passed.
+        Returns the device IDs of the workers that went down since the last call.
+        """
+        now = time.monotonic()
+        down = []
+        for w in self.workers.values():
+            if w.state == 'running':
+                if not w.process.is_alive():
+                    print(f"\n{w.name} process is dead (exit code {w.process.exitcode}). ", end='')
+                    down.extend(w.device_ids)
+                    self._schedule_restart(w, now)
+                elif now - w.heartbeat.value > self.hang_timeout:
+                    print(f"\n{w.name} process is hung (no heartbeat for {now - w.heartbeat.value:.1f} s). Terminating.")
+                    down.extend(w.device_ids)
+                    w.process.terminate()
+                    w.state = 'stopping'
+                    w.deadline = now + self.grace
+                elif w.backoff > self.backoff and now - w.started > self.stable_time:
+                    w.backoff = self.backoff
+            elif w.state == 'stopping':
+                if not w.process.is_alive():
+                    self._schedule_restart(w, now)
+                elif now > w.deadline:
+                    w.process.kill()
+            elif w.state == 'waiting' and now >= w.deadline:
+                self._start(w)
+                w.restarts += 1
+                print(f"\n{w.name} process restarted (restart {w.restarts})")
+        return down
+
+    def healthy(self):
+        """IDs of the workers that are running with a recent heartbeat."""
+        now = time.monotonic()
+        return [w.worker_id for w in self.workers.values()
+                if w.state == 'running' and now - w.heartbeat.value <= self.hang_timeout]
+
+    def devices(self, worker_ids=None):
+        """Device IDs served by the given workers (default: all workers)."""
+        if worker_ids is None:
+            worker_ids = self.workers.keys()
+        return [name for worker_id in worker_ids for name in self.workers[worker_id].device_ids]
+
+    def stats(self):
+        """{worker name: number of restarts}"""
+        return {w.name: w.restarts for w in self.workers.values()}
+
+    def stop(self, timeout=5.0):
+        """
+        Wait for the workers to exit after broadcaster.quit(); workers still running after
+        `timeout` seconds are terminated.
+        """
+        t_end = time.monotonic() + timeout
+        for w in self.workers.values():
+            if w.process is None:
+                self.broadcaster.queues[w.worker_id].cancel_join_thread()  # nobody reads it
+                continue
+            w.process.join(max(0.0, t_end - time.monotonic()))
+            if w.process.is_alive():
+                print(f"{w.name} process did not exit. Terminating.")
+                w.process.terminate()
+                w.process.join(self.grace)
+                if w.process.is_alive():
+                    w.process.kill()
+                    w.process.join()
+            w.process.close()
+            w.process = None
+            w.state = 'stopped'
@@ -0,0 +1,268 @@
+"""
+Flow data writer process.
+
+The writer owns the daily HDF5 file and keeps it open in SWMR mode, so the trigger loop
+only hands shots over through a queue and never waits on disk I/O. Shots are appended in
+batches to chunked datasets whose row length (data_length) is fixed when the file is
+created. A batch is written when it is full or when its oldest shot has waited
+flush_latency seconds, which bounds how long a shot takes to become visible to SWMR readers.
+The per-shot flow features (see flow_analytics.py) are computed for each batch and
+appended to the summary dataset of each flow meter together with the rows. Every batch
+written is added to the shot index (see shot_index.py).
+"""
+import os
+import time
+import datetime
+import queue
+import sqlite3
+import multiprocessing as mp
+import h5py
+import numpy as np
+
+from flow_analytics import shot_features, create_summary_dataset
+from shot_index import ShotIndex
+
+
+def day_file_name(hdf5_path, date):
+    """Path of the flow data file of a given date."""
+    return f"{hdf5_path}/flow_data_{date}.hdf5"
+
+def init_hdf5_file(file_name, devices, data_length, chunk_rows=64, pretrigger_samples=0, sampling_time=1e-3):
+    """
+    Initialize HDF5 file for flow meter data storage.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to HDF5 file
+    devices : dict
+        Flow meter name -> (port, address); one group FlowMeter_<name> is created for each
+    data_length : int
+        Number of samples stored per shot
+    chunk_rows : int
+        Number of shots per HDF5 chunk
+    pretrigger_samples : int
+        Number of samples before the trigger in each row
+    sampling_time : float
+        Time between samples in seconds
+    """
+    if os.path.exists(file_name):
+        print("HDF5 file exists")
+        return
+
+    timestamp = time.time()
+    with h5py.File(file_name, "w", libver='latest') as f:
+        ct = time.localtime(timestamp)
+        f.attrs['created'] = ct
+        print("HDF5 file created", time.strftime("%Y-%m-%d %H:%M:%S", ct))
+        f.attrs['description'] = "Flow meter data from Sensirion flow meters"
+        f.attrs['data_length'] = data_length
+        f.attrs['pretrigger_samples'] = pretrigger_samples
+        f.attrs['sampling_time'] = sampling_time
+
+        # Create groups for each flow meter
+        for name, info in devices.items():
+            grp = f.require_group(f"FlowMeter_{name}")
+            grp.attrs['description'] = f"Flow measurements from {name} flow meter"
+            grp.attrs['port'] = info[0]
+            grp.attrs['address'] = info[1]
+            grp.attrs['unit'] = "standard liter per minute"
+
+            # One row per shot; rows are appended in batches by FlowDataWriter
+            grp.create_dataset("flow_data", (0, data_length), maxshape=(None, data_length),
+                               chunks=(chunk_rows, data_length), dtype=np.float32)
+            grp.create_dataset("timestamp", (0,), maxshape=(None,), chunks=(chunk_rows,), dtype=np.float64)
+            grp.create_dataset("shot_id", (0,), maxshape=(None,), chunks=(chunk_rows,), dtype=np.int64)
+            create_summary_dataset(grp, chunk_rows)
+
+def open_day_file(hdf5_path, date, devices, data_length, chunk_rows=64, pretrigger_samples=0, sampling_time=1e-3):
+    """
+    Create (if needed) and open the file of the given date for appending in SWMR mode.
+    If a file of that date exists with a different layout, a numbered file is used instead.
+    """
+    file_name = day_file_name(hdf5_path, date)
+    n = 0
+    while os.path.exists(file_name):
+        with h5py.File(file_name, 'r') as f:
+            if (f.attrs.get('data_length') == data_length
+                    and f.attrs.get('pretrigger_samples') == pretrigger_samples
+                    and all(f"FlowMeter_{name}/summary" in f for name in devices)):
+                break
+        n += 1
+        print(f"{file_name} has a different layout, using a new file")
+        file_name = day_file_name(hdf5_path, f"{date}_{n}")
+    init_hdf5_file(file_name, devices, data_length, chunk_rows, pretrigger_samples, sampling_time)
+
+    f = h5py.File(file_name, 'a', libver='latest')
+    f.swmr_mode = True
+    return f
+
+def save_flow_data(f, shots, data_length):
+    """
+    Append a batch of shots and their features to every flow meter group with one resize
+    per dataset. Handles both normal data and NaN data from failed readings; rows of a
+    different length are truncated or NaN-padded to data_length.
+
+    shots : list of (shot_id, timestamp, {name: (flow_data, latency)})
+
+    Returns the row of the first shot of the batch.
+    """
+    n = len(shots)
+    first_row = None
+    shot_ids = np.array([s[0] for s in shots], dtype=np.int64)
+    timestamps = np.array([s[1] for s in shots], dtype=np.float64)
+    sampling_time = float(f.attrs.get('sampling_time', 1e-3))
+    pretrigger_samples = int(f.attrs.get('pretrigger_samples', 0))
+
+    for key in f:
+        if not key.startswith("FlowMeter_"):
+            continue
+        name = key[len("FlowMeter_"):]
+        flow = np.full((n, data_length), np.nan, dtype=np.float32)
+        for i, (shot_id, timestamp, results) in enumerate(shots):
+            flow_data = results.get(name, (np.nan, None))[0]
+            if np.isscalar(flow_data) and np.isnan(flow_data):
+                continue
+            flow_data = np.asarray(flow_data, dtype=np.float32)
+            if len(flow_data) != data_length:
+                print(f"Warning: {name} shot {shot_id} data length mismatch. Expected {data_length}, got {len(flow_data)}")
+                flow_data = flow_data[:data_length]
+            flow[i, :len(flow_data)] = flow_data
+
+        grp = f[key]
+        if first_row is None:
+            first_row = grp['flow_data'].shape[0]
+        summary = shot_features(flow, sampling_time, pretrigger_samples)
+        for ds_name, values in (("flow_data", flow), ("timestamp", timestamps), ("shot_id", shot_ids),
+                                ("summary", summary)):
+            ds = grp[ds_name]
+            ds.resize(ds.shape[0] + n, axis=0)
+            ds[-n:] = values
+    return first_row
+
+def write_flow_data(q_write, hdf5_path, devices, data_length, flush_latency=0.5, batch_size=16, chunk_rows=64,
+                    pretrigger_samples=0, sampling_time=1e-3, index_path=None):
+    """
+    Process function of the writer. Reads shots from q_write until it receives None.
+    The file of the current day stays open; a new file is started when a shot belongs
+    to a different day. If index_path is given, written shots are added to that shot index.
+    """
+    index = None
+    if index_path is not None:
+        try:
+            index = ShotIndex(index_path)
+        except sqlite3.Error as e:
+            print(f"Shot index {index_path} not available: {str(e)}")
+    f = None
+    file_date = None
+    batch = []
+    deadline = None
+
+    def flush(batch):
+        nonlocal f, file_date
+        # Split the batch at day boundaries
+        while batch:
+            date = datetime.date.fromtimestamp(batch[0][1])
+            n = 1
+            while n < len(batch) and datetime.date.fromtimestamp(batch[n][1]) == date:
+                n += 1
+            try:
+                if f is None or date != file_date:
+                    if f is not None:
+                        f.close()
+                        f = None
+                    f = open_day_file(hdf5_path, date, devices, data_length, chunk_rows,
+                                      pretrigger_samples, sampling_time)
+                    file_date = date
+                first_row = save_flow_data(f, batch[:n], data_length)
+                f.flush()
+                if index is not None:
+                    try:
+                        index.add_batch(f.filename, first_row, batch[:n])
+                    except sqlite3.Error as e:
+                        print(f"Error updating shot index: {str(e)}")
+            except OSError as e:
+                print(f"Error saving to HDF5 file: {str(e)}")
+                if f is not None:
+                    try:
+                        f.close()
+                    except:
+                        pass
+                    f = None
+            batch = batch[n:]
+
+    try:
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                shot = q_write.get(timeout=timeout)
+            except queue.Empty:
+                shot = False
+            if shot is None:
+                break
+            if shot:
+                batch.append(shot)
+                if len(batch) == 1:
+                    deadline = time.monotonic() + flush_latency
+            if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+                flush(batch)
+                batch = []
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flush(batch)
+        if f is not None:
+            f.close()
+        if index is not None:
+            index.close()
+
+
+class FlowDataWriter:
+    """
+    Handle to the writer process. put() only enqueues the shot and returns immediately.
+    """
+    def __init__(self, hdf5_path, devices, data_length, flush_latency=0.5, batch_size=16, chunk_rows=64,
+                 pretrigger_samples=0, sampling_time=1e-3, index_path=None):
+        """
+        Parameters
+        ----------
+        hdf5_path : str
+            Directory of the daily flow data files
+        devices : dict
+            Flow meter name -> (port, address)
+        data_length : int
+            Number of samples stored per shot
+        flush_latency : float
+            Longest time in seconds a shot waits before it is written and visible to SWMR readers
+        batch_size : int
+            Number of shots written with a single resize
+        chunk_rows : int
+            Number of shots per HDF5 chunk
+        pretrigger_samples : int
+            Number of samples before the trigger in each row (0 if the rows start after the trigger)
+        sampling_time : float
+            Time between samples in seconds
+        index_path : str, optional
+            Shot index database updated after every batch (see shot_index.py)
+        """
+        self.q_write = mp.Queue()
+        self.process = mp.Process(target=write_flow_data,
+                                  args=(self.q_write, hdf5_path, devices, data_length,
+                                        flush_latency, batch_size, chunk_rows,
+                                        pretrigger_samples, sampling_time, index_path))
+
+    def start(self):
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def put(self, shot_id, timestamp, results):
+        """Queue one shot; results is {name: (flow_data, latency)}."""
+        self.q_write.put((shot_id, timestamp, results))
+
+    def close(self):
+        """Write the remaining shots and stop the writer process."""
+        self.q_write.put(None)
+        self.process.join()
+        self.process.close()
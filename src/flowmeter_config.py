@@ -0,0 +1,83 @@
+"""
+Flow meter registry loaded from a JSON config file (see flowmeters.json).
+
+Each entry of "flow_meters" describes one gas line:
+    name        : device ID; the data goes to the HDF5 group FlowMeter_<name>
+    port        : serial port of the RS485 adapter
+    address     : SHDLC slave address
+    calibration : gas calibration block to activate (optional, default 3)
+    baudrate    : serial baud rate (optional, default 460800; must match for meters sharing a port)
+Adding a gas line means adding an entry here; one worker process is started per serial port.
+Several meters with different addresses may share one RS485 port (see shdlc_bus.py).
+"""
+import os
+import json
+from collections import namedtuple, OrderedDict
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flowmeters.json')
+
+FlowMeterSpec = namedtuple('FlowMeterSpec', ['name', 'port', 'address', 'calibration', 'baudrate'])
+
+
+def load_config(path=CONFIG_PATH):
+    """
+    Read the config file and return it as a dict; the "flow_meters" entry is replaced by
+    a list of FlowMeterSpec.
+    Raises ValueError if the registry is empty or inconsistent.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    specs = []
+    for entry in config.get('flow_meters', []):
+        try:
+            specs.append(FlowMeterSpec(name=str(entry['name']),
+                                       port=entry['port'],
+                                       address=int(entry['address']),
+                                       calibration=int(entry.get('calibration', 3)),
+                                       baudrate=int(entry.get('baudrate', 460800))))
+        except KeyError as e:
+            raise ValueError(f"Flow meter entry {entry} in {path} is missing {e}")
+    if not specs:
+        raise ValueError(f"No flow meters configured in {path}")
+
+    names = [s.name for s in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Flow meter names in {path} must be unique: {names}")
+    for port, group in group_by_port(specs).items():
+        addresses = [s.address for s in group]
+        if len(set(addresses)) != len(addresses):
+            raise ValueError(f"Flow meters on {port} must have different slave addresses: {addresses}")
+        if len(set(s.baudrate for s in group)) > 1:
+            raise ValueError(f"Flow meters on {port} must use the same baud rate")
+
+    config['flow_meters'] = specs
+    return config
+
+def group_by_port(specs):
+    """Return an ordered dict serial port -> list of FlowMeterSpec on that port."""
+    ports = OrderedDict()
+    for spec in specs:
+        ports.setdefault(spec.port, []).append(spec)
+    return ports
+
+def device_info(specs):
+    """Flow meter name -> (port, address), as used for the HDF5 group attributes."""
+    return OrderedDict((s.name, (s.port, s.address)) for s in specs)
+
+def set_port_baudrate(port, baudrate, path=CONFIG_PATH):
+    """
+    Store a new baud rate for all flow meters on a serial port in the config file.
+    Returns the number of entries changed.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+    changed = 0
+    for entry in config.get('flow_meters', []):
+        if entry.get('port') == port:
+            entry['baudrate'] = int(baudrate)
+            changed += 1
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=4)
+        f.write('\n')
+    return changed
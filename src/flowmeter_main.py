@@ -1,172 +1,97 @@
 from FlowMeterCommunication import FlowMeter
+from shdlc_bus import ShdlcBus
+from shot_dispatch import TriggerBroadcaster, ShotCollector
+from flow_supervisor import WorkerSupervisor
+from flow_writer import FlowDataWriter
+from shot_index import default_index_path
+from trigger_source import GPIOHandler
+from flowmeter_config import CONFIG_PATH, load_config, group_by_port, device_info
 import datetime
 import numpy as np
 import time
 import multiprocessing as mp
 import queue
-import h5py
 import os
-import ctypes
 import signal
 import sys
 
-from sensirion_shdlc_sfc5xxx import Sfc5xxxScaling
-
-# Configuration
+# Configuration; overridden by "hdf5_path" in the config file
 HDF5_PATH = '/home/pi/flow_meter/data'
 
-class GPIOHandler:
-    """
-    Handles GPIO operations using the gpio_detect.so C library
+def read_flowmeter(q_trigger, q_data, spec, wait_time=0.1, heartbeat=None):
     """
-    def __init__(self, trigger_pin):
-        self.trigger_pin = trigger_pin
-        
-        # Load the GPIO C library
-        gpio_lib_path = "/home/generalpi/pi_gpio/gpio_detect.so"
-        if not os.path.exists(gpio_lib_path):
-            raise FileNotFoundError(f"GPIO library not found at {gpio_lib_path}")
-            
-        try:
-            self.gpio_lib = ctypes.CDLL(gpio_lib_path)
-        except OSError as e:
-            raise RuntimeError(f"Failed to load GPIO library: {str(e)}")
-        
-        self._setup_gpio_functions()
-        
-        # Initialize GPIO
-        if self.gpio_lib.initialize_pigpio() < 0:
-            raise RuntimeError("Failed to initialize pigpio")
-            
-        # Setup trigger pin for input
-        if self.gpio_lib.setup_gpio_pin(self.trigger_pin) < 0:
-            raise RuntimeError(f"Failed to setup input pin {self.trigger_pin}")
-    
-    def _setup_gpio_functions(self):
-        """Setup C function signatures"""
-        # Initialize and cleanup
-        self.gpio_lib.initialize_pigpio.restype = ctypes.c_int
-        self.gpio_lib.terminate_pigpio.restype = None
-        
-        # Pin setup
-        self.gpio_lib.setup_gpio_pin.argtypes = [ctypes.c_int]
-        self.gpio_lib.setup_gpio_pin.restype = ctypes.c_int
-        
-        # GPIO operations
-        self.gpio_lib.wait_for_gpio_high.argtypes = [ctypes.c_int, ctypes.c_int]
-        self.gpio_lib.wait_for_gpio_high.restype = ctypes.c_bool
-    
-    def wait_for_trigger(self, timeout_ms=500):
-        """
-        Wait for rising edge on trigger pin
-        timeout_ms: timeout in milliseconds
-        """
-        return self.gpio_lib.wait_for_gpio_high(self.trigger_pin, timeout_ms * 1000)  # Convert to microseconds
-    
-    def cleanup(self):
-        """Cleanup GPIO resources"""
-        self.gpio_lib.terminate_pigpio()
+    Process function to continuously read from a flow meter device.
 
-def get_current_day(timestamp):
-    """Gets current day from the timestamp"""
-    ct = time.localtime(timestamp)
-    return ct.tm_yday
+    The SHDLC session is opened once and kept for the life of the process; it is only
+    reopened after an I/O failure (see FlowMeter.is_io_error). Trigger messages are
+    ('TRIG', shot_id, timestamp) tuples; each data message is
+    (device_id, shot_id, flow_data, timestamp, latency), where latency is measured in
+    seconds from trigger receipt to data ready.
 
-def init_hdf5_file(file_name, east_info=None, west_info=None):
+    spec : flowmeter_config.FlowMeterSpec of the device; spec.name is used as device ID.
+    heartbeat : shared double set to time.monotonic() every loop iteration (at least once
+        per second), watched by flow_supervisor.WorkerSupervisor.
     """
-    Initialize HDF5 file for flow meter data storage.
-    
-    Parameters
-    ----------
-    file_name : str
-        Path to HDF5 file
-    east_info, west_info : tuple
-        (port, address) for each flow meter
-    """
-    if os.path.exists(file_name):
-        print("HDF5 file exists")
-        return
-    
-    timestamp = time.time()
-    with h5py.File(file_name, "w", libver='latest') as f:
-        ct = time.localtime(timestamp)
-        f.attrs['created'] = ct
-        print("HDF5 file created", time.strftime("%Y-%m-%d %H:%M:%S", ct))
-        f.attrs['description'] = "Flow meter data from Sensirion flow meters"
-        f.attrs['data_length'] = None  # Will be set when first data is received
-
-        # Create groups for each flow meter
-        for name, info in [("East", east_info), ("West", west_info)]:
-            if info is None:
-                continue
-                
-            grp = f.require_group(f"FlowMeter_{name}")
-            grp.attrs['description'] = f"Flow measurements from {name} flow meter"
-            grp.attrs['port'] = info[0]
-            grp.attrs['address'] = info[1]
-            grp.attrs['unit'] = "standard liter per minute"
-            
-            # Create datasets with initial size 0
-            # Actual size will be set when first data is received
-            grp.create_dataset("flow_data", (0, 0), maxshape=(None, None), dtype=np.float32)
-            grp.create_dataset("timestamp", (0,), maxshape=(None,), dtype=np.float64)
-
-def read_flowmeter(q_trigger, q_data, flow_meter_port, slave_address, wait_time=0.1):
-    """Process function to continuously read from a flow meter device."""
+    device_id = spec.name
     fm = None
     consecutive_errors = 0
     MAX_RETRIES = 3
+    buff = np.empty(3 * 60, dtype=np.float32)  # up to 3 buffer reads of 60 values
     
     try:
         while True:
-            trigger = q_trigger.get()
+            if heartbeat is not None:
+                heartbeat.value = time.monotonic()
+            try:
+                trigger = q_trigger.get(timeout=1.0)
+            except queue.Empty:
+                continue
             if trigger == 'QUIT':
                 if fm is not None:
                     fm.close()
                 return
-            elif trigger == 'TRIG':
-                timestamp = time.time()
+            elif trigger[0] == 'TRIG':
+                _, shot_id, timestamp = trigger
+                t0 = time.perf_counter()
                 try:
-                    # Try to initialize flow meter if it's not connected
+                    # Open the session on first use; reopen only if a previous I/O failure closed it
                     if fm is None:
-                        fm = FlowMeter(port=flow_meter_port, slave_address=slave_address)
-                        consecutive_errors = 0  # Reset error counter on successful connection
+                        fm = FlowMeter(port=spec.port, baudrate=spec.baudrate,
+                                       slave_address=spec.address, calibration=spec.calibration)
+                    elif not fm.is_open:
+                        fm.reconnect()
                     
-                    with fm:
-                        time.sleep(wait_time)
-                        buff = fm.device.read_measured_value_buffer(Sfc5xxxScaling.USER_DEFINED, max_reads=3)
-                        q_data.put((slave_address, buff.values, timestamp))
-                        consecutive_errors = 0  # Reset error counter on successful read
+                    time.sleep(wait_time)
+                    n = fm.read_buffer_into(buff, max_reads=3)
+                    consecutive_errors = 0  # Reset error counter on successful read
+                    q_data.put((device_id, shot_id, buff[:n].copy(), timestamp, time.perf_counter() - t0))
                     
                 except Exception as e:
                     consecutive_errors += 1
-                    print(f"Flow meter {slave_address} error ({consecutive_errors}/{MAX_RETRIES}): {str(e)}")
+                    print(f"Flow meter {device_id} error ({consecutive_errors}/{MAX_RETRIES}): {str(e)}")
                     
                     # Send NaN data on failure
-                    q_data.put((slave_address, np.nan, timestamp))
+                    q_data.put((device_id, shot_id, np.nan, timestamp, time.perf_counter() - t0))
                     
-                    # Close and reset connection
-                    if fm is not None:
+                    # Close the port on I/O failure; the next trigger reconnects with cached device info
+                    if fm is not None and FlowMeter.is_io_error(e):
                         try:
                             fm.close()
                         except:
                             pass
-                        fm = None
                     
                     # Add delay between retries
                     if consecutive_errors < MAX_RETRIES:
                         time.sleep(1.0)  # Wait before retry
                     else:
-                        print(f"Flow meter {slave_address} failed after {MAX_RETRIES} attempts")
+                        print(f"Flow meter {device_id} failed after {MAX_RETRIES} attempts")
                         consecutive_errors = 0  # Reset for next trigger
                     
             else:
                 print(f"Unknown command: '{trigger}'")
             
-            time.sleep(0.1)
-            
     except Exception as e:
-        print(f"Fatal error in flow meter {slave_address} process: {str(e)}")
+        print(f"Fatal error in flow meter {device_id} process: {str(e)}")
         raise
     finally:
         if fm is not None:
@@ -175,181 +100,208 @@ def read_flowmeter(q_trigger, q_data, flow_meter_port, slave_address, wait_time=
             except:
                 pass
 
-def save_flow_data(f, flow_data, timestamp, is_east):
+def stream_flowmeters(q_trigger, q_data, specs,
+                      pretrigger_samples=50, posttrigger_samples=250, poll_interval=0.02, shot_timeout=2.0,
+                      stats_interval=600, heartbeat=None):
     """
-    Save flow data to appropriate group in HDF5 file.
-    Handles both normal data and NaN data from failed readings.
+    Process function for streaming acquisition from all flow meters on one serial port.
+
+    The device buffers are drained continuously into one ring buffer per device by an RS485
+    bus scheduler (see shdlc_bus.ShdlcBus), so no blind sleep is needed after a trigger. For
+    every trigger, a fixed window of pretrigger_samples + posttrigger_samples samples around
+    the trigger timestamp is sent to q_data for each device as soon as its post-trigger part
+    has been acquired. Waiting for triggers doubles as the poll interval, so a trigger is
+    picked up as soon as it is queued. Message formats are the same as in read_flowmeter().
+
+    specs : list of flowmeter_config.FlowMeterSpec sharing one serial port.
+    heartbeat : see read_flowmeter().
     """
-    data_length = f.attrs.get('data_length')
-    
-    # If flow_data is NaN (failed reading), create array of NaNs
-    if np.isscalar(flow_data) and np.isnan(flow_data):
-        if data_length is None:
-            print("Cannot save NaN data - data_length not yet established")
-            return False
-        flow_data = np.full(data_length, np.nan)
-    else:
-        # Normal data handling
-        if data_length is None:
-            # First successful reading establishes data length
-            data_length = len(flow_data)
-            f.attrs['data_length'] = data_length
-            # Resize datasets to proper width
-            for grp_name in ["FlowMeter_East", "FlowMeter_West"]:
-                if grp_name in f:
-                    f[grp_name]["flow_data"].resize((0, data_length))
-        elif len(flow_data) != data_length:
-            print(f"Warning: Data length mismatch. Expected {data_length}, got {len(flow_data)}")
-            return False
-
-    grp_name = "FlowMeter_East" if is_east else "FlowMeter_West"
-    grp = f[grp_name]
-    
-    # Extend datasets
-    flow_dataset = grp["flow_data"]
-    time_dataset = grp["timestamp"]
-    
-    flow_dataset.resize((flow_dataset.shape[0] + 1, flow_dataset.shape[1]))
-    time_dataset.resize((time_dataset.shape[0] + 1,))
-    
-    # Save data
-    flow_dataset[-1, :] = flow_data
-    time_dataset[-1] = timestamp
-    
-    return True
+    port = specs[0].port
+    bus = None
+    pending = []  # [shot_id, trigger timestamp, perf_counter at trigger receipt, device IDs still due]
+    next_stats = time.monotonic() + stats_interval
+
+    try:
+        while True:
+            if heartbeat is not None:
+                heartbeat.value = time.monotonic()
+            try:
+                trigger = q_trigger.get(timeout=poll_interval)
+            except queue.Empty:
+                trigger = None
+
+            if trigger == 'QUIT':
+                return
+            elif trigger is not None and trigger[0] == 'TRIG':
+                pending.append([trigger[1], trigger[2], time.perf_counter(), [s.name for s in specs]])
+            elif trigger is not None:
+                print(f"Unknown command: '{trigger}'")
+
+            try:
+                if bus is None:
+                    bus = ShdlcBus(port, specs, pretrigger_samples, posttrigger_samples)
+                elif not bus.is_open:
+                    bus.reconnect()
+
+                # Drain the device buffers; keep reading while they fill faster than we read
+                while bus.service() > 0:
+                    pass
+
+            except Exception as e:
+                print(f"Flow meter bus {port} error: {str(e)}")
+                if bus is None or FlowMeter.is_io_error(e):
+                    if bus is not None:
+                        try:
+                            bus.close()
+                        except:
+                            pass
+                    time.sleep(1.0)  # Wait before reopening the port
+
+            # Cut the windows whose post-trigger samples have arrived
+            for shot in pending:
+                shot_id, timestamp, t0, due = shot
+                timed_out = time.perf_counter() - t0 > shot_timeout
+                for device_id in list(due):
+                    try:
+                        window = bus.cut(device_id, timestamp) if bus is not None else None
+                    except ValueError as e:
+                        print(f"Flow meter {device_id}: {str(e)}")
+                        window = np.nan
+                    if window is None and timed_out:
+                        window = np.nan
+                    if window is not None:
+                        q_data.put((device_id, shot_id, window, timestamp, time.perf_counter() - t0))
+                        due.remove(device_id)
+            pending = [shot for shot in pending if shot[3]]
+
+            if bus is not None and time.monotonic() > next_stats:
+                print(f"\nRS485 bus {port}: {bus.stats()}")
+                bus.reset_stats()
+                next_stats = time.monotonic() + stats_interval
+
+    except Exception as e:
+        print(f"Fatal error in flow meter bus {port} process: {str(e)}")
+        raise
+    finally:
+        if bus is not None:
+            try:
+                bus.close()
+            except:
+                pass
+
+def main(config_path=CONFIG_PATH, trigger_source=None):
+    """
+    Main function to run flow meter data acquisition
 
-def main():
-    """Main function to run flow meter data acquisition"""
+    config_path : JSON file with the flow meter registry (see flowmeter_config.py)
+    trigger_source : object with wait_for_trigger(timeout_ms) and cleanup(), e.g. a
+        trigger_source.TimerTrigger for testing without a Pi. Default is the GPIO trigger.
+    """
     # Flow meter configuration
-    trigger_pin = 25
-    portEast = '/dev/serial/by-id/usb-FTDI_USB-RS485_Cable_AU05D9B7-if00-port0'
-    portWest = '/dev/serial/by-id/usb-FTDI_USB-RS485_Cable_AU050ZDN-if00-port0'
-    addrEast = 2
-    addrWest = 0
+    config = load_config(config_path)
+    specs = config['flow_meters']
+    trigger_pin = config.get('trigger_pin', 25)
+    hdf5_path = config.get('hdf5_path', HDF5_PATH)
     wait_time = 0.110
+    streaming = True  # continuous acquisition with fixed pre/post-trigger windows
+    pretrigger_samples = 50
+    posttrigger_samples = 250
+    flush_latency = 0.5  # seconds until a shot is visible to SWMR readers of the HDF5 file
+    shot_deadline = 2.0  # seconds to wait for all flow meters before a shot is saved with NaN
+    hang_timeout = 10.0  # seconds without heartbeat before a flow meter process is restarted
 
-    # Setup queues
-    q_trigger = mp.Queue()
+    # Setup queues: one trigger queue per flow meter, one shared data queue
+    broadcaster = TriggerBroadcaster()
     q_data = mp.Queue()
+    collector = ShotCollector(q_data, deadline=shot_deadline)
 
-    # Create HDF5 file
-    date = datetime.date.today()
-    hdf5_file = f"{HDF5_PATH}/flow_data_{date}.hdf5"
-    init_hdf5_file(hdf5_file, 
-                   east_info=(portEast, addrEast),
-                   west_info=(portWest, addrWest))
+    # Start the HDF5 writer; every shot row has a fixed length
+    data_length = pretrigger_samples + posttrigger_samples if streaming else 3 * 60  # max_reads=3 buffer reads of 60 values
+    writer = FlowDataWriter(hdf5_path, device_info(specs), data_length, flush_latency=flush_latency,
+                            pretrigger_samples=pretrigger_samples if streaming else 0,
+                            index_path=default_index_path(hdf5_path))
+    writer.start()
 
+    # One worker process per serial port, restarted by the supervisor if it dies or hangs
     print("Starting flow meter processes")
-    eastProcess = mp.Process(target=read_flowmeter, 
-                           args=(q_trigger, q_data, portEast, addrEast, wait_time))
-    westProcess = mp.Process(target=read_flowmeter, 
-                           args=(q_trigger, q_data, portWest, addrWest, wait_time))
-    eastProcess.start()
-    westProcess.start()
+    supervisor = WorkerSupervisor(broadcaster, q_data, hang_timeout=hang_timeout)
+    for port, group in group_by_port(specs).items():
+        if streaming:
+            supervisor.add(port, [spec.name for spec in group], stream_flowmeters,
+                           (group, pretrigger_samples, posttrigger_samples))
+        else:
+            if len(group) > 1:
+                raise ValueError(f"Several flow meters on {port} need streaming acquisition")
+            supervisor.add(port, [group[0].name], read_flowmeter, (group[0], wait_time))
+    supervisor.start()
 
     # Initialize GPIO handler
-    gpio_handler = None
+    gpio_handler = trigger_source
 
     try:
-        gpio_handler = GPIOHandler(trigger_pin)
-        print("GPIO setup - complete")
+        if gpio_handler is None:
+            gpio_handler = GPIOHandler(trigger_pin)
+            print("GPIO setup - complete")
 
         while True:
             # Wait for trigger with 500ms timeout
-            if gpio_handler.wait_for_trigger(timeout_ms=500):
-                # Trigger flow meters
-                if eastProcess.is_alive():
-                    q_trigger.put('TRIG')
-                else:
-                    print("East process is dead. ", end='')
-
-                if westProcess.is_alive():
-                    q_trigger.put('TRIG')
-                else:
-                    print("West process is dead. ", end='')
-
-                if not eastProcess.is_alive() and not westProcess.is_alive():
-                    print("Both flow meter processes are dead. Exiting.")
-                    break
+            trigger = gpio_handler.wait_for_trigger(timeout_ms=500)
+            if trigger:
+                # Shot ID and timestamp come from the trigger edge
+                shot_id, timestamp = trigger.count, trigger.timestamp
+                if trigger.missed:
+                    print(f"\nMissed {trigger.missed} trigger(s) before shot {shot_id}")
 
-                try:
-                    print("\n" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ': ', end='')
-                    
-                    # Check if we need a new file for a new day
-                    current_time = time.time()
-                    try:
-                        with h5py.File(hdf5_file, 'r') as f:
-                            if f.attrs['created'][-2] != get_current_day(current_time):
-                                date = datetime.date.today()
-                                hdf5_file = f"{HDF5_PATH}/flow_data_{date}.hdf5"
-                                init_hdf5_file(hdf5_file, 
-                                             east_info=(portEast, addrEast),
-                                             west_info=(portWest, addrWest))
-                    except Exception as e:
-                        print(f"Error checking file date: {str(e)}")
-                        continue
-
-                    # Get data from both flow meters first
-                    try:
-                        # First flow meter
-                        qd1 = q_data.get(timeout=6)
-                        first_meter_data = (qd1[1], qd1[2], qd1[0] == addrEast)
-                        
-                        # Second flow meter
-                        qd2 = q_data.get(timeout=1)
-                        second_meter_data = (qd2[1], qd2[2], qd2[0] == addrEast)
-                        
-                    except queue.Empty:
-                        print("Timeout waiting for flow meter data")
-                        continue
-
-                    # Then save data in a single file operation
-                    try:
-                        with h5py.File(hdf5_file, 'a', libver='latest') as f:
-                            # Enable SWMR mode for better crash resistance
-                            f.swmr_mode = True
-                            
-                            # Save first flow meter data
-                            if not save_flow_data(f, *first_meter_data):
-                                print("Data length error in first flow meter")
-                            print('{} {}'.format(
-                                'East (#2)' if qd1[0] == 2 else 'West (#1)',
-                                '[ERROR]' if np.isscalar(qd1[1]) and np.isnan(qd1[1]) else ''
-                            ), end=', ', flush=True)
-
-                            # Save second flow meter data
-                            if not save_flow_data(f, *second_meter_data):
-                                print("Data length error in second flow meter")
-                            print('{} {}'.format(
-                                'East (#2)' if qd2[0] == 2 else 'West (#1)',
-                                '[ERROR]' if np.isscalar(qd2[1]) and np.isnan(qd2[1]) else ''
-                            ), flush=True)
-                            
-                            # Explicitly flush to disk
-                            f.flush()
-                            
-                    except OSError as e:
-                        print(f"Error saving to HDF5 file: {str(e)}")
-                        continue
+                # Trigger every healthy worker through its own queue; the devices of the
+                # workers being restarted are missing from this shot
+                healthy = supervisor.healthy()
+                broadcaster.broadcast(shot_id, timestamp, healthy)
+                collector.expect(shot_id, timestamp, supervisor.devices())
+                down = [port for port in supervisor.workers if port not in healthy]
+                if down:
+                    collector.mark_missing(supervisor.devices(down), shot_id)
 
-                except Exception as e:
-                    print(f"Error in trigger handling: {str(e)}")
-                    time.sleep(0.5)
-                    continue
+            # Restart dead or hung workers; their shots in flight will not be answered
+            lost = supervisor.check()
+            if lost:
+                collector.mark_missing(lost)
+
+            # Hand every shot whose results are complete or past the deadline to the writer
+            for sid, timestamp, results in collector.collect():
+                writer.put(sid, timestamp, results)
+                print("\n" + datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+                      + f' shot {sid}: ', end='')
+                for name, (flow_data, latency) in sorted(results.items()):
+                    print('{} {} {}'.format(
+                        name,
+                        '--' if latency is None else '{:.1f} ms'.format(latency * 1e3),
+                        '[ERROR]' if np.isscalar(flow_data) and np.isnan(flow_data) else ''
+                    ), end=', ', flush=True)
+
+            if not writer.is_alive():
+                print("HDF5 writer process is dead. Exiting.")
+                break
 
     except KeyboardInterrupt:
         print("Interrupting processes...")
     except Exception as e:
         print(f"Error: {str(e)}")
     finally:
-        q_trigger.put('QUIT')
-        q_trigger.put('QUIT')
-        
-        eastProcess.join()
-        westProcess.join()
-        
-        eastProcess.close()
-        westProcess.close()
+        # Write the shots still in flight while the workers are still running (a streaming
+        # worker drops its pending windows on QUIT), then stop the workers
+        t_end = time.monotonic() + shot_deadline
+        while collector.pending and time.monotonic() < t_end:
+            for sid, timestamp, results in collector.collect(timeout=0.1):
+                writer.put(sid, timestamp, results)
+        broadcaster.quit()
+        for sid, timestamp, results in collector.collect(flush=True):
+            writer.put(sid, timestamp, results)
+        writer.close()
+
+        supervisor.stop()
+        restarts = {name: n for name, n in supervisor.stats().items() if n}
+        if restarts:
+            print(f"Flow meter process restarts: {restarts}")
 
         if gpio_handler:
             gpio_handler.cleanup()
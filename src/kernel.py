@@ -1,8 +1,9 @@
 import numpy as np
 #import RPi.GPIO as GPIO
 import time
+import os
 #from flow_meter import FlowMeter
-from wavegen_control import wavegen_control
+from wavegen_control import wavegen_control, WaveformManager
 from input import generate_pulse_waveform
 
 '''
@@ -75,22 +76,84 @@ class FlowMeter(object):
 		GPIO.cleanup()
 '''
 
+def puff_time_to_frequency(puff_time):
+	"""Wavegen frequency (Hz) for a puff time (ms)."""
+	# factor of 2 due to the way waveform shape is written; check generate_pulse_waveform()
+	return 1 / (2 * puff_time * 1e-3)
+
+def frequency_to_puff_time(freq):
+	"""Puff time (ms) for a wavegen frequency (Hz)."""
+	return 1 / (2 * freq) * 1e3
+
+def check_settings(high, low, puff_time, max_level):
+	"""Raise ValueError unless 0 <= low < high <= max_level and puff_time > 0."""
+	if not 0 <= low < high <= max_level:
+		raise ValueError(f'Invalid levels: need 0 <= low ({low}) < high ({high}) <= {max_level} V')
+	if puff_time <= 0:
+		raise ValueError(f'Invalid puff time: {puff_time} ms')
+
+def apply_steps(high, low, puff_time, cur_high, output):
+	"""
+	Settings to send for apply(), in order, as (name, value) with name 'output', 'high',
+	'low' or 'frequency'. output : 1 to switch the output off around the level changes.
+	"""
+	steps = [('output', 0)] if output else []
+	# Order the level changes so that high stays above low at every step
+	if low >= cur_high:
+		steps += [('high', high), ('low', low)]
+	else:
+		steps += [('low', low), ('high', high)]
+	steps.append(('frequency', puff_time_to_frequency(puff_time)))
+	if output:
+		steps.append(('output', 1))
+	return steps
+
+
 class GasPuffValve(object):
 
-	def __init__(self, ip_address) -> None:
+	MAX_LEVEL = 10.0  # V, wavegen level limit into high impedance
+
+	def __init__(self, ip_address, settings_log=None, **wavegen_kwargs) -> None:
+		"""
+		ip_address : IP address of the waveform generator.
+		settings_log : optional CSV file; every settings change is appended as
+			timestamp,high_voltage,low_voltage,puff_time (used by shot_joiner.py).
+		wavegen_kwargs : passed to wavegen_control (timeout, retries, interactive, ...).
+		"""
 		if ip_address is None:
 			raise ValueError('IP address must be provided.')
-		# Connect to waveform generator
-		self.wavegen = wavegen_control(server_ip_addr=ip_address)
+		# Connect to waveform generator; one socket is kept open for all commands
+		self.wavegen = wavegen_control(server_ip_addr=ip_address, persistent=True, **wavegen_kwargs)
+		self.waveforms = WaveformManager(self.wavegen)
 		self._puff_time = 10
 		self._high_voltage = 0
 		self._low_voltage = 0
+		self.settings_log = settings_log
 
-	def program_waveform(self):
+	def _log_settings(self):
+		"""Append the current settings to the settings log."""
+		if self.settings_log is None:
+			return
+		try:
+			new = not os.path.exists(self.settings_log)
+			with open(self.settings_log, 'a') as f:
+				if new:
+					f.write('timestamp,high_voltage,low_voltage,puff_time\n')
+				f.write(f'{time.time():.6f},{self._high_voltage},{self._low_voltage},{self._puff_time}\n')
+		except OSError as e:
+			print(f"Could not write valve settings log: {str(e)}")
+
+	def program_waveform(self, data=None, name=None):
+		"""
+		Set up the puff waveform and burst mode. data defaults to generate_pulse_waveform();
+		name keeps the shape in a non-volatile slot of the wavegen. A shape the wavegen already
+		holds is only selected, not uploaded again (see wavegen_control.WaveformManager).
+		"""
 		# Turn off output before applying initial settings
 		self.wavegen.output = 0
-		data = generate_pulse_waveform() # Define Arbitrary waveform shape
-		self.wavegen.send_dac_data(data) # Send waveform shape to the device
+		if data is None:
+			data = generate_pulse_waveform() # Define Arbitrary waveform shape
+		self.waveforms.load(data, name) # Send waveform shape to the device unless it has it
 		self.wavegen.burst(True, 1, 0) # Enable burst mode
 		self.wavegen.voltage_range('ON')
 	
@@ -107,11 +170,14 @@ class GasPuffValve(object):
 		if value < self._low_voltage:
 			print("High voltage is lower than low voltage.")
 
-		self.wavegen.output = 0
-		self.wavegen.set_high_level(value)
-		self.wavegen.output = 1
+		# One command line: output off, new level, output on, *OPC?
+		with self.wavegen.batch():
+			self.wavegen.output = 0
+			self.wavegen.set_high_level(value)
+			self.wavegen.output = 1
 
 		self._high_voltage = value
+		self._log_settings()
 
 	@property
 	def low_voltage(self):
@@ -126,11 +192,14 @@ class GasPuffValve(object):
 		if value > self._high_voltage:
 			print("Low voltage is higher than high voltage.")
 
-		self.wavegen.output = 0
-		self.wavegen.set_low_level(value)
-		self.wavegen.output = 1
+		# One command line: output off, new level, output on, *OPC?
+		with self.wavegen.batch():
+			self.wavegen.output = 0
+			self.wavegen.set_low_level(value)
+			self.wavegen.output = 1
 
 		self._low_voltage = value
+		self._log_settings()
 
 	@property
 	def puff_time(self):
@@ -139,12 +208,69 @@ class GasPuffValve(object):
 	@puff_time.setter
 	def puff_time(self, value):
 		# factor of 2 due to the way waveform shape is written; check generate_pulse_waveform()
-		self.wavegen.frequency = 1 / (2 * value * 1e-3)
+		with self.wavegen.batch():
+			self.wavegen.frequency = 1 / (2 * value * 1e-3)
 		self._puff_time = value
+		self._log_settings()
+
+	def select_waveform(self, name):
+		"""Switch to a puff shape stored earlier with program_waveform(data, name)."""
+		self.waveforms.select(name)
+		self.wavegen.opc()
+
+	def settings(self):
+		"""
+		Current settings of the wavegen as {'high', 'low', 'puff_time'}, from its shadow
+		state (queried when unknown).
+		"""
+		high, low = self.wavegen.voltage_level()
+		return {'high': high, 'low': low, 'puff_time': frequency_to_puff_time(self.wavegen.frequency)}
+
+	def apply(self, high=None, low=None, puff_time=None):
+		"""
+		Change several settings in one transaction; settings not given stay as they are
+		on the wavegen.
+
+		The target state is validated first (0 <= low < high <= MAX_LEVEL, puff_time > 0)
+		and a ValueError is raised before anything is sent. Only the settings that differ
+		from the wavegen's known state are sent, as one command line ending with *OPC?.
+		If the levels change, the output is switched off once around them and then
+		restored, so no puff is fired with half-applied levels.
+
+		Returns the time taken in seconds.
+		"""
+		t0 = time.perf_counter()
+		current = self.settings()
+		high = current['high'] if high is None else float(high)
+		low = current['low'] if low is None else float(low)
+		puff_time = current['puff_time'] if puff_time is None else float(puff_time)
+		check_settings(high, low, puff_time, self.MAX_LEVEL)
+
+		wg = self.wavegen
+		output = wg.output if (high, low) != (current['high'], current['low']) else 0
+		setters = {
+			'output': lambda value: setattr(wg, 'output', value),
+			'high': wg.set_high_level,
+			'low': wg.set_low_level,
+			'frequency': lambda value: setattr(wg, 'frequency', value),
+		}
+		with wg.batch():
+			for name, value in apply_steps(high, low, puff_time, current['high'], output):
+				setters[name](value)
+
+		changed = not np.allclose((high, low, puff_time), (current['high'], current['low'], current['puff_time']))
+		self._high_voltage, self._low_voltage, self._puff_time = high, low, puff_time
+		if changed:
+			self._log_settings()
+		return time.perf_counter() - t0
 
 	def set_output(self,i):
 		self.wavegen.output = i
 
+	def close(self):
+		"""Close the connection to the wavegen."""
+		self.wavegen.close()
+
 #-------------------------------------------------------#
 
 if __name__ == '__main__':
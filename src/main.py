@@ -1,43 +1,93 @@
-from kernel import GasPuffValve
-import numpy as np
+from valve_worker import ValveWorker
 import tkinter as tk
 from tkinter import messagebox
 
+# Every settings change is logged here for the shot table (see shot_joiner.py)
+VALVE_SETTINGS_LOG = '/home/pi/flow_meter/data/valve_settings.csv'
+AMPLIFIER_GAIN = 21.2  # valve voltage per wavegen volt
+
+# Commands run in a background worker, so the window never waits for the wavegen
+worker = ValveWorker(settings_log=VALVE_SETTINGS_LOG).start()
+
+def read_entry(entry, name):
+    try:
+        return float(entry.get())
+    except ValueError:
+        show_status(f"{name}: not a number", error=True)
+        return None
+
 def connect_wavegen():
-    global gas_puff_valve
-    ip_address = ip_address_entry.get()
-    gas_puff_valve = GasPuffValve(ip_address=ip_address)
+    show_status("Connecting...")
+    worker.submit('connect', ip_address_entry.get())
 
 def init_waveform():
-    gas_puff_valve.program_waveform()
+    worker.submit('program')
 
 def enable_output():
-    gas_puff_valve.set_output(1)
+    worker.submit('output', 1)
 
 def disable_output():
-    gas_puff_valve.set_output(0)    
+    worker.submit('output', 0)
 
 def update_high_voltage():
-    v_in = float(high_voltage_entry.get())
+    v_in = read_entry(high_voltage_entry, "High voltage")
+    if v_in is None:
+        return
     if v_in > 106:
         print('Set to 106V, cannot go higher for the moment')
-    gas_puff_valve.high_voltage = v_in/21.2
+    worker.submit('high', v_in/AMPLIFIER_GAIN)
 
 def update_low_voltage():
-    v_in = float(low_voltage_entry.get())
+    v_in = read_entry(low_voltage_entry, "Low voltage")
+    if v_in is None:
+        return
     if v_in < 0:
         v_in = 0
         print('Set to 0V, cannot go negative')
-    gas_puff_valve.low_voltage = v_in/21.2
-    
+    worker.submit('low', v_in/AMPLIFIER_GAIN)
+
 def update_puff_time():
-    gas_puff_valve.puff_time = float(puff_time_entry.get())
+    t = read_entry(puff_time_entry, "Puff time")
+    if t is not None:
+        worker.submit('puff_time', t)
+
+def show_status(text, error=False):
+    status_label.config(text=text, fg='red' if error else 'black')
+
+def show_state(state):
+    def fmt(value, spec):
+        return '?' if value is None else format(value, spec)
+    output = {1: 'ON', 0: 'OFF'}.get(state.get('OUTP'), '?')
+    high, low, freq = state.get('VOLT:HIGH'), state.get('VOLT:LOW'), state.get('FREQ')
+    puff_time = 1 / (2 * freq) * 1e3 if freq else None  # see GasPuffValve.apply()
+    state_label.config(text=(
+        f"Output: {output}   Function: {fmt(state.get('FUNC'), '')}   Burst: {fmt(state.get('BURS:STAT'), '')}\n"
+        f"High: {fmt(high and high * AMPLIFIER_GAIN, '.1f')} V   Low: {fmt(low and low * AMPLIFIER_GAIN, '.1f')} V\n"
+        f"Puff time: {fmt(puff_time, '.2f')} ms"))
+
+def poll_results():
+    # Results of the worker; runs in the Tk thread every 100 ms
+    while not worker.results.empty():
+        result = worker.results.get()
+        if result.state:
+            show_state(result.state)
+        if result.error:
+            show_status(f"{result.command} failed: {result.error}", error=True)
+        elif result.command != 'refresh':
+            merged = f" ({result.coalesced} updates merged)" if result.coalesced > 1 else ""
+            show_status(f"{result.command} done in {result.latency * 1e3:.0f} ms{merged}")
+    window.after(100, poll_results)
+
+def on_close():
+    worker.stop()
+    window.destroy()
 
 
 # Create the main window
 window = tk.Tk()
 window.title("Waveform Control")
-window.geometry("400x500")
+window.geometry("400x620")
+window.protocol("WM_DELETE_WINDOW", on_close)
 
 # Create the widgets
 ip_address_label = tk.Label(window, text="IP Address:")
@@ -81,6 +131,14 @@ puff_time_entry.pack()
 update_puff_time_button = tk.Button(window, text="Update", command=update_puff_time)
 update_puff_time_button.pack(pady=5)
 
+# Live instrument state and the outcome and latency of the last command
+state_label = tk.Label(window, text="Not connected", justify=tk.LEFT)
+state_label.pack(pady=10)
+
+status_label = tk.Label(window, text="", wraplength=380)
+status_label.pack()
+
 
 # Run the main loop
+window.after(100, poll_results)
 window.mainloop()
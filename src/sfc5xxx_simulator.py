@@ -0,0 +1,439 @@
+"""
+Pseudo-terminal simulator of SFC5xxx flow meters speaking SHDLC.
+
+The simulator opens a pty pair and answers SHDLC frames on the master side. The slave side
+(e.g. /dev/pts/5) is used in place of /dev/serial/by-id/... in flowmeters.json, so
+FlowMeter, ShdlcBus and the whole acquisition pipeline can run without Sensirion hardware.
+Several slave addresses can be simulated on one pty, like meters on one RS485 bus.
+
+Supported commands are the ones FlowMeter uses: device information (0xD0), get version
+(0xD1), calibration information (0x40), activate calibration (0x45), medium unit
+configuration (0x21), read measured value (0x08), read measured value buffer (0x09) and
+baud rate (0x91). Other commands are answered with SHDLC error 0x02 (unknown command).
+
+Every device samples a puff-shaped flow trace at a configurable rate into an internal
+buffer of limited size; samples that overflow the buffer are reported as lost values, as
+on the real device. Transmission time at the device baud rate is emulated, and a request
+sent at a different baud rate than the device uses is not answered. CRC errors (corrupted
+checksum) and timeouts (no response) can be injected at a given rate.
+
+Usage:
+    python sfc5xxx_simulator.py --address 2 --address 0 --link /tmp/ttySFC
+"""
+import os
+import pty
+import tty
+import time
+import select
+import termios
+import argparse
+import threading
+from struct import pack, unpack
+import numpy as np
+
+START_STOP = 0x7E
+ESCAPE = 0x7D
+ESCAPE_XOR = 0x20
+CHARS_TO_ESCAPE = (0x7E, 0x7D, 0x11, 0x13)
+
+# SHDLC error codes
+ERR_DATA_SIZE = 0x01
+ERR_UNKNOWN_COMMAND = 0x02
+ERR_PARAMETER_RANGE = 0x04
+
+BAUDRATES = (19200, 38400, 57600, 115200, 230400, 460800)
+
+# Unit encodings used in the frames: (prefix, unit, timebase); standard liter per minute
+SLM = (0, 1, 4)
+
+# (gas description, gas ID, fullscale in slm) of the simulated calibration blocks
+CALIBRATIONS = [('Air', 1, 20.0), ('N2', 2, 20.0), ('Ar', 3, 20.0), ('He', 4, 50.0), ('H2', 5, 50.0)]
+
+
+def checksum(frame):
+    return ~sum(frame) & 0xFF
+
+def stuff(data):
+    """Escape the reserved bytes of a frame."""
+    out = bytearray()
+    for b in data:
+        if b in CHARS_TO_ESCAPE:
+            out.append(ESCAPE)
+            out.append(b ^ ESCAPE_XOR)
+        else:
+            out.append(b)
+    return out
+
+def unstuff(data):
+    out = bytearray()
+    escaped = False
+    for b in data:
+        if escaped:
+            out.append(b ^ ESCAPE_XOR)
+            escaped = False
+        elif b == ESCAPE:
+            escaped = True
+        else:
+            out.append(b)
+    return out
+
+def build_miso_frame(address, command, state, data, corrupt=False):
+    """Raw MISO frame; with corrupt=True the checksum is wrong."""
+    content = bytearray([address, command, state, len(data)]) + bytearray(data)
+    content.append(checksum(content) ^ (0xFF if corrupt else 0x00))
+    return bytes(bytearray([START_STOP]) + stuff(content) + bytearray([START_STOP]))
+
+
+class SimulatedFlowMeter:
+    """
+    State of one simulated SFC5xxx: calibration, medium unit, baud rate and the
+    measurement buffer filled with a periodic gas puff trace.
+    """
+    def __init__(self, address, sample_rate=1000.0, buffer_size=100, puff_period=1.0,
+                 puff_duration=0.03, amplitude=5.0, rise_time=0.003, decay_time=0.02,
+                 noise=0.01, baudrate=460800, seed=None):
+        """
+        Parameters
+        ----------
+        address : int
+            SHDLC slave address.
+        sample_rate : float
+            Buffered samples per second (the real device samples at 1 kHz).
+        buffer_size : int
+            Capacity of the measurement buffer in samples (85 or more on the real devices).
+        puff_period : float
+            Seconds between puffs; 0 disables the periodic puffs (see puff()).
+        puff_duration : float
+            Seconds the simulated valve stays open per puff.
+        amplitude : float
+            Flow in slm with the valve open.
+        rise_time, decay_time : float
+            Exponential time constants of the flow rise and decay in seconds.
+        noise : float
+            Standard deviation of the Gaussian noise added to every sample, in slm.
+        baudrate : int
+            Initial baud rate of the device.
+        """
+        self.address = address
+        self.sampling_time = 1.0 / sample_rate
+        self.buffer = np.zeros(buffer_size, dtype=np.float32)
+        self.count = 0                 # samples currently in the buffer
+        self.lost = 0                  # samples dropped since the last buffer read
+        self.puff_period = puff_period
+        self.puff_duration = puff_duration
+        self.amplitude = amplitude
+        self.rise_time = rise_time
+        self.decay_time = decay_time
+        self.noise = noise
+        self.baudrate = baudrate
+        self.rng = np.random.default_rng(seed)
+
+        self.calibration = 0
+        self.unit = SLM
+        self.t_start = time.monotonic()
+        self.generated = 0             # samples generated since t_start
+        self.puff_times = []           # extra puffs requested with puff()
+
+    def puff(self, t=None):
+        """Add a puff starting at monotonic time t (default: now)."""
+        self.puff_times.append(time.monotonic() if t is None else t)
+
+    def _trace(self, dt):
+        """Flow of one puff, dt seconds after the valve opened."""
+        level = 1 - np.exp(-np.clip(dt, 0, self.puff_duration) / self.rise_time)
+        after = np.maximum(dt - self.puff_duration, 0)
+        return np.where(dt >= 0, self.amplitude * level * np.exp(-after / self.decay_time), 0.0)
+
+    def flow(self, t):
+        """Noise-free flow in slm at monotonic times t (array)."""
+        flow = np.zeros_like(t)
+        if self.puff_period > 0:
+            flow = self._trace((t - self.t_start) % self.puff_period)
+        for t_open in self.puff_times:
+            flow = np.maximum(flow, self._trace(t - t_open))
+        return flow
+
+    def advance(self, now=None):
+        """Generate the samples taken up to now into the buffer."""
+        if now is None:
+            now = time.monotonic()
+        total = int((now - self.t_start) / self.sampling_time)
+        n = total - self.generated
+        if n <= 0:
+            return
+        t = self.t_start + (self.generated + np.arange(n)) * self.sampling_time
+        values = self.flow(t) + self.noise * self.rng.standard_normal(n)
+        self.generated = total
+        self.puff_times = [p for p in self.puff_times if now - p < self.puff_duration + 10 * self.decay_time]
+
+        # The oldest samples are dropped when the buffer overruns
+        size = len(self.buffer)
+        keep = min(size, self.count + n)
+        self.lost += self.count + n - keep
+        if n >= size:
+            self.buffer[:] = values[-size:]
+        else:
+            old = min(self.count, keep - n)
+            self.buffer[:old] = self.buffer[self.count - old:self.count]
+            self.buffer[old:keep] = values
+        self.count = keep
+
+    def scaled(self, values, scaling):
+        """Convert slm to the requested scaling (0: normalized, 1 and 2: physical/user unit)."""
+        if scaling == 0:
+            return values / CALIBRATIONS[self.calibration][2]
+        return values
+
+    def handle(self, command, data):
+        """Execute one command; returns (error code, response data)."""
+        if command == 0xD0:
+            if len(data) != 1:
+                return ERR_DATA_SIZE, b''
+            strings = {0x00: 'SFC5xxx', 0x01: 'SFC5400 (simulated)', 0x02: '3.000.000',
+                       0x03: f'SIM{self.address:05d}'}
+            if data[0] == 0x04:
+                return 0, bytes([1])
+            if data[0] not in strings:
+                return ERR_PARAMETER_RANGE, b''
+            return 0, strings[data[0]].encode() + b'\0'
+
+        if command == 0xD1:
+            return 0, bytes([1, 60, 0, 1, 0, 2, 0])
+
+        if command == 0x40:
+            if len(data) < 1:
+                return ERR_DATA_SIZE, b''
+            if data[0] == 0x00:
+                return 0, pack('>I', len(CALIBRATIONS))
+            if len(data) != 5:
+                return ERR_DATA_SIZE, b''
+            index = unpack('>I', data[1:5])[0]
+            if index >= len(CALIBRATIONS):
+                return ERR_PARAMETER_RANGE, b''
+            gas, gas_id, fullscale = CALIBRATIONS[index]
+            responses = {0x10: pack('>?', True), 0x11: gas.encode() + b'\0', 0x12: pack('>I', gas_id),
+                         0x13: pack('>bBB', *SLM), 0x14: pack('>f', fullscale)}
+            if data[0] not in responses:
+                return ERR_PARAMETER_RANGE, b''
+            return 0, responses[data[0]]
+
+        if command == 0x45:
+            if len(data) != 4:
+                return ERR_DATA_SIZE, b''
+            index = unpack('>I', data)[0]
+            if index >= len(CALIBRATIONS):
+                return ERR_PARAMETER_RANGE, b''
+            self.calibration = index
+            return 0, b''
+
+        if command == 0x21:
+            if len(data) == 4 and data[0] == 0x00:
+                self.unit = unpack('>bBB', data[1:4])
+                return 0, b''
+            if len(data) != 1:
+                return ERR_DATA_SIZE, b''
+            if data[0] in (0x00, 0x01):
+                return 0, pack('>bBB', *self.unit)
+            if data[0] == 0x0A:
+                return 0, pack('>f', CALIBRATIONS[self.calibration][2])
+            return ERR_PARAMETER_RANGE, b''
+
+        if command == 0x08:
+            if len(data) != 1:
+                return ERR_DATA_SIZE, b''
+            value = self.flow(np.array([time.monotonic()]))[0] + self.noise * self.rng.standard_normal()
+            return 0, pack('>f', self.scaled(value, data[0]))
+
+        if command == 0x09:
+            if len(data) != 1:
+                return ERR_DATA_SIZE, b''
+            self.advance()
+            n = min(60, self.count)
+            values = self.scaled(self.buffer[:n], data[0]).astype('>f4')
+            self.buffer[:self.count - n] = self.buffer[n:self.count]
+            self.count -= n
+            header = pack('>IIf', self.lost, self.count, self.sampling_time)
+            self.lost = 0
+            return 0, header + values.tobytes()
+
+        if command == 0x91:
+            if len(data) == 0:
+                return 0, pack('>I', self.baudrate)
+            if len(data) != 4:
+                return ERR_DATA_SIZE, b''
+            baudrate = unpack('>I', data)[0]
+            if baudrate not in BAUDRATES:
+                return ERR_PARAMETER_RANGE, b''
+            self.baudrate = baudrate  # applied after the response is sent
+            return 0, b''
+
+        return ERR_UNKNOWN_COMMAND, b''
+
+
+class Sfc5xxxSimulator:
+    """
+    Serves one or more SimulatedFlowMeter on a pty from a background thread.
+    """
+    def __init__(self, addresses=(0,), crc_error_rate=0.0, timeout_rate=0.0, response_delay=0.0005,
+                 emulate_line=True, link=None, seed=None, **device_kwargs):
+        """
+        Parameters
+        ----------
+        addresses : sequence of int
+            SHDLC slave addresses of the simulated devices on this pty.
+        crc_error_rate : float
+            Fraction of responses sent with a wrong checksum.
+        timeout_rate : float
+            Fraction of requests that are not answered.
+        response_delay : float
+            Processing time of the device before it answers, in seconds.
+        emulate_line : bool
+            Delay every response by its transmission time at the device baud rate, and
+            ignore requests sent at a different baud rate than the device uses.
+        link : str, optional
+            Path of a symlink to the pty slave (e.g. /tmp/ttySFC), so the port name stays fixed.
+        device_kwargs :
+            Passed to SimulatedFlowMeter (sample_rate, buffer_size, puff_period, ...).
+        """
+        self.devices = {}
+        for i, address in enumerate(addresses):
+            self.devices[address] = SimulatedFlowMeter(address, seed=None if seed is None else seed + i,
+                                                       **device_kwargs)
+        self.crc_error_rate = crc_error_rate
+        self.timeout_rate = timeout_rate
+        self.response_delay = response_delay
+        self.emulate_line = emulate_line
+        self.rng = np.random.default_rng(seed)
+        self.stats = {'requests': 0, 'crc_errors': 0, 'timeouts': 0, 'baud_mismatch': 0, 'bad_frames': 0}
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.link = link
+        if link is not None:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        """Port name to pass to FlowMeter / flowmeters.json."""
+        return self.link if self.link is not None else self.port
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def host_baudrate(self):
+        """Baud rate the host configured on the pty slave (None if not a standard rate)."""
+        speed = termios.tcgetattr(self.master_fd)[5]
+        for rate in BAUDRATES:
+            if getattr(termios, f'B{rate}', None) == speed:
+                return rate
+        return None
+
+    def run(self):
+        """Read requests from the pty and answer them until stop() is called."""
+        frame = None
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master_fd], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                continue
+            for b in data:
+                if b != START_STOP:
+                    if frame is not None:
+                        frame.append(b)
+                elif frame:
+                    self._handle_frame(unstuff(frame))
+                    frame = None
+                else:
+                    frame = bytearray()  # start byte (or a stop byte directly followed by a start byte)
+
+    def _handle_frame(self, content):
+        # MOSI frame: address, command, length, data, checksum
+        if len(content) < 4 or content[2] != len(content) - 4 or checksum(content[:-1]) != content[-1]:
+            self.stats['bad_frames'] += 1
+            return
+        address, command, data = content[0], content[1], bytes(content[3:-1])
+        device = self.devices.get(address)
+        if device is None:
+            return  # no device with this address on the bus
+        self.stats['requests'] += 1
+        if self.emulate_line and self.host_baudrate() not in (None, device.baudrate):
+            self.stats['baud_mismatch'] += 1
+            return
+        if self.rng.random() < self.timeout_rate:
+            self.stats['timeouts'] += 1
+            return
+
+        error, response = device.handle(command, data)
+        corrupt = self.rng.random() < self.crc_error_rate
+        if corrupt:
+            self.stats['crc_errors'] += 1
+        raw = build_miso_frame(address, command, error, response, corrupt)
+        if not self.emulate_line:
+            time.sleep(self.response_delay)
+            os.write(self.master_fd, raw)
+            return
+        # The request has to be received before the device answers; the response is sent
+        # in chunks at the line rate (10 bits per byte), so the first byte arrives early
+        byte_time = 10.0 / device.baudrate
+        time.sleep(self.response_delay + (len(content) + 2) * byte_time)
+        for i in range(0, len(raw), 16):
+            os.write(self.master_fd, raw[i:i + 16])
+            time.sleep(len(raw[i:i + 16]) * byte_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate SFC5xxx flow meters on a pseudo-terminal.")
+    parser.add_argument('--address', type=int, action='append', help="SHDLC slave address (repeatable, default 0)")
+    parser.add_argument('--link', help="create a symlink to the pty at this path, e.g. /tmp/ttySFC")
+    parser.add_argument('--rate', type=float, default=1000.0, help="sample rate in Hz")
+    parser.add_argument('--buffer-size', type=int, default=100, help="device buffer size in samples")
+    parser.add_argument('--puff-period', type=float, default=1.0, help="seconds between puffs (0: no puffs)")
+    parser.add_argument('--amplitude', type=float, default=5.0, help="puff flow in slm")
+    parser.add_argument('--baudrate', type=int, default=460800, help="initial device baud rate")
+    parser.add_argument('--crc-error-rate', type=float, default=0.0, help="fraction of responses with a bad checksum")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="fraction of requests not answered")
+    args = parser.parse_args()
+
+    sim = Sfc5xxxSimulator(addresses=args.address or [0], crc_error_rate=args.crc_error_rate,
+                           timeout_rate=args.timeout_rate, link=args.link, sample_rate=args.rate,
+                           buffer_size=args.buffer_size, puff_period=args.puff_period,
+                           amplitude=args.amplitude, baudrate=args.baudrate)
+    sim.start()
+    print(f"Simulating SFC5xxx at addresses {sorted(sim.devices)} on {sim.path}")
+    try:
+        while True:
+            time.sleep(10)
+            print(sim.stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
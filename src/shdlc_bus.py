@@ -0,0 +1,165 @@
+"""
+RS485 bus scheduler for several SFC5xxx flow meters sharing one serial port.
+
+SHDLC addresses several slaves on one RS485 line, but only one transaction can be on the
+line at a time. ShdlcBus owns the serial port and interleaves single buffer-read
+transactions of all devices on the bus. The device read longest ago goes first, which is
+round-robin in normal operation. Each device has a deadline: the longest time between two
+reads before its internal buffer (85 samples or more at 1 kHz) can overrun. Each device
+is exposed as a virtual stream (a FlowStream with its own ring buffer).
+"""
+import time
+from collections import OrderedDict
+
+from sensirion_shdlc_driver import ShdlcSerialPort
+from sensirion_shdlc_driver.errors import ShdlcError, ShdlcTimeoutError
+
+from FlowMeterCommunication import FlowMeter
+from flow_stream import FlowStream
+
+
+class BusDevice:
+    """Scheduling state of one flow meter on the bus."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.fm = None
+        self.stream = None
+        self.last_read = None     # time.monotonic() of the last buffer read
+        self.retry_at = 0.0       # time.monotonic() before which the device is not polled after a failure
+        self.failures = 0
+        self.deadline_misses = 0
+
+    @property
+    def name(self):
+        return self.spec.name
+
+
+class ShdlcBus:
+    """
+    Owns one serial port and schedules buffer reads for all flow meters on it.
+    """
+    def __init__(self, port, specs, pretrigger_samples=50, posttrigger_samples=250,
+                 deadline=0.08, retry_delay=1.0):
+        """
+        Parameters
+        ----------
+        port : str
+            Serial port of the RS485 adapter.
+        specs : list of flowmeter_config.FlowMeterSpec
+            Flow meters on this port; they must use the same baud rate.
+        pretrigger_samples, posttrigger_samples : int
+            Shot window of every virtual stream.
+        deadline : float
+            Longest time in seconds between two reads of a device before it counts as a
+            deadline miss (the smallest SFC5xxx buffer holds 85 ms at 1 kHz).
+        retry_delay : float
+            Seconds a device that stopped answering is left alone before it is reinitialized.
+        """
+        baudrates = set(s.baudrate for s in specs)
+        if len(baudrates) != 1:
+            raise ValueError(f"Flow meters on {port} use different baud rates: {baudrates}")
+        self.port_name = port
+        self.pretrigger_samples = pretrigger_samples
+        self.posttrigger_samples = posttrigger_samples
+        self.deadline = deadline
+        self.retry_delay = retry_delay
+        self.devices = OrderedDict((s.name, BusDevice(s)) for s in specs)
+
+        self.port = ShdlcSerialPort(port=port, baudrate=baudrates.pop())
+        self.busy_time = 0.0              # time spent in transactions since reset_stats()
+        self.stats_start = time.monotonic()
+        try:
+            for dev in self.devices.values():
+                self._init_device(dev)
+        except BaseException:
+            self.port.close()  # the caller never gets the bus to close
+            raise
+
+    def _init_device(self, dev):
+        """(Re)configure one device; I/O failures of the port itself are raised."""
+        try:
+            if dev.fm is None:
+                dev.fm = FlowMeter(port=self.port_name, baudrate=dev.spec.baudrate,
+                                   slave_address=dev.spec.address, calibration=dev.spec.calibration,
+                                   shdlc_port=self.port)
+                dev.stream = FlowStream(dev.fm, self.pretrigger_samples, self.posttrigger_samples)
+            else:
+                dev.fm.open()
+            dev.failures = 0
+            dev.last_read = None
+        except RuntimeError as e:
+            self._device_failed(dev, e)
+
+    def _device_failed(self, dev, e):
+        cause = e.__cause__ if isinstance(e, RuntimeError) and e.__cause__ is not None else e
+        if isinstance(cause, OSError):
+            raise e  # the serial port itself failed
+        dev.failures += 1
+        dev.retry_at = time.monotonic() + self.retry_delay
+        print(f"Flow meter {dev.name} on {self.port_name} not responding ({dev.failures}): {str(e)}")
+
+    @property
+    def is_open(self):
+        return self.port.is_open
+
+    def close(self):
+        self.port.close()
+
+    def reconnect(self):
+        """Reopen the serial port after an I/O failure and reconfigure all devices."""
+        print(f"Reopening RS485 bus {self.port_name}")
+        self.port.close()
+        self.port.open()
+        for dev in self.devices.values():
+            self._init_device(dev)
+
+    def service(self):
+        """
+        Run one scheduling round: one buffer-read transaction per ready device, least
+        recently read first. Returns the total number of samples left in the device
+        buffers, so the caller can run another round right away if it is not zero.
+        """
+        now = time.monotonic()
+        backlog = 0
+        order = sorted(self.devices.values(), key=lambda d: -1.0 if d.last_read is None else d.last_read)
+        for dev in order:
+            if dev.fm is None or dev.failures:
+                if now >= dev.retry_at:
+                    self._init_device(dev)
+                continue
+
+            t_start = time.monotonic()
+            if dev.last_read is not None and t_start - dev.last_read > self.deadline:
+                dev.deadline_misses += 1
+            try:
+                backlog += dev.stream.poll(max_reads=1)
+            except ShdlcTimeoutError as e:
+                self._device_failed(dev, e)
+            except ShdlcError as e:
+                print(f"Flow meter {dev.name} on {self.port_name}: {str(e)}")  # garbled frame, retried next round
+            t_end = time.monotonic()
+            self.busy_time += t_end - t_start
+            dev.last_read = t_end
+        return backlog
+
+    def cut(self, name, trigger_time):
+        """Shot window of device `name` (see FlowStream.cut); None if not available yet."""
+        dev = self.devices[name]
+        if dev.stream is None:
+            return None
+        return dev.stream.cut(trigger_time)
+
+    def stats(self):
+        """Bus utilisation (fraction of time spent in transactions) and per-device counters."""
+        elapsed = time.monotonic() - self.stats_start
+        return {
+            'utilisation': self.busy_time / elapsed if elapsed > 0 else 0.0,
+            'devices': {name: {'lost_samples': dev.fm.lost_samples if dev.fm else None,
+                               'deadline_misses': dev.deadline_misses,
+                               'failures': dev.failures}
+                        for name, dev in self.devices.items()},
+        }
+
+    def reset_stats(self):
+        self.busy_time = 0.0
+        self.stats_start = time.monotonic()
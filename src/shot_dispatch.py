@@ -0,0 +1,115 @@
+"""
+Per-device trigger fan-out and shot-ID based result collection for the flow meter workers.
+
+Every registered worker gets its own trigger queue, so each worker receives exactly one
+message per shot no matter how many workers are running; a worker may serve several
+devices (e.g. all flow meters on one RS485 bus). Trigger messages are tuples
+('TRIG', shot_id, timestamp); workers answer on a shared data queue with
+(device_id, shot_id, flow_data, timestamp, latency). Results are grouped by shot ID, and
+a shot is complete when all expected devices have answered or its deadline has passed.
+"""
+import time
+import queue
+import multiprocessing as mp
+import numpy as np
+
+
+class TriggerBroadcaster:
+    """Sends each trigger to every registered worker through its own queue."""
+    def __init__(self):
+        self.queues = {}
+
+    def register(self, worker_id):
+        """Create and return the trigger queue of a worker."""
+        q = mp.Queue()
+        self.queues[worker_id] = q
+        return q
+
+    def broadcast(self, shot_id, timestamp, worker_ids=None):
+        """
+        Send a trigger message to the given workers (default: all registered workers).
+        mp.Queue.put hands the message to a feeder thread, so this does not wait on the workers.
+        """
+        if worker_ids is None:
+            worker_ids = self.queues.keys()
+        for worker_id in worker_ids:
+            self.queues[worker_id].put(('TRIG', shot_id, timestamp))
+
+    def quit(self):
+        """Ask every registered worker to exit."""
+        for q in self.queues.values():
+            q.put('QUIT')
+
+
+class ShotCollector:
+    """
+    Groups worker results by shot ID.
+    Devices that have not answered when the shot deadline passes are recorded as NaN.
+    """
+    def __init__(self, q_data, deadline=2.0):
+        """
+        Parameters
+        ----------
+        q_data : multiprocessing.Queue
+            Shared queue the workers put their results on.
+        deadline : float
+            Seconds after expect() at which a shot is completed with whatever arrived.
+        """
+        self.q_data = q_data
+        self.deadline = deadline
+        self.shots = {}  # shot_id -> [timestamp, deadline, expected device IDs, results]
+
+    def expect(self, shot_id, timestamp, device_ids):
+        """Register a shot that was sent to device_ids."""
+        self.shots[shot_id] = [timestamp, time.monotonic() + self.deadline, set(device_ids), {}]
+
+    def mark_missing(self, device_ids, shot_id=None):
+        """
+        Record devices that will not answer (e.g. their worker is down) as missing, for one
+        shot or all pending shots, so those shots complete without waiting for the deadline.
+        Data that still arrives replaces the missing entry.
+        """
+        shot_ids = list(self.shots) if shot_id is None else [shot_id]
+        for sid in shot_ids:
+            results = self.shots[sid][3]
+            for device_id in device_ids:
+                results.setdefault(device_id, (np.nan, None))
+
+    @property
+    def pending(self):
+        """Number of shots still waiting for results."""
+        return len(self.shots)
+
+    def collect(self, timeout=0, flush=False):
+        """
+        Read results from the data queue and return the completed shots in shot order,
+        as a list of (shot_id, timestamp, {device_id: (flow_data, latency)}).
+
+        timeout : float
+            Longest time to wait for the first result if none is queued.
+        flush : bool
+            Complete all pending shots regardless of their deadline (used at shutdown).
+        """
+        block = timeout > 0
+        while True:
+            try:
+                device_id, shot_id, flow_data, timestamp, latency = self.q_data.get(block=block, timeout=timeout if block else None)
+            except queue.Empty:
+                break
+            block = False
+            shot = self.shots.get(shot_id)
+            if shot is None:
+                print(f"Late data from {device_id} for shot {shot_id} discarded")
+                continue
+            shot[3][device_id] = (flow_data, latency)
+
+        now = time.monotonic()
+        completed = []
+        for shot_id in sorted(self.shots):
+            timestamp, deadline, expected, results = self.shots[shot_id]
+            if flush or expected.issubset(results) or now >= deadline:
+                for device_id in expected.difference(results):
+                    results[device_id] = (np.nan, None)
+                completed.append((shot_id, timestamp, results))
+                del self.shots[shot_id]
+        return completed
@@ -0,0 +1,234 @@
+"""
+Persistent shot index across the daily flow data files.
+
+A SQLite database next to the HDF5 files (shot_index.sqlite) holds one entry per shot
+written: a global shot number that keeps counting across files and restarts of the
+acquisition, the trigger shot ID, the trigger time, the file and row of the shot, and the
+status of every flow meter (OK, or NaN if the reading failed). The writer adds each batch
+right after it was written to the HDF5 file.
+
+Queries resolve a range of global shot numbers or a time range to contiguous HDF5 slices
+(file, first row, last row + 1), so the shots can be read with one dataset read per file:
+
+    index = ShotIndex('/home/pi/flow_meter/data/shot_index.sqlite')
+    for s in index.slices(start=5000, stop=5101):
+        print(s.file, s.row_start, s.row_stop)
+    flow = index.read('East', index.slices(t_start=t_start, t_end=t_end))
+"""
+import os
+import glob
+import sqlite3
+import argparse
+import datetime
+from collections import namedtuple
+import numpy as np
+import h5py
+
+INDEX_NAME = 'shot_index.sqlite'
+
+ShotSlice = namedtuple('ShotSlice', ['file', 'row_start', 'row_stop', 'first_shot', 'last_shot'])
+
+
+def default_index_path(hdf5_path):
+    """Index file of a flow data directory."""
+    return os.path.join(hdf5_path, INDEX_NAME)
+
+def _to_time(t):
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    return t
+
+
+class ShotIndex:
+    """
+    SQLite shot index. File names are stored relative to the directory of the index, so
+    the data directory can be moved together with its index.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.root = os.path.dirname(self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS shots (
+                global_shot INTEGER PRIMARY KEY AUTOINCREMENT,
+                shot_id INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                file TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                UNIQUE (file, row)
+            );
+            CREATE INDEX IF NOT EXISTS shots_timestamp ON shots (timestamp);
+            CREATE TABLE IF NOT EXISTS device_status (
+                global_shot INTEGER NOT NULL REFERENCES shots (global_shot),
+                device TEXT NOT NULL,
+                ok INTEGER NOT NULL,
+                PRIMARY KEY (global_shot, device)
+            );
+        """)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _rel(self, file_name):
+        return os.path.relpath(os.path.abspath(file_name), self.root)
+
+    def _abs(self, file_name):
+        return os.path.join(self.root, file_name)
+
+    def add_batch(self, file_name, first_row, shots):
+        """
+        Add shots written to file_name starting at first_row, in one transaction.
+
+        shots : list of (shot_id, timestamp, {name: (flow_data, latency)}), as written by
+            flow_writer.save_flow_data
+        """
+        rel = self._rel(file_name)
+        with self.db:
+            self._forget(rel, first_row)  # entries of a file that was replaced
+            for i, (shot_id, timestamp, results) in enumerate(shots):
+                cur = self.db.execute("INSERT INTO shots (shot_id, timestamp, file, row) VALUES (?, ?, ?, ?)",
+                                      (int(shot_id), float(timestamp), rel, first_row + i))
+                status = [(cur.lastrowid, name, int(not (np.isscalar(data) and np.isnan(data))))
+                          for name, (data, latency) in results.items()]
+                self.db.executemany("INSERT OR REPLACE INTO device_status VALUES (?, ?, ?)", status)
+
+    def _forget(self, rel, first_row):
+        """Remove the entries of rows >= first_row of a file."""
+        self.db.execute("DELETE FROM device_status WHERE global_shot IN "
+                        "(SELECT global_shot FROM shots WHERE file = ? AND row >= ?)", (rel, first_row))
+        self.db.execute("DELETE FROM shots WHERE file = ? AND row >= ?", (rel, first_row))
+
+    def add_file(self, file_name):
+        """
+        Index all shots of an existing flow data file that are not in the index yet
+        (used to build the index for files written before it existed). Returns the number
+        of shots added.
+        """
+        rel = self._rel(file_name)
+        indexed = self.db.execute("SELECT COUNT(*) FROM shots WHERE file = ?", (rel,)).fetchone()[0]
+        with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+            groups = [key for key in f if key.startswith("FlowMeter_")]
+            if not groups:
+                return 0
+            n = min(f[key]['timestamp'].shape[0] for key in groups)
+            if n <= indexed:
+                return 0
+            # Files written before the shot IDs were stored: use the row number
+            if 'shot_id' in f[groups[0]]:
+                shot_ids = f[groups[0]]['shot_id'][indexed:n]
+            else:
+                shot_ids = np.arange(indexed, n)
+            timestamps = f[groups[0]]['timestamp'][indexed:n]
+            ok = {key[len("FlowMeter_"):]: ~np.all(np.isnan(f[key]['flow_data'][indexed:n]), axis=1)
+                  for key in groups}
+        with self.db:
+            for i in range(n - indexed):
+                cur = self.db.execute("INSERT INTO shots (shot_id, timestamp, file, row) VALUES (?, ?, ?, ?)",
+                                      (int(shot_ids[i]), float(timestamps[i]), rel, indexed + i))
+                self.db.executemany("INSERT OR REPLACE INTO device_status VALUES (?, ?, ?)",
+                                    [(cur.lastrowid, name, int(status[i])) for name, status in ok.items()])
+        return n - indexed
+
+    def rebuild(self, hdf5_path):
+        """Index the shots of every flow data file in hdf5_path, oldest file first."""
+        total = 0
+        files = glob.glob(os.path.join(hdf5_path, "flow_data_*.hdf5"))
+        for file_name in sorted(files, key=os.path.getmtime):
+            n = self.add_file(file_name)
+            if n:
+                print(f"{file_name}: {n} shots indexed")
+            total += n
+        return total
+
+    @property
+    def count(self):
+        """Number of shots in the index."""
+        return self.db.execute("SELECT COUNT(*) FROM shots").fetchone()[0]
+
+    def shots(self, start=None, stop=None, t_start=None, t_end=None):
+        """
+        Shots by global shot number [start, stop) and/or trigger time [t_start, t_end)
+        (epoch seconds or datetime), in global shot order. Returns a list of
+        (global_shot, shot_id, timestamp, file, row, {device: ok}).
+        """
+        where, args = [], []
+        for cond, value in (("global_shot >= ?", start), ("global_shot < ?", stop),
+                            ("timestamp >= ?", _to_time(t_start)), ("timestamp < ?", _to_time(t_end))):
+            if value is not None:
+                where.append(cond)
+                args.append(value)
+        sql = "SELECT global_shot, shot_id, timestamp, file, row FROM shots"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.db.execute(sql + " ORDER BY global_shot", args).fetchall()
+        if not rows:
+            return []
+
+        status = {}
+        for global_shot, device, ok in self.db.execute(
+                "SELECT global_shot, device, ok FROM device_status WHERE global_shot BETWEEN ? AND ?",
+                (rows[0][0], rows[-1][0])):
+            status.setdefault(global_shot, {})[device] = bool(ok)
+        return [(g, shot_id, timestamp, self._abs(file), row, status.get(g, {}))
+                for g, shot_id, timestamp, file, row in rows]
+
+    def nearest(self, t):
+        """Global shot number of the shot closest to time t, or None if the index is empty."""
+        t = _to_time(t)
+        candidates = self.db.execute(
+            "SELECT * FROM (SELECT global_shot, timestamp FROM shots WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1) "
+            "UNION ALL SELECT * FROM (SELECT global_shot, timestamp FROM shots WHERE timestamp > ? ORDER BY timestamp LIMIT 1)",
+            (t, t)).fetchall()
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: abs(c[1] - t))[0]
+
+    def slices(self, start=None, stop=None, t_start=None, t_end=None):
+        """
+        Resolve a shot range or time range (see shots()) to contiguous HDF5 row ranges.
+        Returns a list of ShotSlice(file, row_start, row_stop, first_shot, last_shot).
+        """
+        result = []
+        for g, shot_id, timestamp, file, row, status in self.shots(start, stop, t_start, t_end):
+            last = result[-1] if result else None
+            if last is not None and last.file == file and last.row_stop == row:
+                result[-1] = last._replace(row_stop=row + 1, last_shot=g)
+            else:
+                result.append(ShotSlice(file, row, row + 1, g, g))
+        return result
+
+    @staticmethod
+    def read(name, slices, dataset='flow_data'):
+        """
+        Read a dataset of flow meter `name` (flow_data, timestamp, shot_id or summary) for
+        the given slices, one read per slice, concatenated along the shot axis.
+        """
+        parts = []
+        for s in slices:
+            with h5py.File(s.file, 'r', libver='latest', swmr=True) as f:
+                ds = f[f"FlowMeter_{name}/{dataset}"]
+                ds.refresh()
+                parts.append(ds[s.row_start:s.row_stop])
+        if not parts:
+            return np.empty(0)
+        return np.concatenate(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the shot index of a flow data directory.")
+    parser.add_argument('hdf5_path', help="directory of the daily flow data files")
+    args = parser.parse_args()
+    with ShotIndex(default_index_path(args.hdf5_path)) as index:
+        index.rebuild(args.hdf5_path)
+        print(f"{index.count} shots in {index.path}")
+
+
+if __name__ == '__main__':
+    main()
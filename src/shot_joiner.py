@@ -0,0 +1,343 @@
+"""
+Per-shot table joining flow, valve settings and vacuum pressure (the output.csv of the
+system diagram).
+
+Sources, all keyed by time:
+    flow      : daily flow_data_<date>.hdf5 files of flowmeter_main; the trigger timestamp
+                and shot ID of every shot and the per-device features of the summary
+                datasets (see flow_analytics.py)
+    pressure  : daily pressure_data_<date>.hdf5 files of pfeiffer/Pfeiffer_control.py,
+                sampled independently of the shots
+    valve     : CSV log of the GasPuffValve settings (kernel.py, settings_log); each
+                setting applies from its timestamp until the next change
+
+The shots drive the join. Both sides are sorted by time, so every source is matched with
+one vectorized merge (np.searchsorted over the sorted times) instead of a search per shot:
+the pressure sample nearest to the trigger within `tolerance` seconds, and the last valve
+setting at or before the trigger. Unmatched values are left empty.
+
+ShotJoiner follows the flow file of the current day and appends new shots to
+output_<date>.csv once the pressure logger had time to record them; backfill() rebuilds
+the tables of past days, one day per worker process.
+
+Usage:
+    python shot_joiner.py --flow /home/pi/flow_meter/data --pressure /mnt/gauge --out /home/pi/flow_meter/tables
+    python shot_joiner.py ... --backfill 2025-06-01 2025-06-30
+"""
+import os
+import csv
+import glob
+import time
+import datetime
+import argparse
+import multiprocessing as mp
+import numpy as np
+import h5py
+
+from flow_analytics import SUMMARY_DTYPE
+
+VALVE_FIELDS = ('high_voltage', 'low_voltage', 'puff_time')
+
+
+def merge_indices(t, t_ref, tolerance=None, direction='nearest'):
+    """
+    Match every time of the sorted array t to an entry of the sorted array t_ref.
+
+    direction : 'nearest' (closest entry) or 'backward' (last entry at or before t)
+    tolerance : largest allowed time difference in seconds (None: no limit)
+
+    Returns the indices into t_ref, -1 where there is no match.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    t_ref = np.asarray(t_ref, dtype=np.float64)
+    if len(t_ref) == 0:
+        return np.full(len(t), -1, dtype=np.int64)
+    after = np.searchsorted(t_ref, t, side='right')   # first entry later than t
+    before = after - 1
+    if direction == 'backward':
+        idx = before
+    else:
+        after = np.minimum(after, len(t_ref) - 1)
+        before_ok = before >= 0
+        d_before = np.where(before_ok, t - t_ref[np.maximum(before, 0)], np.inf)
+        d_after = t_ref[after] - t
+        idx = np.where(before_ok & (d_before <= np.abs(d_after)), before, after)
+    valid = idx >= 0
+    if tolerance is not None:
+        valid &= np.abs(t - t_ref[np.maximum(idx, 0)]) <= tolerance
+    return np.where(valid, idx, -1)
+
+def _take(values, idx):
+    """values[idx] as float64 with NaN where idx is -1."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.full(len(idx), np.nan)
+    return np.where(idx >= 0, values[np.maximum(idx, 0)], np.nan)
+
+def flow_files(flow_path, date):
+    """Flow data files of a date (including numbered files started after a layout change)."""
+    return sorted(glob.glob(os.path.join(flow_path, f"flow_data_{date}*.hdf5")))
+
+def read_flow(file_name, start_row=0):
+    """
+    Read shots start_row... of a flow data file.
+    Returns (timestamp, shot_id, {device: summary}) with the shots sorted by time.
+    """
+    with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+        groups = [key for key in f if key.startswith("FlowMeter_")]
+        if not groups:
+            return np.empty(0), np.empty(0, dtype=np.int64), {}
+        for key in groups:
+            for ds in f[key].values():
+                ds.refresh()
+        # Rows are only complete once every dataset of every group was resized
+        n = min(f[key][ds].shape[0] for key in groups for ds in ('timestamp', 'shot_id', 'summary')
+                if ds in f[key])
+        timestamps = f[groups[0]]['timestamp'][start_row:n]
+        if 'shot_id' in f[groups[0]]:
+            shot_ids = f[groups[0]]['shot_id'][start_row:n]
+        else:
+            shot_ids = np.arange(start_row, n, dtype=np.int64)   # files written before shot IDs: row numbers
+        summaries = {}
+        for key in groups:
+            if 'summary' in f[key]:
+                summaries[key[len("FlowMeter_"):]] = f[key]['summary'][start_row:n]
+            else:
+                summaries[key[len("FlowMeter_"):]] = np.full(len(timestamps), np.nan, dtype=SUMMARY_DTYPE)
+    order = np.argsort(timestamps, kind='stable')
+    return timestamps[order], shot_ids[order], {name: s[order] for name, s in summaries.items()}
+
+def read_pressure(pressure_path, t_start, t_end):
+    """
+    Pressure samples between t_start and t_end from the daily Pfeiffer files.
+    Returns (timestamp, {sensor: pressure in Torr}), sorted by time.
+    """
+    parts = []  # (timestamps, {sensor: pressures}) per file
+    date = datetime.date.fromtimestamp(t_start)
+    while date <= datetime.date.fromtimestamp(t_end):
+        file_name = os.path.join(pressure_path, f"pressure_data_{date}.hdf5")
+        date += datetime.timedelta(days=1)
+        if not os.path.exists(file_name):
+            continue
+        try:
+            f = h5py.File(file_name, 'r', libver='latest', swmr=True)
+        except OSError as e:
+            print(f"Could not read {file_name}: {str(e)}")
+            continue
+        with f:
+            grp = f['PfeifferVacuum']
+            sensors = [key for key in grp if key != 'timestamp']
+            # The logger resizes the sensor datasets before the timestamp
+            n = min([grp['timestamp'].shape[0]] + [grp[key].shape[0] for key in sensors])
+            t = grp['timestamp'][:n].astype(np.float64)
+            sel = (t >= t_start) & (t <= t_end)
+            parts.append((t[sel], {key: grp[key][:n][sel] for key in sensors}))
+    if not parts:
+        return np.empty(0), {}
+
+    sensors = sorted({key for t, p in parts for key in p}, key=lambda k: (len(k), k))  # "1", "2", ..., "10"
+    t = np.concatenate([t for t, p in parts])
+    pressures = {key: np.concatenate([p.get(key, np.full(len(t_part), np.nan)) for t_part, p in parts])
+                 for key in sensors}
+    order = np.argsort(t, kind='stable')
+    return t[order], {key: p[order] for key, p in pressures.items()}
+
+def read_valve_log(valve_log):
+    """Valve settings log as (timestamp, {field: values}), sorted by time."""
+    if valve_log is None or not os.path.exists(valve_log):
+        return np.empty(0), {field: np.empty(0) for field in VALVE_FIELDS}
+    data = np.genfromtxt(valve_log, delimiter=',', names=True, ndmin=1)
+    if data.size == 0:
+        return np.empty(0), {field: np.empty(0) for field in VALVE_FIELDS}
+    order = np.argsort(data['timestamp'], kind='stable')
+    return data['timestamp'][order], {field: data[field][order] for field in VALVE_FIELDS}
+
+def join_shots(timestamps, shot_ids, summaries, pressure, valve, tolerance=2.0):
+    """
+    Join the shots with the pressure samples and valve settings.
+    Returns (header, columns) where columns is a list of arrays, one per header entry.
+    """
+    t_pressure, pressures = pressure
+    t_valve, settings = valve
+    i_pressure = merge_indices(timestamps, t_pressure, tolerance, 'nearest')
+    i_valve = merge_indices(timestamps, t_valve, None, 'backward')
+
+    header = ['shot_id', 'timestamp', 'time']
+    columns = [shot_ids, np.array([f"{t:.6f}" for t in timestamps]),
+               np.array([datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] for t in timestamps])]
+    for field in VALVE_FIELDS:
+        header.append(field)
+        columns.append(_take(settings[field], i_valve))
+    header.append('pressure_dt')
+    columns.append(np.where(i_pressure >= 0, _take(t_pressure, i_pressure) - timestamps, np.nan))
+    for sensor, p in pressures.items():
+        header.append(f'pressure_{sensor}')
+        columns.append(_take(p, i_pressure))
+    for name, summary in sorted(summaries.items()):
+        header.append(f'{name}_ok')
+        columns.append((~np.isnan(summary['baseline'])).astype(int))
+        for field in SUMMARY_DTYPE.names:
+            header.append(f'{name}_{field}')
+            columns.append(summary[field])
+    return header, columns
+
+def _format(v):
+    """CSV cell: empty for NaN, 7 significant digits for floats (the data are float32)."""
+    if isinstance(v, (float, np.floating)):
+        return '' if np.isnan(v) else f"{v:.7g}"
+    return v.item() if hasattr(v, 'item') else v
+
+def append_table(csv_name, header, columns):
+    """Append rows to a per-day table, writing the header if the file is new."""
+    new = not os.path.exists(csv_name)
+    with open(csv_name, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(header)
+        for row in zip(*columns):
+            writer.writerow([_format(v) for v in row])
+
+def table_name(output_path, date):
+    return os.path.join(output_path, f"output_{date}.csv")
+
+def join_day(date, flow_path, pressure_path, valve_log, output_path, tolerance=2.0):
+    """
+    Rebuild the table of one day from scratch. Returns the number of shots written.
+    The table is written to a temporary file that replaces the existing one only once the
+    whole day was joined, so a failed join leaves the old table in place.
+    """
+    csv_name = table_name(output_path, date)
+    tmp_name = csv_name + '.tmp'
+    if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+    valve = read_valve_log(valve_log)
+    n = 0
+    try:
+        for file_name in flow_files(flow_path, date):
+            timestamps, shot_ids, summaries = read_flow(file_name)
+            if len(timestamps) == 0:
+                continue
+            pressure = read_pressure(pressure_path, timestamps[0] - tolerance, timestamps[-1] + tolerance)
+            append_table(tmp_name, *join_shots(timestamps, shot_ids, summaries, pressure, valve, tolerance))
+            n += len(timestamps)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    if os.path.exists(tmp_name):
+        os.replace(tmp_name, csv_name)
+    elif os.path.exists(csv_name):
+        os.remove(csv_name)   # no shots that day any more
+    return n
+
+def _join_day(args):
+    return args[0], join_day(*args)
+
+def backfill(dates, flow_path, pressure_path, valve_log, output_path, tolerance=2.0, processes=None):
+    """Rebuild the tables of several days in parallel. Returns {date: shots written}."""
+    results = {}
+    tasks = [(date, flow_path, pressure_path, valve_log, output_path, tolerance) for date in dates]
+    with mp.Pool(processes) as pool:
+        for date, n in pool.imap_unordered(_join_day, tasks):
+            results[date] = n
+            if n:
+                print(f"{date}: {n} shots")
+    return results
+
+
+class ShotJoiner:
+    """
+    Follows the flow files of the current day and appends joined shots to the day table.
+    A shot is joined once it is `tolerance` seconds old, so the pressure sample after it
+    has been written by the pressure logger.
+    """
+    def __init__(self, flow_path, pressure_path, valve_log, output_path, tolerance=2.0):
+        self.flow_path = flow_path
+        self.pressure_path = pressure_path
+        self.valve_log = valve_log
+        self.output_path = output_path
+        self.tolerance = tolerance
+        self.rows_done = {}  # flow file -> rows joined so far
+        os.makedirs(output_path, exist_ok=True)
+
+    def resume(self, date):
+        """Continue an existing table of `date` instead of rejoining its shots."""
+        csv_name = table_name(self.output_path, date)
+        if not os.path.exists(csv_name):
+            return
+        with open(csv_name, newline='') as f:
+            n = sum(1 for row in csv.reader(f)) - 1
+        for file_name in flow_files(self.flow_path, date):
+            with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+                groups = [key for key in f if key.startswith("FlowMeter_")]
+                rows = min(f[key]['timestamp'].shape[0] for key in groups) if groups else 0
+            self.rows_done[file_name] = min(n, rows)
+            n -= self.rows_done[file_name]
+
+    def poll(self):
+        """Join the new shots that are old enough. Returns the number of shots written."""
+        written = 0
+        cutoff = time.time() - self.tolerance
+        for date in sorted({datetime.date.fromtimestamp(cutoff), datetime.date.fromtimestamp(cutoff - 86400)}):
+            for file_name in flow_files(self.flow_path, date):
+                start = self.rows_done.get(file_name, 0)
+                try:
+                    timestamps, shot_ids, summaries = read_flow(file_name, start)
+                except OSError as e:
+                    print(f"Could not read {file_name}: {str(e)}")
+                    continue
+                # Rows are appended in time order; stop at the first shot that is too recent
+                n = int(np.searchsorted(timestamps, cutoff, side='right'))
+                if n == 0:
+                    continue
+                timestamps, shot_ids = timestamps[:n], shot_ids[:n]
+                summaries = {name: s[:n] for name, s in summaries.items()}
+                pressure = read_pressure(self.pressure_path, timestamps[0] - self.tolerance,
+                                         timestamps[-1] + self.tolerance)
+                header, columns = join_shots(timestamps, shot_ids, summaries, pressure,
+                                             read_valve_log(self.valve_log), self.tolerance)
+                append_table(table_name(self.output_path, date), header, columns)
+                self.rows_done[file_name] = start + n
+                written += n
+        return written
+
+    def run(self, poll_interval=5.0):
+        """Poll until interrupted."""
+        self.resume(datetime.date.today())
+        try:
+            while True:
+                n = self.poll()
+                if n:
+                    print(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {n} shots joined")
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Join flow, valve settings and pressure into per-shot tables.")
+    parser.add_argument('--flow', default='/home/pi/flow_meter/data', help="directory of the flow data files")
+    parser.add_argument('--pressure', required=True, help="directory of the Pfeiffer pressure files")
+    parser.add_argument('--valve-log', default='/home/pi/flow_meter/data/valve_settings.csv',
+                        help="valve settings log written by GasPuffValve")
+    parser.add_argument('--out', required=True, help="directory of the output_<date>.csv tables")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="largest shot-to-pressure time difference in s")
+    parser.add_argument('--backfill', nargs=2, metavar=('FIRST', 'LAST'),
+                        help="rebuild the tables of the days FIRST..LAST (YYYY-MM-DD) and exit")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes for --backfill")
+    args = parser.parse_args()
+
+    if args.backfill:
+        first, last = (datetime.date.fromisoformat(d) for d in args.backfill)
+        dates = [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+        os.makedirs(args.out, exist_ok=True)
+        results = backfill(dates, args.flow, args.pressure, args.valve_log, args.out, args.tolerance, args.processes)
+        print(f"{sum(results.values())} shots in {sum(1 for n in results.values() if n)} days joined")
+        return
+
+    print(f"Joining shots from {args.flow} into {args.out}")
+    ShotJoiner(args.flow, args.pressure, args.valve_log, args.out, args.tolerance).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Trigger-rate stress benchmark of the flow acquisition pipeline.
+
+For every trigger rate, flowmeter_main.main() runs unchanged in a child process with a
+software TimerTrigger, against simulated flow meters (sfc5xxx_simulator.py, one pty per
+configured port) and a scratch HDF5 directory. The benchmark process follows the flow data
+file like any SWMR reader and records when each shot becomes visible.
+
+Per rate, the report holds:
+    shots        : triggers fired, shots written, dropped shots (fired but never written,
+                   including periods the trigger loop missed) and NaN readings per device
+    latency_ms   : end-to-end latency from the trigger edge to the shot being readable in
+                   the HDF5 file (mean, p50, p90, p99, max)
+    cpu_percent  : CPU time of the acquisition processes (main, workers, writer) per wall time
+    max_rss_mb   : largest resident memory of any acquisition process of this rate
+The report also records the git revision, so runs can be compared across releases.
+
+Usage:
+    python trigger_rate_benchmark.py --rates 0.5 1 2 5 --duration 60 --report trigger_rate_report.json
+"""
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import resource
+import datetime
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing as mp
+import numpy as np
+import h5py
+
+from trigger_source import TimerTrigger
+from sfc5xxx_simulator import Sfc5xxxSimulator
+
+
+class TimedTrigger(TimerTrigger):
+    """
+    TimerTrigger that stops the acquisition after `duration` seconds the same way as
+    Ctrl+C, so main() runs its normal shutdown (flush pending shots, close the writer).
+    """
+    def __init__(self, period, duration):
+        super().__init__(period)
+        self.t_end = time.time() + duration
+
+    def wait_for_trigger(self, timeout_ms=500):
+        if time.time() >= self.t_end:
+            raise KeyboardInterrupt
+        return super().wait_for_trigger(timeout_ms)
+
+
+def _run_acquisition(config_path, period, duration, log_path, stats_path):
+    """
+    Child process: run flowmeter_main.main() with its output in a log file, then write the
+    triggers fired and the peak memory of this run to stats_path (JSON).
+    """
+    sys.stdout = sys.stderr = open(log_path, 'w', buffering=1)
+    import flowmeter_main
+    trigger = TimedTrigger(period, duration)
+    try:
+        flowmeter_main.main(config_path, trigger_source=trigger)
+    finally:
+        # RUSAGE_CHILDREN of this process covers the workers and the writer of this run only
+        max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        with open(stats_path, 'w') as f:
+            json.dump({'fired': trigger.count, 'max_rss_mb': max_rss / 1024.0}, f)  # kB on Linux
+
+
+class ShotWatcher:
+    """Polls the flow data files of a directory and records when each shot appears."""
+    def __init__(self, hdf5_path, poll_interval=0.02):
+        self.hdf5_path = hdf5_path
+        self.poll_interval = poll_interval
+        self.seen = {}     # (file, row) -> time the row became readable
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._poll()
+
+    def _poll(self):
+        for file_name in glob.glob(os.path.join(self.hdf5_path, "flow_data_*.hdf5")):
+            try:
+                with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+                    groups = [key for key in f if key.startswith("FlowMeter_")]
+                    if not groups:
+                        continue
+                    n = min(f[key]['shot_id'].shape[0] for key in groups)
+            except (OSError, KeyError):
+                continue  # file is being created
+            now = time.time()
+            for row in range(n):
+                self.seen.setdefault((file_name, row), now)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._poll()
+            time.sleep(self.poll_interval)
+
+
+def read_shots(hdf5_path):
+    """All shots written: (shot_id, timestamp, {device: NaN row flags}, [(file, row)])."""
+    shot_ids, timestamps, nan_rows, keys = [], [], {}, []
+    for file_name in sorted(glob.glob(os.path.join(hdf5_path, "flow_data_*.hdf5"))):
+        with h5py.File(file_name, 'r') as f:
+            groups = [key for key in f if key.startswith("FlowMeter_")]
+            n = min(f[key]['shot_id'].shape[0] for key in groups)
+            shot_ids.append(f[groups[0]]['shot_id'][:n])
+            timestamps.append(f[groups[0]]['timestamp'][:n])
+            for key in groups:
+                nan_rows.setdefault(key[len("FlowMeter_"):], []).append(
+                    np.all(np.isnan(f[key]['flow_data'][:n]), axis=1))
+            keys.extend((file_name, row) for row in range(n))
+    if not shot_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0), {}, []
+    return (np.concatenate(shot_ids), np.concatenate(timestamps),
+            {name: np.concatenate(v) for name, v in nan_rows.items()}, keys)
+
+def _stats_ms(values):
+    if len(values) == 0:
+        return None
+    values = 1e3 * np.asarray(values)
+    return {'mean': float(np.mean(values)), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))}
+
+def run_rate(rate, duration, meters, scratch, sim_kwargs=None):
+    """
+    Run the pipeline at one trigger rate and return its result dict.
+
+    meters : list of (name, address, port index); meters with the same port index share
+        one simulated RS485 bus
+    """
+    hdf5_path = os.path.join(scratch, f"rate_{rate:g}")
+    os.makedirs(hdf5_path)
+    sims = {}
+    for name, address, port in meters:
+        sims.setdefault(port, []).append(address)
+    sims = {port: Sfc5xxxSimulator(addresses=addresses, **(sim_kwargs or {})).start()
+            for port, addresses in sims.items()}
+    config_path = os.path.join(hdf5_path, 'flowmeters.json')
+    with open(config_path, 'w') as f:
+        json.dump({'hdf5_path': hdf5_path,
+                   'flow_meters': [{'name': name, 'port': sims[port].path, 'address': address}
+                                   for name, address, port in meters]}, f, indent=4)
+
+    watcher = ShotWatcher(hdf5_path)
+    watcher.start()
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t_start = time.time()
+    stats_path = os.path.join(hdf5_path, 'run_stats.json')
+    p = mp.Process(target=_run_acquisition,
+                   args=(config_path, 1.0 / rate, duration, os.path.join(hdf5_path, 'acquisition.log'), stats_path))
+    p.start()
+    p.join()
+    wall = time.time() - t_start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    watcher.stop()
+    for sim in sims.values():
+        sim.stop()
+
+    shot_ids, timestamps, nan_rows, keys = read_shots(hdf5_path)
+    latencies = np.array([watcher.seen[k] for k in keys]) - timestamps if keys else np.empty(0)
+    try:
+        with open(stats_path) as f:
+            run_stats = json.load(f)
+    except (OSError, ValueError):
+        run_stats = {'fired': None, 'max_rss_mb': None}  # the acquisition process crashed
+    # Triggers counted by the trigger source, including periods the trigger loop missed
+    fired = run_stats['fired'] if run_stats['fired'] is not None else int(duration * rate)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    result = {
+        'rate_hz': rate,
+        'duration': duration,
+        'exit_code': p.exitcode,
+        'shots': {
+            'fired': fired,
+            'written': int(len(np.unique(shot_ids))),
+            'dropped': fired - int(len(np.unique(shot_ids))),
+            'nan': {name: int(rows.sum()) for name, rows in nan_rows.items()},
+        },
+        'latency_ms': _stats_ms(latencies),
+        'cpu_percent': 100.0 * cpu / wall,
+        'max_rss_mb': run_stats['max_rss_mb'],
+        'simulator': {port: sim.stats for port, sim in sims.items()},
+    }
+    p.close()
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the flow acquisition pipeline at several trigger rates.")
+    parser.add_argument('--rates', type=float, nargs='+', default=[0.5, 1, 2, 5], help="trigger rates in Hz")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds per rate")
+    parser.add_argument('--shared-bus', action='store_true',
+                        help="simulate both flow meters on one RS485 bus instead of one port each")
+    parser.add_argument('--crc-error-rate', type=float, default=0.0, help="simulated CRC error rate")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="simulated timeout rate")
+    parser.add_argument('--scratch', help="scratch directory (default: a temporary directory, removed afterwards)")
+    parser.add_argument('--report', help="JSON report file (default: trigger_rate_report_<time>.json)")
+    args = parser.parse_args()
+
+    meters = [('East', 2, 0), ('West', 0, 0 if args.shared_bus else 1)]
+    scratch = args.scratch or tempfile.mkdtemp(prefix='flow_benchmark_')
+    os.makedirs(scratch, exist_ok=True)
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'revision': git_revision(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'meters': [{'name': name, 'address': address, 'port': port} for name, address, port in meters],
+        'results': [],
+    }
+    try:
+        for rate in args.rates:
+            print(f"Running at {rate:g} Hz for {args.duration:g} s")
+            result = run_rate(rate, args.duration, meters, scratch,
+                              {'crc_error_rate': args.crc_error_rate, 'timeout_rate': args.timeout_rate})
+            report['results'].append(result)
+            latency = result['latency_ms']
+            latency = f"latency p50 {latency['p50']:.0f} ms p99 {latency['p99']:.0f} ms" if latency else "no latency data"
+            print(f"  {result['shots']['written']}/{result['shots']['fired']} shots written, "
+                  f"NaN {result['shots']['nan']}, {latency}, "
+                  f"CPU {result['cpu_percent']:.0f}%, max RSS {result['max_rss_mb'] or 0:.0f} MB")
+    finally:
+        if args.scratch is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    report_path = args.report or f"trigger_rate_report_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {report_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Shot trigger sources.
+
+Every source has the same interface as GPIOHandler: wait_for_trigger(timeout_ms) returns a
+Trigger (count, timestamp, missed) on a trigger edge, or None on timeout, and cleanup()
+releases the resources. The timestamp is taken in the trigger layer (at interrupt time if
+the GPIO library supports it), so every flow meter process works with the same shot time.
+The count is a monotonic shot counter; missed is the number of edges skipped since the
+previous trigger.
+"""
+import os
+import time
+import ctypes
+import socket
+from collections import namedtuple
+
+Trigger = namedtuple('Trigger', ['count', 'timestamp', 'missed'])
+
+
+class GPIOHandler:
+    """
+    Handles GPIO operations using the gpio_detect.so C library
+
+    If the library exports wait_for_gpio_edge(pin, timeout_us, *tick, *count), the pigpio
+    tick and edge counter latched by the interrupt handler are used for the timestamp and
+    shot count. Otherwise the timestamp is taken as soon as wait_for_gpio_high returns and
+    the edges are counted here.
+    """
+    def __init__(self, trigger_pin):
+        self.trigger_pin = trigger_pin
+        self.count = 0
+
+        # Load the GPIO C library
+        gpio_lib_path = "/home/generalpi/pi_gpio/gpio_detect.so"
+        if not os.path.exists(gpio_lib_path):
+            raise FileNotFoundError(f"GPIO library not found at {gpio_lib_path}")
+
+        try:
+            self.gpio_lib = ctypes.CDLL(gpio_lib_path)
+        except OSError as e:
+            raise RuntimeError(f"Failed to load GPIO library: {str(e)}")
+
+        self._setup_gpio_functions()
+
+        # Initialize GPIO
+        if self.gpio_lib.initialize_pigpio() < 0:
+            raise RuntimeError("Failed to initialize pigpio")
+
+        # Setup trigger pin for input
+        if self.gpio_lib.setup_gpio_pin(self.trigger_pin) < 0:
+            raise RuntimeError(f"Failed to setup input pin {self.trigger_pin}")
+
+    def _setup_gpio_functions(self):
+        """Setup C function signatures"""
+        # Initialize and cleanup
+        self.gpio_lib.initialize_pigpio.restype = ctypes.c_int
+        self.gpio_lib.terminate_pigpio.restype = None
+
+        # Pin setup
+        self.gpio_lib.setup_gpio_pin.argtypes = [ctypes.c_int]
+        self.gpio_lib.setup_gpio_pin.restype = ctypes.c_int
+
+        # GPIO operations
+        self.gpio_lib.wait_for_gpio_high.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.gpio_lib.wait_for_gpio_high.restype = ctypes.c_bool
+
+        # Edge timestamps latched at interrupt time (optional)
+        try:
+            self.gpio_lib.wait_for_gpio_edge.argtypes = [ctypes.c_int, ctypes.c_int,
+                                                         ctypes.POINTER(ctypes.c_uint32),
+                                                         ctypes.POINTER(ctypes.c_uint32)]
+            self.gpio_lib.wait_for_gpio_edge.restype = ctypes.c_bool
+            self.gpio_lib.gpioTick.restype = ctypes.c_uint32
+            self.has_edge_ticks = True
+        except AttributeError:
+            self.has_edge_ticks = False
+        print("GPIO trigger timestamps:", "interrupt tick" if self.has_edge_ticks else "host time on return")
+
+    def wait_for_trigger(self, timeout_ms=500):
+        """
+        Wait for rising edge on trigger pin
+        timeout_ms: timeout in milliseconds
+        Returns a Trigger, or None on timeout.
+        """
+        if not self.has_edge_ticks:
+            if not self.gpio_lib.wait_for_gpio_high(self.trigger_pin, timeout_ms * 1000):  # Convert to microseconds
+                return None
+            self.count += 1
+            return Trigger(self.count, time.time(), 0)
+
+        tick = ctypes.c_uint32()
+        count = ctypes.c_uint32()
+        if not self.gpio_lib.wait_for_gpio_edge(self.trigger_pin, timeout_ms * 1000,
+                                                ctypes.byref(tick), ctypes.byref(count)):
+            return None
+        # Age of the edge in microseconds; pigpio ticks wrap every 2**32 us
+        age_us = (self.gpio_lib.gpioTick() - tick.value) & 0xFFFFFFFF
+        timestamp = time.time() - age_us * 1e-6
+        missed = max(0, count.value - self.count - 1) if self.count else 0
+        self.count = count.value
+        return Trigger(self.count, timestamp, missed)
+
+    def cleanup(self):
+        """Cleanup GPIO resources"""
+        self.gpio_lib.terminate_pigpio()
+
+
+class TimerTrigger:
+    """
+    Software trigger firing at a fixed period, as a stand-in for the GPIO trigger on
+    machines without a Pi.
+    """
+    def __init__(self, period=1.0):
+        self.period = period
+        self.count = 0
+        self.next_time = time.time() + period
+
+    def wait_for_trigger(self, timeout_ms=500):
+        """Sleep until the next period boundary, or return None after timeout_ms."""
+        now = time.time()
+        if self.next_time - now > timeout_ms * 1e-3:
+            time.sleep(timeout_ms * 1e-3)
+            return None
+        time.sleep(max(0.0, self.next_time - now))
+        # Periods that already passed (e.g. while the caller was busy) count as missed edges
+        missed = max(0, int((time.time() - self.next_time) / self.period))
+        timestamp = self.next_time + missed * self.period
+        self.count += 1 + missed
+        self.next_time = timestamp + self.period
+        return Trigger(self.count, timestamp, missed)
+
+    def cleanup(self):
+        pass
+
+
+class SocketTrigger:
+    """
+    Software trigger driven by UDP datagrams, as a stand-in for the GPIO trigger.
+    Each datagram is one trigger. The payload may hold a shot count and an epoch
+    timestamp ("<count> <timestamp>"); otherwise the receive time and a local counter are used.
+
+    Example sender:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(b'', ('127.0.0.1', 5555))
+    """
+    def __init__(self, port=5555, host='127.0.0.1'):
+        self.count = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+
+    def wait_for_trigger(self, timeout_ms=500):
+        """Wait for a datagram; returns a Trigger, or None on timeout."""
+        self.sock.settimeout(timeout_ms * 1e-3)
+        try:
+            payload, _ = self.sock.recvfrom(256)
+        except socket.timeout:
+            return None
+        timestamp = time.time()
+
+        count = self.count + 1
+        fields = payload.split()
+        try:
+            if len(fields) >= 1:
+                count = int(fields[0])
+            if len(fields) >= 2:
+                timestamp = float(fields[1])
+        except ValueError:
+            print(f"Ignoring malformed trigger payload: {payload!r}")
+        missed = max(0, count - self.count - 1) if self.count else 0
+        self.count = count
+        return Trigger(count, timestamp, missed)
+
+    def cleanup(self):
+        self.sock.close()
@@ -0,0 +1,217 @@
+"""
+Between-shot parameter scans of the gas-puff valve.
+
+A scan is a list of valve settings (high level, low level, puff time, as in
+GasPuffValve.apply), given explicitly or as a grid. The first setting is applied before
+the scan starts; after each trigger the scan records the shot and, once a setting has
+been used for `repeat` shots, applies the next one with GasPuffValve.apply, which sends
+only the settings that change, in one round trip. Triggers come from any trigger source
+(trigger_source.py): the GPIO trigger on the Pi, or a TimerTrigger or SocketTrigger.
+
+Every shot is written to the scan log (CSV) with the setting that was active:
+    shot_id, timestamp, step, high, low, puff_time, apply_ms, settled
+apply_ms is the time taken to apply the setting (on the first shot of each step) and
+settled is 0 if that change completed after the trigger, i.e. the shot may have used part
+of the old setting. Shots the trigger source reports as missed are logged with the current
+setting and no timestamp.
+The latency budget is a fraction of the shot period (measured from the trigger
+timestamps, or given); a warning is printed whenever a change does not fit in it.
+Levels are wavegen levels in volts (the valve voltage divided by the amplifier gain,
+see main.py). With --arduino, the scan drives the Arduino firmware instead
+(arduino_client.ArduinoValve, levels in volts at its DAC output), which is told every
+trigger so it sends each change inside the firmware's window between shots.
+
+Usage:
+    python valve_scan.py 192.168.7.61 --high 3 4 5 --low 0 --puff-time 5 10 --repeat 3
+    python valve_scan.py 127.0.0.1 --high 3 4 --trigger timer --period 1
+    python valve_scan.py 192.168.7.70 --arduino --high 1 2 --puff-time 5 --trigger socket
+    python valve_scan.py 192.168.7.70 --arduino --arduino-current 2 0 10 --puff-time 5 10
+"""
+import os
+import csv
+import time
+import datetime
+import argparse
+import itertools
+import numpy as np
+
+from kernel import GasPuffValve, check_settings
+from arduino_client import ArduinoValve
+from trigger_source import GPIOHandler, TimerTrigger, SocketTrigger
+
+LOG_FIELDS = ['shot_id', 'timestamp', 'step', 'high', 'low', 'puff_time', 'apply_ms', 'settled']
+
+
+def grid(high=None, low=None, puff_time=None):
+    """
+    All combinations of the given values, the last parameter varying fastest. Parameters
+    that are None are left out of the settings (they keep their current value).
+    """
+    axes = [(name, values) for name, values in (('high', high), ('low', low), ('puff_time', puff_time))
+            if values is not None]
+    return [dict(zip([name for name, _ in axes], combo)) for combo in itertools.product(*[v for _, v in axes])]
+
+def load_settings(file_name):
+    """Settings from a CSV file with a header of high, low and/or puff_time columns."""
+    with open(file_name, newline='') as f:
+        return [{key: float(value) for key, value in row.items() if value not in (None, '')}
+                for row in csv.DictReader(f)]
+
+
+class ValveScan:
+    """
+    Steps a GasPuffValve through a list of settings, one step per `repeat` shots.
+    """
+    def __init__(self, valve, settings, trigger_source, repeat=1, log_path=None, period=None,
+                 budget_fraction=0.5):
+        """
+        Parameters
+        ----------
+        valve : kernel.GasPuffValve or arduino_client.ArduinoValve
+        settings : list of dict
+            Keyword arguments of GasPuffValve.apply, one dict per step.
+        trigger_source : object with wait_for_trigger(timeout_ms) and cleanup()
+        repeat : int
+            Shots per setting.
+        log_path : str
+            Scan log (CSV); default valve_scan_<time>.csv.
+        period : float
+            Shot period in seconds; default: measured from the trigger timestamps.
+        budget_fraction : float
+            Fraction of the shot period a setting change may take.
+        """
+        self.valve = valve
+        self.settings = list(settings)
+        self.trigger_source = trigger_source
+        self.repeat = repeat
+        self.log_path = log_path or f"valve_scan_{datetime.datetime.now():%Y%m%d_%H%M%S}.csv"
+        self.period = period
+        self.budget_fraction = budget_fraction
+        self.intervals = []
+        self.apply_times = []
+
+        # Validate every step up front, starting from the valve's current settings, so a bad
+        # setting does not stop the scan halfway
+        state = dict(valve.settings())
+        for i, setting in enumerate(self.settings):
+            state.update(setting)
+            try:
+                if None in state.values():
+                    raise ValueError("current value unknown (ArduinoValve), give it in the first step")
+                check_settings(state['high'], state['low'], state['puff_time'], valve.MAX_LEVEL)
+            except ValueError as e:
+                raise ValueError(f"Invalid setting at step {i}: {state}: {str(e)}") from None
+        self.active = None   # settings in effect, {'high', 'low', 'puff_time'}
+
+    @property
+    def budget(self):
+        """Latency budget in seconds, or None while the shot period is unknown."""
+        period = self.period if self.period is not None else (
+            float(np.median(self.intervals)) if self.intervals else None)
+        return None if period is None else self.budget_fraction * period
+
+    def _apply(self, step):
+        t_apply = self.valve.apply(**self.settings[step])
+        self.active = dict(self.valve.settings())
+        self.apply_times.append(t_apply)
+        budget = self.budget
+        if budget is not None and t_apply > budget:
+            print(f"Warning: step {step + 1} took {t_apply * 1e3:.1f} ms to apply, "
+                  f"over the budget of {budget * 1e3:.0f} ms ({self.budget_fraction:.0%} of the shot period)")
+        return t_apply, time.time()
+
+    def run(self):
+        """Run the scan until every step has had its shots. Returns the scan log path."""
+        step, shots = 0, 0
+        t_apply, applied_at = self._apply(step)
+        last_timestamp = None
+        print(f"Scan of {len(self.settings)} settings x {self.repeat} shots, log {self.log_path}")
+        new = not os.path.exists(self.log_path)
+        with open(self.log_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(LOG_FIELDS)
+            try:
+                while step < len(self.settings):
+                    trigger = self.trigger_source.wait_for_trigger(timeout_ms=500)
+                    if not trigger:
+                        continue
+                    if last_timestamp is not None:
+                        self.intervals.append((trigger.timestamp - last_timestamp) / (1 + trigger.missed))
+                    last_timestamp = trigger.timestamp
+                    if hasattr(self.valve, 'on_trigger'):
+                        self.valve.on_trigger(trigger.timestamp)
+
+                    # Missed edges were shots with the current setting too; their time is unknown
+                    state = (self.active['high'], self.active['low'], self.active['puff_time'])
+                    for shot_id in range(trigger.count - trigger.missed, trigger.count + 1):
+                        settled = int(applied_at <= trigger.timestamp or shots > 0)
+                        timestamp = f"{trigger.timestamp:.6f}" if shot_id == trigger.count else ''
+                        writer.writerow([shot_id, timestamp, step, *state,
+                                         f"{t_apply * 1e3:.2f}" if shots == 0 else '', settled])
+                        shots += 1
+                    f.flush()
+                    print(f"shot {trigger.count}: step {step + 1}/{len(self.settings)} "
+                          f"({shots}/{self.repeat}) {dict(zip(('high', 'low', 'puff_time'), state))}")
+
+                    if shots >= self.repeat:
+                        step, shots = step + 1, 0
+                        if step < len(self.settings):
+                            t_apply, applied_at = self._apply(step)
+            except KeyboardInterrupt:
+                print("Scan interrupted")
+        if self.apply_times:
+            print(f"Apply latency: median {np.median(self.apply_times) * 1e3:.1f} ms, "
+                  f"max {np.max(self.apply_times) * 1e3:.1f} ms; budget "
+                  + (f"{self.budget * 1e3:.0f} ms" if self.budget is not None else "unknown"))
+        return self.log_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan gas-puff valve settings between shots.")
+    parser.add_argument('ip_address', help="IP address of the waveform generator (or of the Arduino)")
+    parser.add_argument('--arduino', action='store_true', help="drive the Arduino firmware instead of the wavegen")
+    parser.add_argument('--arduino-current', type=float, nargs=3, metavar=('HIGH', 'LOW', 'PUFF_TIME'),
+                        help="settings the Arduino holds now (it cannot be queried); "
+                             "without them the first step must set high, low and puff time")
+    parser.add_argument('--high', type=float, nargs='+', help="high levels (wavegen V)")
+    parser.add_argument('--low', type=float, nargs='+', help="low levels (wavegen V)")
+    parser.add_argument('--puff-time', type=float, nargs='+', help="puff times (ms)")
+    parser.add_argument('--settings', help="CSV file of settings (columns high, low, puff_time) instead of a grid")
+    parser.add_argument('--repeat', type=int, default=1, help="shots per setting")
+    parser.add_argument('--trigger', choices=['gpio', 'timer', 'socket'], default='gpio')
+    parser.add_argument('--trigger-pin', type=int, default=25, help="GPIO pin of the shot trigger")
+    parser.add_argument('--period', type=float, help="shot period in s (timer trigger; default: measured)")
+    parser.add_argument('--budget', type=float, default=0.5, help="fraction of the shot period a change may take")
+    parser.add_argument('--log', help="scan log file (default: valve_scan_<time>.csv)")
+    parser.add_argument('--settings-log', help="valve settings log (see kernel.GasPuffValve)")
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings) if args.settings else grid(args.high, args.low, args.puff_time)
+    if not settings or not settings[0]:
+        parser.error("No settings to scan; give --high/--low/--puff-time or --settings")
+
+    if args.trigger == 'gpio':
+        trigger_source = GPIOHandler(args.trigger_pin)
+    elif args.trigger == 'timer':
+        trigger_source = TimerTrigger(args.period or 1.0)
+    else:
+        trigger_source = SocketTrigger()
+
+    valve = None
+    try:
+        if args.arduino:
+            high, low, puff_time = args.arduino_current or (None, None, None)
+            valve = ArduinoValve(args.ip_address, settings_log=args.settings_log,
+                                 high=high, low=low, puff_time=puff_time)
+        else:
+            valve = GasPuffValve(ip_address=args.ip_address, settings_log=args.settings_log)
+        ValveScan(valve, settings, trigger_source, args.repeat, args.log, args.period, args.budget).run()
+    finally:
+        if valve is not None:
+            valve.close()
+        trigger_source.cleanup()
+
+
+if __name__ == '__main__':
+    main()
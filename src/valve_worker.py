@@ -0,0 +1,162 @@
+"""
+Background command worker for the gas-puff valve control panel (main.py).
+
+The panel never talks to the wavegen itself: it submits commands (connect, program,
+output, high, low, puff_time) and the worker thread runs them on a GasPuffValve. Commands
+waiting in the queue are coalesced: a parameter submitted again before it ran only keeps
+the latest value, and the pending high, low and puff time changes run together as one
+GasPuffValve.apply(). When idle, the worker reloads the instrument state every
+poll_interval seconds with one batched query, so changes made on the front panel show up.
+
+Every command and state refresh yields a Result on the `results` queue, which the Tk
+main loop reads with window.after() (Tk widgets must only be touched from its thread):
+    command   : command name ('settings' for apply(), 'refresh' for the state poll)
+    value     : value(s) sent
+    latency   : time the command took on the instrument, in seconds
+    coalesced : number of submissions merged into this command
+    error     : error message, or None
+    state     : instrument state after the command (see ValveWorker.STATE_KEYS)
+"""
+import time
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+
+from kernel import GasPuffValve
+from wavegen_control import WavegenConnectionError
+
+Result = namedtuple('Result', ['command', 'value', 'latency', 'coalesced', 'error', 'state'])
+
+
+class ValveWorker:
+    """Runs valve commands in a background thread, coalescing the pending ones."""
+    COMMANDS = ('connect', 'program', 'output', 'high', 'low', 'puff_time')
+    SETTINGS = ('high', 'low', 'puff_time')
+    # Shadow state entries reported in Result.state
+    STATE_KEYS = ('OUTP', 'FUNC', 'FREQ', 'VOLT:HIGH', 'VOLT:LOW', 'BURS:STAT')
+
+    def __init__(self, settings_log=None, poll_interval=2.0, timeout=2.0, retries=3):
+        """
+        Parameters
+        ----------
+        settings_log : str
+            Valve settings log (see kernel.GasPuffValve).
+        poll_interval : float
+            Seconds between state refreshes while idle; None disables them.
+        timeout, retries : float, int
+            Wavegen response timeout and connection attempts; a failed connection is
+            reported as an error instead of waiting for console input.
+        """
+        self.settings_log = settings_log
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.valve = None
+        self.results = queue.Queue()
+        self._pending = OrderedDict()   # command -> [value, number of submissions]
+        self._cond = threading.Condition()
+        self._quit = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, command, value=None):
+        """
+        Queue a command; a pending command of the same name is replaced and moves to the end
+        of the queue, so the commands run in the order of their last submission.
+        """
+        if command not in self.COMMANDS:
+            raise ValueError(f"Unknown valve command: {command}")
+        with self._cond:
+            if command in self._pending:
+                self._pending[command][0] = value
+                self._pending[command][1] += 1
+                self._pending.move_to_end(command)
+            else:
+                self._pending[command] = [value, 1]
+            self._cond.notify()
+
+    def stop(self, timeout=5.0):
+        """Stop the worker after the running command and close the connection."""
+        with self._cond:
+            self._quit = True
+            self._pending.clear()
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _take(self):
+        # Wait for commands; returns the pending ones ([] on poll timeout, None on quit)
+        with self._cond:
+            if not self._pending and not self._quit:
+                self._cond.wait(self.poll_interval)
+            if self._quit:
+                return None
+            pending, self._pending = list(self._pending.items()), OrderedDict()
+        # Merge the settings changes into one apply(), at the place of the first of them
+        commands, settings, coalesced = [], {}, 0
+        for command, (value, count) in pending:
+            if command in self.SETTINGS:
+                if not settings:
+                    commands.append(('settings', settings, 0))
+                settings[command] = value
+                coalesced += count
+            else:
+                commands.append((command, value, count))
+        return [(c, v, coalesced if c == 'settings' else n) for c, v, n in commands]
+
+    def _state(self):
+        if self.valve is None:
+            return {}
+        return {key: self.valve.wavegen.state.get(key) for key in self.STATE_KEYS}
+
+    def _execute(self, command, value):
+        if command == 'connect':
+            if self.valve is not None:
+                self.valve.wavegen.close()
+                self.valve = None
+            valve = GasPuffValve(ip_address=value, settings_log=self.settings_log, timeout=self.timeout,
+                                 retries=self.retries, interactive=False)
+            # Load the state shown in the panel; this also checks the connection
+            if not valve.wavegen.sync():
+                valve.wavegen.close()
+                raise WavegenConnectionError(f"no valid response from the wavegen at {value}")
+            self.valve = valve
+            return
+        if self.valve is None:
+            raise WavegenConnectionError("not connected")
+        if command == 'program':
+            self.valve.program_waveform()
+            self.valve.wavegen.sync()  # waits for the upload and reloads what it changed
+        elif command == 'output':
+            self.valve.set_output(value)
+            self.valve.wavegen.opc()
+        elif command == 'settings':
+            self.valve.apply(**value)
+        elif command == 'refresh':
+            if not self.valve.wavegen.sync():
+                raise WavegenConnectionError("no valid response to the state query")
+
+    def _run(self):
+        while True:
+            commands = self._take()
+            if commands is None:
+                break
+            if not commands:
+                if self.valve is None or self.poll_interval is None:
+                    continue
+                commands = [('refresh', None, 0)]
+            for command, value, coalesced in commands:
+                t0 = time.perf_counter()
+                error = None
+                try:
+                    self._execute(command, value)
+                except (ValueError, OSError, WavegenConnectionError) as e:
+                    error = str(e)
+                except Exception as e:
+                    # Keep the worker alive whatever goes wrong; the panel shows the error
+                    error = f"{type(e).__name__}: {str(e)}"
+                self.results.put(Result(command, value, time.perf_counter() - t0, coalesced, error, self._state()))
+        if self.valve is not None:
+            self.valve.wavegen.close()
@@ -0,0 +1,415 @@
+"""
+Asyncio driver for the waveform generators of the gas-puff valves.
+
+AsyncWavegen implements the wavegen_control command set on one persistent asyncio stream
+per instrument: the same shadow state (getters answer from it, setters skip values the
+wavegen already has), the same batching into one semicolon-separated command line ending
+with *OPC?, and binary DAC uploads. Setters are coroutines (`await wg.set_frequency(f)`)
+and a batch is `async with wg.batch():`. Commands to one instrument are serialised by a
+lock; commands to different instruments run concurrently, so reconfiguring N valves takes
+as long as the slowest instrument instead of the sum of all of them.
+
+AsyncGasPuffValve is the asyncio counterpart of kernel.GasPuffValve (apply() with the same
+validation, ordering and settings log); apply_all() applies settings to several valves at
+once.
+
+Usage:
+    python wavegen_async.py 192.168.7.61 192.168.7.62 --high 4 --low 0 --puff-time 5
+"""
+import time
+import asyncio
+import numpy as np
+import argparse
+from contextlib import asynccontextmanager
+
+from wavegen_control import wavegen_control
+from kernel import GasPuffValve, check_settings, apply_steps, frequency_to_puff_time
+from input import generate_pulse_waveform
+
+
+class AsyncWavegen:
+    """One waveform generator on a persistent asyncio stream."""
+    STATE = wavegen_control.STATE
+    DEPENDS = wavegen_control.DEPENDS
+    DAC_MAX = wavegen_control.DAC_MAX
+
+    # Pure shadow state helpers, shared with the blocking driver
+    invalidate = wavegen_control.invalidate
+    _parse = wavegen_control._parse
+    dac_codes = wavegen_control.dac_codes
+
+    def __init__(self, server_ip_addr, port=wavegen_control.WAVEGEN_SERVER_PORT, timeout=5.0,
+                 local_ip=wavegen_control.LOCAL_IP, retries=3, verbose=True):
+        """
+        Parameters
+        ----------
+        server_ip_addr : str
+            IP address of the waveform generator.
+        port : int
+            SCPI socket port.
+        timeout : float
+            Seconds to wait for the connection and for a response.
+        local_ip : str
+            Local interface the connection is bound to; None lets the OS choose.
+        retries : int
+            Connection attempts before connect() raises ConnectionError.
+        """
+        self.server_ip_addr = server_ip_addr
+        self.port = port
+        self.timeout = timeout
+        self.local_ip = local_ip
+        self.retries = retries
+        self.verbose = verbose
+        self.reader = None
+        self.writer = None
+        self.state = {}     # shadow state: STATE header -> last value set or read
+        self._batch = None  # commands of the open batch
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """Open the connection and return the *IDN? response."""
+        await self._open()
+        idn = await self.send_text('*IDN?')
+        if self.verbose:
+            print('Wavegen found at', self.server_ip_addr + ':', idn)
+        return idn
+
+    async def _open(self):
+        for attempt in range(1, self.retries + 1):
+            try:
+                local_addr = (self.local_ip, 0) if self.local_ip is not None else None
+                try:
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.server_ip_addr, self.port, local_addr=local_addr),
+                        self.timeout)
+                except OSError:
+                    if local_addr is None:
+                        raise
+                    # e.g. on a laptop talking to wavegen_simulator.py
+                    print('Local interface', self.local_ip, 'not available, using the default one')
+                    self.local_ip = None
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.server_ip_addr, self.port), self.timeout)
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f'Connection to {self.server_ip_addr} failed ({e!r}), attempt {attempt}/{self.retries}')
+                if attempt < self.retries:
+                    await asyncio.sleep(1.0)
+        raise ConnectionError(f'Cannot connect to the wavegen at {self.server_ip_addr}:{self.port}')
+
+    async def close(self):
+        """Close the connection; the next command reopens it."""
+        writer, self.reader, self.writer = self.writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _send(self, command, payload=None):
+        # Send a command (with an optional binary block) and read the response of a query.
+        # As in wavegen_control._send_persistent: a broken connection is reopened and the
+        # command sent again once, and a query without answer drops the connection. A wavegen
+        # that cannot be reached at all raises ConnectionError.
+        async with self._lock:
+            for attempt in range(2):
+                if self.writer is None:
+                    await self._open()  # ConnectionError if the wavegen cannot be reached
+                try:
+                    if payload is None:
+                        self.writer.write((command + '\n').encode())
+                    else:
+                        length = str(len(payload))
+                        self.writer.write(command.encode() + b' #' + str(len(length)).encode() + length.encode()
+                                          + payload + b'\n')
+                    await asyncio.wait_for(self.writer.drain(), self.timeout)
+                    if payload is not None or command.find('?') < 0:
+                        return 'No response'
+                    line = await asyncio.wait_for(self.reader.readuntil(b'\n'), self.timeout)
+                    return line.decode().rstrip('\r\n')
+                except asyncio.TimeoutError:
+                    print('wavegen', self.server_ip_addr, 'did not answer', repr(command), 'within', self.timeout, 's')
+                    await self.close()
+                    return 'No response'
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    print('wavegen', self.server_ip_addr, 'connection lost (' + repr(e) + '), reconnecting')
+                    await self.close()
+            return 'No response'
+
+    async def send_text(self, command):
+        return await self._send(command)
+
+    async def send_block(self, command, payload):
+        """Send a command followed by an IEEE-488.2 definite-length block."""
+        return await self._send(command, payload)
+
+    async def opc(self):
+        """Wait until the wavegen has completed all commands sent so far (*OPC? returns 1)."""
+        return await self.send_text('*OPC?') == '1'
+
+    async def system_error(self):
+        return await self.send_text('SYST:ERR?')
+
+    # Shadow state and command batching, as in wavegen_control
+
+    async def _get(self, key):
+        if key not in self.state:
+            self.state[key] = self._parse(key, await self.send_text(key + '?'))
+        return self.state[key]
+
+    async def _set(self, key, value, command):
+        if key in self.state and self.state[key] == value:
+            return
+        self.invalidate(key)
+        self.state[key] = value
+        await self._write(command)
+
+    async def _write(self, command):
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            await self.send_text(command)
+
+    @asynccontextmanager
+    async def batch(self, wait=True):
+        """
+        Collect the commands sent inside the block and send them as one line on exit.
+        wait : end the line with *OPC? and wait for it. Nested batches join the outer one.
+        If the block raises, nothing is sent and the shadow state is invalidated.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+        except BaseException:
+            self._batch = None
+            self.invalidate()
+            raise
+        commands, self._batch = self._batch, None
+        await self.flush(commands, wait)
+
+    async def flush(self, commands, wait=True):
+        """
+        Send commands as one semicolon-joined line, optionally synchronised with *OPC?.
+        If *OPC? does not return 1, the shadow state is invalidated (see wavegen_control.flush).
+        """
+        if not commands:
+            return
+        if wait:
+            commands = commands + ['*OPC?']
+        line = commands[0] + ''.join((';' if c.startswith('*') else ';:') + c for c in commands[1:])
+        resp = await self.send_text(line)
+        if wait and resp != '1':
+            print('Batch not confirmed by the wavegen', self.server_ip_addr, '(' + resp + '); settings state reset')
+            self.invalidate()
+
+    async def sync(self):
+        """Reload the whole shadow state with one batched query."""
+        keys = list(self.STATE)
+        resp = await self.send_text(';:'.join(key + '?' for key in keys))
+        values = resp.split(';')
+        if len(values) != len(keys):
+            print('Unexpected response to the state query:', resp)
+            self.invalidate()
+            return self.state
+        self.state = {key: self._parse(key, v) for key, v in zip(keys, values)}
+        return self.state
+
+    # Settings
+
+    async def output(self):
+        return await self._get('OUTP')
+
+    async def set_output(self, out):
+        if out == 1:
+            await self._set('OUTP', 1, 'OUTP ON')
+        elif out == 0:
+            await self._set('OUTP', 0, 'OUTP OFF')
+        else:
+            print('Unknown input parameter')
+
+    async def voltage_level(self):
+        if 'VOLT:HIGH' not in self.state or 'VOLT:LOW' not in self.state:
+            high, low = (await self.send_text('VOLT:HIGH?;:VOLT:LOW?')).split(';')
+            self.state['VOLT:HIGH'], self.state['VOLT:LOW'] = float(high), float(low)
+        return self.state['VOLT:HIGH'], self.state['VOLT:LOW']
+
+    async def set_high_level(self, level):
+        await self._set('VOLT:HIGH', float(level), 'VOLT:HIGH ' + str(level))
+
+    async def set_low_level(self, level):
+        await self._set('VOLT:LOW', float(level), 'VOLT:LOW ' + str(level))
+
+    async def voltage_range(self, stat):
+        await self._write('VOLT:RANG:AUTO ' + stat)
+
+    async def frequency(self):
+        return await self._get('FREQ')
+
+    async def set_frequency(self, freq):
+        await self._set('FREQ', float(freq), 'FREQ ' + str(freq))
+
+    async def function(self):
+        return await self._get('FUNC')
+
+    async def set_function(self, func):
+        if func == 'USER':
+            await self._write('FUNC:USER VOLATILE')
+            self.invalidate('FUNC')
+        await self._set('FUNC', func, 'FUNC ' + func)
+
+    async def burst(self, enable, ncycles, phase, mode='TRIG', source='EXT', period=None):
+        async with self.batch():
+            if enable:
+                await self._set('BURS:MODE', mode, 'BURS:MODE ' + mode)
+                await self._set('BURS:NCYC', float(ncycles), 'BURS:NCYC ' + str(ncycles))
+                if period is not None:
+                    await self._set('BURS:INT:PER', float(period), 'BURS:INT:PER ' + str(period))
+                await self._set('BURS:PHAS', float(phase), 'BURS:PHAS ' + str(phase))
+                await self._set('TRIG:SOUR', source, 'TRIG:SOUR ' + source)
+                await self._set('BURS:STAT', 1, 'BURS:STAT ON')
+            else:
+                await self._set('BURS:STAT', 0, 'BURS:STAT OFF')
+
+    async def send_dac_data(self, data):
+        """
+        Upload an arbitrary waveform (values from -1 to +1) to volatile memory as a binary
+        DAC block and select it. Returns the upload time in seconds.
+        """
+        t0 = time.perf_counter()
+        await self.send_text('DATA:VOL:CLE;*CLS;:FORM:BORD NORM')
+        await self.send_block('DATA:DAC VOLATILE,', self.dac_codes(data).tobytes())
+        err = await self.system_error()
+        if not err.startswith(('+0', '0')):
+            print('Binary waveform upload to', self.server_ip_addr, 'failed (' + err + '), sending ASCII')
+            await self.send_text('DATA VOLATILE, ' + ','.join(map(str, data)))
+        await self.send_text('FUNC:USER VOLATILE;:FUNC:SHAP USER')
+        self.invalidate('FUNC')
+        await self.opc()
+        upload_time = time.perf_counter() - t0
+        if self.verbose:
+            print('Waveform upload to {}: {} points in {:.1f} ms'.format(self.server_ip_addr, len(data), upload_time * 1e3))
+        return upload_time
+
+
+class AsyncGasPuffValve:
+    """Asyncio counterpart of kernel.GasPuffValve."""
+    MAX_LEVEL = GasPuffValve.MAX_LEVEL
+    _log_settings = GasPuffValve._log_settings
+
+    def __init__(self, ip_address, settings_log=None, **wavegen_kwargs):
+        """
+        ip_address : IP address of the waveform generator.
+        settings_log : optional CSV file of the settings changes (see kernel.GasPuffValve).
+        wavegen_kwargs : passed to AsyncWavegen (port, timeout, ...).
+        """
+        if ip_address is None:
+            raise ValueError('IP address must be provided.')
+        self.wavegen = AsyncWavegen(ip_address, **wavegen_kwargs)
+        self._puff_time = None    # last settings applied, for the settings log
+        self._high_voltage = None
+        self._low_voltage = None
+        self.settings_log = settings_log
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        return await self.wavegen.connect()
+
+    async def close(self):
+        await self.wavegen.close()
+
+    async def program_waveform(self, data=None):
+        """Upload the puff waveform (default generate_pulse_waveform()) and set up burst mode."""
+        await self.wavegen.set_output(0)
+        if data is None:
+            data = generate_pulse_waveform()
+        await self.wavegen.send_dac_data(data)
+        async with self.wavegen.batch():
+            await self.wavegen.burst(True, 1, 0)
+            await self.wavegen.voltage_range('ON')
+
+    async def set_output(self, i):
+        await self.wavegen.set_output(i)
+
+    async def settings(self):
+        """Current settings of the wavegen as {'high', 'low', 'puff_time'} (see GasPuffValve.settings)."""
+        high, low = await self.wavegen.voltage_level()
+        return {'high': high, 'low': low, 'puff_time': frequency_to_puff_time(await self.wavegen.frequency())}
+
+    async def apply(self, high=None, low=None, puff_time=None):
+        """
+        Change several settings in one transaction, as kernel.GasPuffValve.apply(); settings
+        not given stay as they are on the wavegen. Returns the time taken in seconds.
+        """
+        t0 = time.perf_counter()
+        current = await self.settings()
+        high = current['high'] if high is None else float(high)
+        low = current['low'] if low is None else float(low)
+        puff_time = current['puff_time'] if puff_time is None else float(puff_time)
+        check_settings(high, low, puff_time, self.MAX_LEVEL)
+
+        wg = self.wavegen
+        output = await wg.output() if (high, low) != (current['high'], current['low']) else 0
+        setters = {'output': wg.set_output, 'high': wg.set_high_level, 'low': wg.set_low_level,
+                   'frequency': wg.set_frequency}
+        async with wg.batch():
+            for name, value in apply_steps(high, low, puff_time, current['high'], output):
+                await setters[name](value)
+
+        changed = not np.allclose((high, low, puff_time), (current['high'], current['low'], current['puff_time']))
+        self._high_voltage, self._low_voltage, self._puff_time = high, low, puff_time
+        if changed:
+            self._log_settings()
+        return time.perf_counter() - t0
+
+
+async def apply_all(valves, settings):
+    """
+    Apply settings[i] (keyword arguments of apply()) to valves[i], all valves at once.
+    Returns the time taken per valve, or the exception it raised.
+    """
+    return await asyncio.gather(*(valve.apply(**s) for valve, s in zip(valves, settings)),
+                                return_exceptions=True)
+
+
+async def _main(args):
+    valves = [AsyncGasPuffValve(ip, port=args.port) for ip in args.ip_addresses]
+    await asyncio.gather(*(valve.connect() for valve in valves))
+    try:
+        setting = {key: value for key, value in
+                   (('high', args.high), ('low', args.low), ('puff_time', args.puff_time)) if value is not None}
+        t0 = time.perf_counter()
+        results = await apply_all(valves, [setting] * len(valves))
+        total = time.perf_counter() - t0
+        for valve, result in zip(valves, results):
+            print(valve.wavegen.server_ip_addr + ':',
+                  result if isinstance(result, Exception) else f'{result * 1e3:.1f} ms')
+        print(f'All {len(valves)} valves in {total * 1e3:.1f} ms')
+    finally:
+        await asyncio.gather(*(valve.close() for valve in valves))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply one setting to several gas-puff valves concurrently.")
+    parser.add_argument('ip_addresses', nargs='+', help="IP addresses of the waveform generators")
+    parser.add_argument('--port', type=int, default=wavegen_control.WAVEGEN_SERVER_PORT)
+    parser.add_argument('--high', type=float, help="high level (wavegen V)")
+    parser.add_argument('--low', type=float, help="low level (wavegen V)")
+    parser.add_argument('--puff-time', type=float, help="puff time (ms)")
+    asyncio.run(_main(parser.parse_args()))
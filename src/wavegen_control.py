@@ -3,6 +3,24 @@
 Waveform generator Agilent and Keysight control using socket
 Commands are send and received as ASCII
 
+By default every command opens and closes its own socket and is followed by a 0.1 s pause.
+With persistent=True one socket is kept open: commands are sent back to back, responses are
+read up to the line terminator, ordering is ensured with *OPC? (see opc()) instead of sleeps,
+and the connection is reopened when it fails.
+
+Arbitrary waveforms are uploaded as DAC codes in an IEEE-488.2 definite-length binary block
+(DATA:DAC, int16 big-endian), or as a comma-separated ASCII list (DATA) as a fallback.
+WaveformManager keeps track of the waveforms held in volatile memory and in the named
+non-volatile slots, so a shape already in the wavegen is selected instead of uploaded.
+
+The settings (output, levels, frequency, function, pulse and burst parameters) are mirrored
+in a shadow state: getters answer from it and query the wavegen only for unknown values,
+setters skip values the wavegen already has, and settings that change with another one
+(e.g. amplitude and offset with the high level) are invalidated. Inside `with wavegen.batch():`
+the setters are joined into one semicolon-separated command line, sent in one round trip
+with *OPC? at the end. sync() reloads the whole state with one batched query, and
+invalidate() forgets values changed outside this driver (e.g. on the front panel).
+
 Remote control command see: http://ecelabs.njit.edu/student_resources/33220_user_guide.pdf
 Or Google search Agilent 33220A user guide
 """
@@ -12,21 +30,66 @@ import sys
 if sys.version_info[0] < 3: raise RuntimeError('This script should be run under Python 3')
 
 import socket
+import json
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 import time
 
 
+class WavegenConnectionError(Exception):
+	""" the wavegen could not be reached after all connection attempts (non-interactive mode) """
+
+
+class WavegenError(Exception):
+	""" the wavegen reported an error for a command (SYST:ERR?) """
+
 
 class wavegen_control:
 	MSIPA_CACHE_FN = 'wavegen_server_ip_address_cache.tmp'
 	WAVEGEN_SERVER_PORT = 5025
 	BUF_SIZE = 4096
+	LOCAL_IP = '192.168.7.38'   # local interface for comms; None to let the OS choose
+	DAC_MAX = 2047              # DATA:DAC range is -2047 ... +2047 for -1 ... +1
+
+	# Settings in the shadow state: query header -> type of the value
+	STATE = OrderedDict([
+		('OUTP', int), ('FUNC', str), ('FREQ', float), ('VOLT', float), ('VOLT:OFFS', float),
+		('VOLT:HIGH', float), ('VOLT:LOW', float), ('FUNC:PULS:WIDT', float), ('FUNC:PULS:PER', float),
+		('BURS:STAT', int), ('BURS:MODE', str), ('BURS:NCYC', float), ('BURS:PHAS', float),
+		('BURS:INT:PER', float), ('TRIG:SOUR', str),
+	])
+	# Settings the wavegen recalculates when another one is set
+	DEPENDS = {
+		'VOLT': ('VOLT:HIGH', 'VOLT:LOW'), 'VOLT:OFFS': ('VOLT:HIGH', 'VOLT:LOW'),
+		'VOLT:HIGH': ('VOLT', 'VOLT:OFFS'), 'VOLT:LOW': ('VOLT', 'VOLT:OFFS'),
+		'FREQ': ('FUNC:PULS:PER',), 'FUNC:PULS:PER': ('FREQ',),
+		'FUNC': ('FREQ', 'VOLT', 'VOLT:OFFS', 'VOLT:HIGH', 'VOLT:LOW', 'FUNC:PULS:WIDT', 'FUNC:PULS:PER'),
+	}
 
 	#- - - - - - - - - - - - - - - - -
 
-	def __init__(self, server_ip_addr = None, msipa_cache_fn = None, verbose = True):
-
+	def __init__(self, server_ip_addr = None, msipa_cache_fn = None, verbose = True,
+	             persistent = False, local_ip = LOCAL_IP, timeout = 5.0, retries = 30, interactive = True):
+		"""
+		persistent : keep one socket open for all commands (see module docstring)
+		local_ip : local interface the socket is bound to
+		timeout : seconds to wait for the connection and for a response
+		retries : connection attempts before giving up
+		interactive : after the last attempt, ask on the console whether to try again;
+			False raises WavegenConnectionError instead (e.g. in a GUI)
+		"""
 		self.verbose = verbose
+		self.persistent = persistent
+		self.local_ip = local_ip
+		self.timeout = timeout
+		self.retries = retries
+		self.interactive = interactive
+		self.session = None   # open socket in persistent mode
+		self._rx = b''        # received bytes not yet returned as a response
+		self.state = {}       # shadow state: STATE header -> last value set or read
+		self._batch = None    # commands of the open batch
 		if msipa_cache_fn == None:
 			self.msipa_cache_fn = self.MSIPA_CACHE_FN
 		else:
@@ -86,24 +149,45 @@ class wavegen_control:
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		""" no special processing after __init__() """
+		""" close the persistent connection """
+		self.close()
 
 	def __del__(self):
-		""" no special processing after __init__() """
+		""" close the persistent connection """
+		self.close()
+
+	def close(self):
+		""" close the persistent connection; the next command reopens it """
+		session = getattr(self, 'session', None)
+		self.session = None
+		self._rx = b''
+		if session is not None:
+			try:
+				session.close()
+			except OSError:
+				pass
 
 ########################################################################################################
 ########################################################################################################
 
 	def open_socket(self, port = 5025):
 		# Open a socket, retries 30 times if connection fails
-		RETRIES = 30
+		RETRIES = self.retries
 		retry_count = 0
 		while retry_count < RETRIES:
 			try:
 				session = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				# session.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+				session.settimeout(self.timeout)
+				if self.persistent:
+					session.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # commands are short; do not delay them
 				# session.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, 0)
-				session.bind(('192.168.7.38', 0))  # set local interface for comms
+				if self.local_ip is not None:
+					try:
+						session.bind((self.local_ip, 0))  # set local interface for comms
+					except OSError:
+						# e.g. on a laptop talking to wavegen_simulator.py
+						print('Local interface', self.local_ip, 'not available, using the default one')
+						self.local_ip = None
 				session.connect((self.server_ip_addr,port))
 				break
 			except ConnectionRefusedError:
@@ -123,6 +207,8 @@ class wavegen_control:
 				return session
 
 		if retry_count >= RETRIES:
+			if not self.interactive:
+				raise WavegenConnectionError('cannot connect to the wavegen at ' + str(self.server_ip_addr))
 			input(" pausing in wavegen_socket_control.py open_socket(), socket can't connect. hit Enter to try again, or ^C: ")
 			
 			return self.open_socket()  # tail-recurse if retry is requested
@@ -131,7 +217,10 @@ class wavegen_control:
 	
 	def send_text(self, command):
 		# Open a socket session, sends input command, get response, close socket session when done
-		
+		# (in persistent mode, send on the open socket instead)
+		if self.persistent:
+			return self._send_persistent(command)
+
 		s = self.open_socket()
 
 		message = command + '\n'
@@ -161,20 +250,196 @@ class wavegen_control:
 
 		return response
 
-	def send_dac_data(self, data):
+	def send_block(self, command, payload):
+		# Send a command followed by an IEEE-488.2 definite-length block: #<digits><length><payload>
+		if self.persistent:
+			return self._send_persistent(command, payload)
+
+		length = str(len(payload))
+		s = self.open_socket()
+		try:
+			s.sendall(command.encode() + b' #' + str(len(length)).encode() + length.encode() + payload + b'\n')
+		except TimeoutError:
+			print('socket opened but sending block time out.')
+		s.close()
+		time.sleep(0.1)
+		return 'No response'
+
+	def _send_persistent(self, command, payload=None):
+		# Send a command (with an optional binary block, see send_block) on the open socket
+		# and read the response of a query.
+		# A broken connection is reopened and the command sent again once; a query without
+		# answer (e.g. a bad command) drops the connection, so a late answer cannot be taken
+		# as the response of the next query.
+		for attempt in range(2):
+			try:
+				if self.session is None:
+					self.session = self.open_socket(self.WAVEGEN_SERVER_PORT)
+					self._rx = b''
+				if payload is None:
+					self.session.sendall((command + '\n').encode())
+				else:
+					length = str(len(payload))
+					self.session.sendall(command.encode() + b' #' + str(len(length)).encode() + length.encode()
+					                     + payload + b'\n')
+				if payload is not None or command.find('?') < 0:
+					return 'No response'
+				return self._readline()
+			except socket.timeout:
+				print('wavegen did not answer', repr(command), 'within', self.timeout, 's')
+				self.close()
+				return 'No response'
+			except OSError as e:
+				print('wavegen connection lost (' + str(e) + '), reconnecting')
+				self.close()
+		return 'No response'
+
+	def _readline(self):
+		# Read one response up to the line terminator; bytes after it stay buffered
+		while b'\n' not in self._rx:
+			chunk = self.session.recv(self.BUF_SIZE)
+			if not chunk:
+				raise ConnectionResetError('connection closed by the wavegen')
+			self._rx += chunk
+		line, _, self._rx = self._rx.partition(b'\n')
+		return line.decode().rstrip('\r')
+
+	def opc(self):
+		""" wait until the wavegen has completed all commands sent so far (*OPC? returns 1) """
+		return self.send_text('*OPC?') == '1'
+
+#-------------------------------------------------------
+	# Shadow state and command batching
+
+	def invalidate(self, *keys):
+		""" forget settings (and the ones depending on them); no argument forgets all """
+		if not keys:
+			self.state.clear()
+			return
+		for key in keys:
+			self.state.pop(key, None)
+			for dep in self.DEPENDS.get(key, ()):
+				self.state.pop(dep, None)
+
+	def _get(self, key):
+		# Value of a setting from the shadow state, queried if unknown
+		if key not in self.state:
+			self.state[key] = self._parse(key, self.send_text(key + '?'))
+		return self.state[key]
+
+	def _parse(self, key, resp):
+		# Response to a query as the type of the setting; raises ValueError on 'No response'
+		if self.STATE[key] is str:
+			return resp.strip().strip('"')
+		return self.STATE[key](float(resp))
+
+	def _set(self, key, value, command):
+		# Send a setting unless the wavegen has it already; batched inside batch()
+		if key in self.state and self.state[key] == value:
+			return
+		self.invalidate(key)
+		self.state[key] = value
+		self._write(command)
+
+	def _write(self, command):
+		if self._batch is not None:
+			self._batch.append(command)
+		else:
+			self.send_text(command)
+
+	@contextmanager
+	def batch(self, wait = True):
+		"""
+		Collect the commands sent inside the block and send them as one line on exit.
+		wait : end the line with *OPC? and wait for it. Nested batches join the outer one.
+		If the block raises, nothing is sent and the settings it changed are invalidated.
+		"""
+		if self._batch is not None:
+			yield self
+			return
+		self._batch = []
+		try:
+			yield self
+		except BaseException:
+			self._batch = None
+			self.invalidate()
+			raise
+		commands, self._batch = self._batch, None
+		self.flush(commands, wait)
+
+	def flush(self, commands, wait = True):
+		"""
+		send commands as one semicolon-joined line, optionally synchronised with *OPC?
+		If *OPC? does not return 1 (timeout, lost connection), the commands may not have been
+		applied: the shadow state is invalidated, so the next setters send their values again.
+		"""
+		if not commands:
+			return
+		if wait:
+			commands = commands + ['*OPC?']
+		# ';:' starts the next command from the root of the command tree
+		line = commands[0] + ''.join((';' if c.startswith('*') else ';:') + c for c in commands[1:])
+		resp = self.send_text(line)
+		if wait and resp != '1':
+			print('Batch not confirmed by the wavegen (' + resp + '); settings state reset')
+			self.invalidate()
+
+	def sync(self):
+		""" reload the whole shadow state with one batched query """
+		keys = list(self.STATE)
+		resp = self.send_text(';:'.join(key + '?' for key in keys))
+		values = resp.split(';')
+		if len(values) != len(keys):
+			print('Unexpected response to the state query:', resp)
+			self.invalidate()
+			return self.state
+		self.state = {key: self._parse(key, v) for key, v in zip(keys, values)}
+		return self.state
+
+	def dac_codes(self, data):
+		""" waveform values (-1 to +1) as DAC codes, int16 with the most significant byte first """
+		return np.round(np.clip(np.asarray(data, dtype=float), -1, 1) * self.DAC_MAX).astype('>i2')
+
+	def send_dac_data(self, data, binary = True):
+		"""
+		Upload an arbitrary waveform (values from -1 to +1) to volatile memory and select it.
+		binary : send DAC codes as a binary block; if the wavegen reports an error, the
+			waveform is sent again as ASCII. False sends ASCII only.
+		Returns the upload time in seconds (until the wavegen has processed the data).
+		"""
+		t0 = time.perf_counter()
 
 		# Prepare the instrument for receiving the waveform data
 		self.send_text("DATA:VOL:CLE")  # Clear volatile memory
-		self.send_text("FUNC:USER VOLATILE")  # Specify the use of volatile memory
 
-		# Define the waveform data points (assuming 'data_normalized' is your NumPy array)
-		waveform_data = ','.join(map(str, data))
+		if binary:
+			dac = self.dac_codes(data)
+			self.send_text("*CLS")  # so SYST:ERR? below only reports errors of this upload
+			self.send_text("FORM:BORD NORM")
+			self.send_block("DATA:DAC VOLATILE,", dac.tobytes())
+			err = self.system_error()
+			if not err.startswith(('+0', '0')):
+				print('Binary waveform upload failed (' + err + '), sending ASCII')
+				binary = False
+
+		if not binary:
+			# Define the waveform data points (assuming 'data_normalized' is your NumPy array)
+			waveform_data = ','.join(map(str, data))
 
-		# Download the waveform to the instrument's volatile memory
-		self.send_text(f"DATA VOLATILE, {waveform_data}")
+			# Download the waveform to the instrument's volatile memory
+			self.send_text(f"DATA VOLATILE, {waveform_data}")
 
 		# Set the function generator to use the uploaded arbitrary waveform
+		self.send_text("FUNC:USER VOLATILE")  # Specify the use of volatile memory (once it holds data)
 		self.send_text("FUNC:SHAP USER")
+		self.invalidate('FUNC')
+		self.opc()
+
+		upload_time = time.perf_counter() - t0
+		if self.verbose:
+			print('Waveform upload ({}): {} points in {:.1f} ms'.format(
+				'binary' if binary else 'ASCII', len(data), upload_time * 1e3))
+		return upload_time
 
 
 
@@ -185,15 +450,14 @@ class wavegen_control:
 
 	@property
 	def output(self):
-		resp = int(self.send_text('OUTP?'))
-		return(resp)
+		return self._get('OUTP')
 	
 	@output.setter
 	def output(self, out):
 		if out == 1:
-			self.send_text('OUTP ON')
+			self._set('OUTP', 1, 'OUTP ON')
 		elif out == 0:
-			self.send_text('OUTP OFF')
+			self._set('OUTP', 0, 'OUTP OFF')
 		else:
 			print('Unknown input parameter')
 			
@@ -206,12 +470,11 @@ class wavegen_control:
 
 	@property
 	def DCoffset(self):
-		resp = float(self.send_text('VOLTage:OFFSet?'))
-		return(resp)
+		return self._get('VOLT:OFFS')
 
 	@DCoffset.setter
 	def DCoffset(self, offset):
-		self.send_text('VOLTage:OFFSet '+str(offset))
+		self._set('VOLT:OFFS', float(offset), 'VOLTage:OFFSet '+str(offset))
 
 #-------------------------------------------------------
 	'''
@@ -220,12 +483,11 @@ class wavegen_control:
 	
 	@property
 	def amplitude(self):
-		resp = float(self.send_text('VOLT?'))
-		return(resp)
+		return self._get('VOLT')
 
 	@amplitude.setter
 	def amplitude(self, amp):
-		self.send_text('VOLT '+str(amp))
+		self._set('VOLT', float(amp), 'VOLT '+str(amp))
 
 #-------------------------------------------------------
 	'''
@@ -234,30 +496,30 @@ class wavegen_control:
 	'''
 
 	def voltage_level(self):
-		HiLevel = float(self.send_text('VOLT:HIGH?'))
-		LoLevel = float(self.send_text('VOLT:LOW?'))
+		if 'VOLT:HIGH' not in self.state or 'VOLT:LOW' not in self.state:
+			HiLevel, LoLevel = self.send_text('VOLT:HIGH?;:VOLT:LOW?').split(';')
+			self.state['VOLT:HIGH'], self.state['VOLT:LOW'] = float(HiLevel), float(LoLevel)
 		
-		return(HiLevel, LoLevel)
+		return(self.state['VOLT:HIGH'], self.state['VOLT:LOW'])
 
 	def set_high_level(self, level):
-		self.send_text('VOLT:HIGH '+str(level))
+		self._set('VOLT:HIGH', float(level), 'VOLT:HIGH '+str(level))
 			
 	def set_low_level(self, level):
-		self.send_text('VOLT:LOW '+str(level))
+		self._set('VOLT:LOW', float(level), 'VOLT:LOW '+str(level))
 			
 	def voltage_range(self, stat): #stat: ON, OFF, ONCE
-		self.send_text('VOLT:RANG:AUTO '+ stat)
+		self._write('VOLT:RANG:AUTO '+ stat)
 
 #-------------------------------------------------------
 
 	@property
 	def frequency(self):
-		resp = float(self.send_text('FREQ?'))
-		return(resp)
+		return self._get('FREQ')
 
 	@frequency.setter
 	def frequency(self, freq):
-		self.send_text('FREQ '+str(freq))
+		self._set('FREQ', float(freq), 'FREQ '+str(freq))
 
 #-------------------------------------------------------
 
@@ -290,7 +552,8 @@ class wavegen_control:
 		except ValueError:
 			raise ValueError('The mode setter needs an iterable with four items: [function, frequency, amplitude, DC offset]')
 			
-		self.send_text('APPL:' + func + ' ' + str(freq) + ',' + str(amp) + ',' + str(offset))
+		self._write('APPL:' + func + ' ' + str(freq) + ',' + str(amp) + ',' + str(offset))
+		self.invalidate()  # APPLy also turns the output on
 
 #-------------------------------------------------------
 	'''
@@ -299,8 +562,7 @@ class wavegen_control:
 	'''
 	@property
 	def function(self):
-		resp = self.send_text('FUNC?')
-		return(resp)
+		return self._get('FUNC')
 	
 	'''
 	set output function with default parameters
@@ -309,9 +571,10 @@ class wavegen_control:
 	def function(self, func):
 		# ----- MODIFICATION -----
 		if func == 'USER':
-			self.send_text('FUNC:USER VOLATILE')
+			self._write('FUNC:USER VOLATILE')
+			self.invalidate('FUNC')
 		# ----- END MODIFICATION -----
-		self.send_text('FUNC ' + func)
+		self._set('FUNC', func, 'FUNC ' + func)
 
 #-------------------------------------------------------
 	'''
@@ -319,15 +582,14 @@ class wavegen_control:
 	'''
 	@property
 	def pulse_width(self):
-		resp = self.send_text('FUNC:PULS:WIDT?')
-		return(resp)
+		return self._get('FUNC:PULS:WIDT')
 
 	'''
 	set output function with default parameters
 	'''
 	@pulse_width.setter
 	def pulse_width(self, width):
-		self.send_text('FUNC:PULS:WIDT ' + str(width))
+		self._set('FUNC:PULS:WIDT', float(width), 'FUNC:PULS:WIDT ' + str(width))
 
 #-------------------------------------------------------
 	'''
@@ -335,15 +597,14 @@ class wavegen_control:
 	'''
 	@property
 	def pulse_period(self):
-		resp = self.send_text('FUNC:PULS:PER?')
-		return(resp)
+		return self._get('FUNC:PULS:PER')
 	
 	'''
 	set output function with default parameters
 	'''
 	@pulse_period.setter
 	def pulse_period(self, period):
-		self.send_text('FUNC:PULS:PER ' + str(period))
+		self._set('FUNC:PULS:PER', float(period), 'FUNC:PULS:PER ' + str(period))
 #-------------------------------------------------------
 
 	# def burst(self):
@@ -357,17 +618,18 @@ class wavegen_control:
 	
 	def burst(self, enable, ncycles, phase, mode='TRIG', source='EXT', period=None):
 		try:
-			if enable:
-
-				self.send_text('BURS:MODE '+ mode)
-				self.send_text('BURS:NCYC '+ str(ncycles))
-				if period != None:
-					self.send_text('BURS:INT:PER '+ str(period))
-				self.send_text('BURS:PHAS '+ str(phase))
-				self.send_text('TRIG:SOUR '+ source)
-				self.send_text('BURS:STAT ON')
-			else:
-				self.send_text('BURS:STAT OFF')
+			with self.batch():
+				if enable:
+
+					self._set('BURS:MODE', mode, 'BURS:MODE '+ mode)
+					self._set('BURS:NCYC', float(ncycles), 'BURS:NCYC '+ str(ncycles))
+					if period != None:
+						self._set('BURS:INT:PER', float(period), 'BURS:INT:PER '+ str(period))
+					self._set('BURS:PHAS', float(phase), 'BURS:PHAS '+ str(phase))
+					self._set('TRIG:SOUR', source, 'TRIG:SOUR '+ source)
+					self._set('BURS:STAT', 1, 'BURS:STAT ON')
+				else:
+					self._set('BURS:STAT', 0, 'BURS:STAT OFF')
 		except ValueError:
 			raise ValueError('The burst setter needs an iterable with four items: [enable(True or False), ncycles, phase, mode]')
 		
@@ -380,6 +642,164 @@ class wavegen_control:
 		w0 = np.zeros(1000)
 
 
+########################################################################################################
+########################################################################################################
+
+class WaveformManager:
+	"""
+	Tracks which arbitrary waveforms the wavegen holds, by a hash of their DAC codes, so
+	that loading a shape the wavegen already has only selects it (FUNC:USER <name>).
+
+	Shapes are kept in volatile memory (name None) or in named non-volatile slots, which
+	survive a power cycle. The slot hashes are saved in a cache file shared by all the
+	wavegens, under the IP address of each, and the slots the wavegen no longer lists are
+	dropped. Free slots are counted by the wavegen (DATA:NVOL:FREE?), so waveforms stored
+	outside the manager are accounted for; when none is free, the least recently used slot
+	of the manager (other than the selected one) is deleted. Waveforms the manager did not
+	store are never deleted: if only those fill the memory, load() raises WavegenError.
+	Storing and selecting a waveform are checked with SYST:ERR? and raise WavegenError
+	when the wavegen rejects them.
+	Waveforms uploaded with wavegen_control.send_dac_data directly bypass the manager; call
+	forget_volatile() afterwards.
+	"""
+	CACHE_FN = 'wavegen_waveform_cache.json'
+	VOLATILE = 'VOLATILE'
+
+	def __init__(self, wavegen, cache_fn = None):
+		self.wavegen = wavegen
+		self.cache_fn = self.CACHE_FN if cache_fn is None else cache_fn
+		self.instrument = str(wavegen.server_ip_addr)   # key of this wavegen in the cache file
+		self.volatile = None            # hash of the waveform in volatile memory (unknown at start)
+		self.slots = OrderedDict()      # slot name -> hash, least recently used first
+		self.selected = None            # name of the selected arbitrary waveform
+
+		cached = self._read_cache().get(self.instrument, {})
+		stored = self.catalog()
+		for name, digest in cached.items():
+			if name in stored:
+				self.slots[name] = digest
+
+	def _read_cache(self):
+		# {instrument: {slot name: hash}}; entries of the old format (one flat table of
+		# slots, not tied to a wavegen) are dropped
+		try:
+			with open(self.cache_fn, 'r') as f:
+				cached = json.load(f)
+		except (FileNotFoundError, ValueError):
+			return {}
+		if not isinstance(cached, dict):
+			return {}
+		return {key: value for key, value in cached.items() if isinstance(value, dict)}
+
+	def waveform_hash(self, data):
+		""" hash of the DAC codes of a waveform, i.e. of what the wavegen would hold """
+		return hashlib.sha1(self.wavegen.dac_codes(data).tobytes()).hexdigest()
+
+	def catalog(self):
+		""" names of the waveforms stored in non-volatile memory """
+		resp = self.wavegen.send_text('DATA:NVOL:CAT?')
+		if resp == 'No response':
+			return []
+		names = [name.strip().strip('"') for name in resp.split(',')]
+		return [name for name in names if name]
+
+	def free_slots(self):
+		""" number of free non-volatile slots """
+		try:
+			return int(self.wavegen.send_text('DATA:NVOL:FREE?'))
+		except ValueError:
+			raise WavegenError('no valid response to DATA:NVOL:FREE?')
+
+	def _checked(self, command):
+		# Send a command and raise WavegenError if the wavegen reports an error for it
+		self.wavegen.send_text('*CLS')  # so that SYST:ERR? only reports this command
+		self.wavegen.send_text(command)
+		resp = self.wavegen.system_error()
+		if not resp.startswith(('+0,', '0,')):
+			raise WavegenError(command + ': ' + resp)
+
+	def _save(self):
+		cached = self._read_cache()
+		cached[self.instrument] = self.slots
+		try:
+			with open(self.cache_fn, 'w') as f:
+				json.dump(cached, f, indent=4)
+		except OSError as e:
+			print('Could not write waveform cache:', str(e))
+
+	def find(self, data):
+		""" name of the memory that holds the waveform (VOLATILE or a slot name), or None """
+		digest = self.waveform_hash(data)
+		if self.volatile == digest:
+			return self.VOLATILE
+		for name, d in self.slots.items():
+			if d == digest:
+				return name
+		return None
+
+	def select(self, name):
+		""" select a stored waveform as the output function; no command if already selected """
+		if name != self.VOLATILE and name not in self.slots:
+			raise KeyError('No waveform stored as ' + str(name))
+		if name != self.VOLATILE:
+			self.slots.move_to_end(name)
+		if self.selected != name:
+			self.selected = None            # unknown until the wavegen accepted it
+			self._checked('FUNC:USER ' + name)
+			self.wavegen.send_text('FUNC:SHAP USER')
+			self.wavegen.invalidate('FUNC')
+			self.selected = name
+
+	def load(self, data, name = None):
+		"""
+		Make a waveform the output function, uploading it only if the wavegen does not have it.
+		name : non-volatile slot to keep it in (up to 12 characters, starting with a letter);
+			None keeps it in volatile memory only.
+		Returns the name of the memory selected.
+		"""
+		digest = self.waveform_hash(data)
+		if name is None:
+			if self.volatile != digest:
+				self.wavegen.send_dac_data(data)
+				self.volatile = digest
+				self.selected = self.VOLATILE
+			self.select(self.VOLATILE)
+			return self.VOLATILE
+
+		name = name.upper()
+		if self.slots.get(name) != digest:
+			if self.volatile != digest:
+				self.wavegen.send_dac_data(data)
+				self.volatile = digest
+				self.selected = self.VOLATILE
+			stored = self.catalog()
+			for n in [n for n in self.slots if n not in stored]:
+				del self.slots[n]           # deleted outside the manager
+			if name not in stored and self.free_slots() <= 0:
+				victims = [n for n in self.slots if n != self.selected]
+				if not victims:
+					raise WavegenError('No free non-volatile slot for ' + name + ' (stored: '
+						+ ', '.join(stored) + '); delete one with DATA:DEL')
+				self.delete(victims[0])
+			self.slots.pop(name, None)          # the slot no longer holds its old shape
+			self._checked('DATA:COPY ' + name + ', VOLATILE')
+			self.slots[name] = digest
+			self._save()
+		self.select(name)
+		return name
+
+	def delete(self, name):
+		""" delete a non-volatile waveform (it must not be the selected one) """
+		self.wavegen.send_text('DATA:DEL ' + name)
+		self.slots.pop(name, None)
+		self._save()
+
+	def forget_volatile(self):
+		""" volatile memory was changed outside the manager """
+		self.volatile = None
+		self.selected = None
+
+
 #----------------------FOR TEST---------------------------------#
 if __name__ == '__main__':
 	#reply = 'none'
@@ -387,3 +807,12 @@ if __name__ == '__main__':
 	
 	wavegen.DCoffset = 0
 
+	# Compare the waveform upload paths
+	data = np.zeros(16384)
+	data[1:8192] = 1
+	for persistent in (False, True):
+		wavegen.persistent = persistent
+		for binary in (False, True):
+			wavegen.send_dac_data(data, binary=binary)
+	wavegen.close()
+
@@ -0,0 +1,543 @@
+"""
+Local SCPI simulator of the Agilent 33220A waveform generator.
+
+The simulator listens on TCP port 5025 (the instrument's SCPI socket port) and answers
+the SCPI subset used by wavegen_control.py and kernel.GasPuffValve, so the drivers and the
+valve control panel (main.py, with IP address 127.0.0.1) run without the instrument:
+    *IDN?, *OPC?, *CLS, *RST, SYST:ERR?
+    OUTP, VOLT, VOLT:HIGH, VOLT:LOW, VOLT:OFFS, VOLT:RANG:AUTO, FREQ, APPL
+    FUNC (FUNC:SHAP), FUNC:USER, FUNC:PULS:WIDT, FUNC:PULS:PER
+    DATA VOLATILE (ASCII), DATA:DAC VOLATILE (ASCII or binary block), FORM:BORD,
+    DATA:VOL:CLE, DATA:COPY, DATA:DEL, DATA:CAT?, DATA:NVOL:CAT?, DATA:NVOL:FREE?
+    BURS:STAT, BURS:MODE, BURS:NCYC, BURS:PHAS, BURS:INT:PER, TRIG:SOUR
+Settings have queries (header with '?'), short and long mnemonics are accepted, and
+compound messages (';' and ';:') are answered with one line. Out-of-range values are
+clipped and undefined commands are rejected, with the error in the SYST:ERR? queue; a
+rejected query is not answered, as on the instrument.
+
+A latency per command emulates the instrument's command processing time. Errors
+(a command rejected with "-310,System error") and dropped connections can be injected at
+a given rate.
+
+Usage:
+    python wavegen_simulator.py --latency 0.002
+"""
+import re
+import time
+import random
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+IDN = 'Agilent Technologies,33220A,SIM0000000,2.07-2.06-22-2'
+
+# SCPI mnemonics; the upper-case part is the short form
+MNEMONICS = ['VOLTage', 'OFFSet', 'HIGH', 'LOW', 'RANGe', 'AUTO', 'OUTPut', 'FREQuency', 'FUNCtion',
+             'SHAPe', 'USER', 'PULSe', 'WIDTh', 'PERiod', 'BURSt', 'MODE', 'NCYCles', 'PHASe',
+             'INTernal', 'STATe', 'TRIGger', 'SOURce', 'SYSTem', 'ERRor', 'DATA', 'DAC', 'VOLatile',
+             'NVOLatile', 'CATalog', 'CLEar', 'COPY', 'DELete', 'FREE', 'FORMat', 'BORDer', 'APPLy',
+             'SINusoid', 'SQUare', 'RAMP', 'NOISe', 'DC']
+SHORT = {}
+for _m in MNEMONICS:
+    _short = ''.join(c for c in _m if c.isupper())
+    SHORT[_short] = SHORT[_m.upper()] = _short
+ALIASES = {'FUNC:SHAP': 'FUNC'}
+
+FUNCTIONS = ['SIN', 'SQU', 'RAMP', 'PULS', 'NOIS', 'DC', 'USER']
+BUILTIN_ARBS = ['SINC', 'NEG_RAMP', 'EXP_RISE', 'EXP_FALL', 'CARDIAC']
+MAX_NVOL = 4
+MAX_POINTS = 65536
+DAC_MAX = 2047
+MAX_VOLTAGE = 10.0          # level limit into high impedance, V
+MIN_AMPLITUDE = 0.02        # V peak to peak
+FREQ_RANGE = {'SIN': (1e-6, 20e6), 'SQU': (1e-6, 20e6), 'RAMP': (1e-6, 200e3), 'PULS': (5e-4, 5e6),
+              'NOIS': (1e-6, 20e6), 'DC': (1e-6, 20e6), 'USER': (1e-6, 6e6)}
+
+
+def scan(message, sep, maxsplit=-1):
+    """
+    Split a message at `sep` outside quoted strings and IEEE-488.2 definite-length blocks.
+    Returns (parts, complete); complete is False if a block is cut off at the end.
+    """
+    special = re.compile(rb'["\'#]|' + re.escape(sep))
+    parts, start, i = [], 0, 0
+    n = len(message)
+    while maxsplit < 0 or len(parts) < maxsplit:
+        m = special.search(message, i)
+        if m is None:
+            break
+        c, i = m.group(), m.start()
+        if c in (b'"', b"'"):
+            end = message.find(c, i + 1)
+            if end < 0:
+                break
+            i = end + 1
+        elif c == b'#':
+            if i + 1 < n and message[i + 1:i + 2].isdigit() and message[i + 1:i + 2] != b'0':
+                digits = int(message[i + 1:i + 2])
+                if i + 2 + digits > n:
+                    return parts, False
+                i += 2 + digits + int(message[i + 2:i + 2 + digits])
+                if i > n:
+                    return parts, False
+            else:
+                i += 1
+        else:
+            parts.append(message[start:i])
+            start = i = i + 1
+    parts.append(message[start:])
+    return parts, True
+
+def split_message(buf):
+    """Cut the first complete program message (up to '\\n' outside blocks) off buf: (message, rest) or None."""
+    parts, complete = scan(buf, b'\n', maxsplit=1)
+    if not complete or len(parts) < 2:
+        return None
+    return parts[0], parts[1]
+
+def fmt(value):
+    """Number as the instrument formats it, e.g. +5.000000000000000E+00."""
+    return f"{value:+.15E}"
+
+
+class ScpiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'{code:+d},"{message}"')
+        self.code = code
+
+
+class Simulated33220A:
+    """Instrument state and SCPI command execution."""
+    def __init__(self):
+        self.nvol = {}         # name -> waveform values (-1 ... +1)
+        self.errors = []
+        self.reset()
+
+    def reset(self):
+        self.output = 0
+        self.function = 'SIN'
+        self.user = 'EXP_RISE'
+        self.frequency = 1e3
+        self.high = 0.05
+        self.low = -0.05
+        self.pulse_width = 1e-4
+        self.range_auto = 1
+        self.burst = {'STAT': 0, 'MODE': 'TRIG', 'NCYC': 1.0, 'PHAS': 0.0, 'INT:PER': 1e-2}
+        self.trigger_source = 'IMM'
+        self.byte_order = 'NORM'
+        self.volatile = None
+
+    def error(self, code, message):
+        raise ScpiError(code, message)
+
+    # - - - - - - - - - - - - - - - - - - - - - - -
+
+    def canonical(self, header, prefix):
+        """Canonical short-form header of a command, and the path prefix for the next one."""
+        query = header.endswith('?')
+        header = header.rstrip('?')
+        if header.startswith('*'):
+            return header.upper() + ('?' if query else ''), prefix
+        if header.startswith(':'):
+            nodes = header[1:].split(':')
+        else:
+            nodes = prefix + header.split(':')
+        try:
+            nodes = [SHORT[node.upper()] for node in nodes]
+        except KeyError:
+            self.error(-113, "Undefined header")
+        canonical = ':'.join(nodes)
+        canonical = ALIASES.get(canonical, canonical)
+        return canonical + ('?' if query else ''), nodes[:-1]
+
+    def execute(self, message):
+        """Execute a program message; returns the response line or None."""
+        commands, _ = scan(message, b';')
+        responses = []
+        prefix = []
+        for command in commands:
+            command = command.strip()
+            if not command:
+                continue
+            header, _, params = command.partition(b' ')
+            try:
+                header, prefix = self.canonical(header.decode('ascii', 'replace'), prefix)
+                response = self.command(header, params.strip())
+            except ScpiError as e:
+                self.errors.append(str(e))
+                continue
+            if response is not None:
+                responses.append(response)
+        return ';'.join(responses) if responses else None
+
+    # - - - - - - - - - - - - - - - - - - - - - - -
+
+    def number(self, params):
+        text = params.decode('ascii', 'replace').strip()
+        try:
+            return float(text)
+        except ValueError:
+            self.error(-104, "Data type error")
+
+    def boolean(self, params):
+        text = params.decode('ascii', 'replace').strip().upper()
+        if text in ('ON', '1'):
+            return 1
+        if text in ('OFF', '0'):
+            return 0
+        self.error(-224, "Illegal parameter value")
+
+    def choice(self, params, choices):
+        text = params.decode('ascii', 'replace').strip().upper()
+        for choice in choices:
+            if text == choice or (len(text) >= 3 and choice.startswith(text)):
+                return choice
+        self.error(-224, "Illegal parameter value")
+
+    def clip(self, value, lo, hi):
+        if value < lo or value > hi:
+            self.errors.append('-222,"Data out of range"')
+            return min(max(value, lo), hi)
+        return value
+
+    def set_levels(self, high, low):
+        high = self.clip(high, -MAX_VOLTAGE, MAX_VOLTAGE)
+        low = self.clip(low, -MAX_VOLTAGE, MAX_VOLTAGE)
+        if high - low < MIN_AMPLITUDE:
+            self.errors.append('-221,"Settings conflict;amplitude changed due to limits"')
+            if high == self.high:
+                low = high - MIN_AMPLITUDE
+            else:
+                high = low + MIN_AMPLITUDE
+        self.high, self.low = high, low
+
+    def set_frequency(self, frequency):
+        self.frequency = self.clip(frequency, *FREQ_RANGE[self.function])
+        if self.pulse_width > 1 / self.frequency:
+            self.pulse_width = 0.5 / self.frequency
+
+    def waveform_name(self, params):
+        name = params.decode('ascii', 'replace').strip().strip('"').upper()
+        if name in ('VOL', 'VOLATILE'):
+            return 'VOLATILE'
+        if not name or len(name) > 12 or not name[0].isalpha() or not name.replace('_', '').isalnum():
+            self.error(-224, "Illegal parameter value")
+        return name
+
+    def arb_names(self):
+        names = list(BUILTIN_ARBS)
+        if self.volatile is not None:
+            names.append('VOLATILE')
+        return names + list(self.nvol)
+
+    def load_volatile(self, values):
+        if not 1 <= len(values) <= MAX_POINTS:
+            self.error(-222, "Data out of range;number of points")
+        self.volatile = values
+
+    def command(self, header, params):
+        # Common commands
+        if header == '*IDN?':
+            return IDN
+        if header == '*OPC?':
+            return '1'
+        if header in ('*OPC', '*WAI'):
+            return None
+        if header == '*CLS':
+            self.errors.clear()
+            return None
+        if header == '*RST':
+            self.reset()
+            return None
+        if header == 'SYST:ERR?':
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+
+        # Output and levels
+        if header == 'OUTP':
+            self.output = self.boolean(params)
+        elif header == 'OUTP?':
+            return str(self.output)
+        elif header == 'VOLT':
+            amplitude = self.clip(self.number(params), MIN_AMPLITUDE, 2 * MAX_VOLTAGE)
+            offset = (self.high + self.low) / 2
+            self.set_levels(offset + amplitude / 2, offset - amplitude / 2)
+        elif header == 'VOLT?':
+            return fmt(self.high - self.low)
+        elif header == 'VOLT:OFFS':
+            offset, amplitude = self.number(params), self.high - self.low
+            self.set_levels(offset + amplitude / 2, offset - amplitude / 2)
+        elif header == 'VOLT:OFFS?':
+            return fmt((self.high + self.low) / 2)
+        elif header == 'VOLT:HIGH':
+            self.set_levels(self.number(params), self.low)
+        elif header == 'VOLT:HIGH?':
+            return fmt(self.high)
+        elif header == 'VOLT:LOW':
+            self.set_levels(self.high, self.number(params))
+        elif header == 'VOLT:LOW?':
+            return fmt(self.low)
+        elif header == 'VOLT:RANG:AUTO':
+            self.range_auto = 1 if self.choice(params, ['ON', 'OFF', 'ONCE', '1', '0']) in ('ON', 'ONCE', '1') else 0
+        elif header == 'VOLT:RANG:AUTO?':
+            return str(self.range_auto)
+
+        # Function and timing
+        elif header == 'FREQ':
+            self.set_frequency(self.number(params))
+        elif header == 'FREQ?':
+            return fmt(self.frequency)
+        elif header == 'FUNC':
+            function = self.choice(params, FUNCTIONS + ['SINUSOID', 'SQUARE', 'PULSE', 'NOISE'])
+            function = {'SINUSOID': 'SIN', 'SQUARE': 'SQU', 'PULSE': 'PULS', 'NOISE': 'NOIS'}.get(function, function)
+            if function == 'USER' and self.user == 'VOLATILE' and self.volatile is None:
+                self.error(-221, "Settings conflict;no volatile waveform")
+            self.function = function
+            self.set_frequency(self.frequency)
+        elif header == 'FUNC?':
+            return self.function
+        elif header == 'FUNC:USER':
+            name = self.waveform_name(params)
+            if name not in self.arb_names():
+                self.error(-224, "Illegal parameter value;waveform not found")
+            self.user = name
+        elif header == 'FUNC:USER?':
+            return self.user
+        elif header == 'FUNC:PULS:WIDT':
+            self.pulse_width = self.clip(self.number(params), 20e-9, 1 / self.frequency)
+        elif header == 'FUNC:PULS:WIDT?':
+            return fmt(self.pulse_width)
+        elif header == 'FUNC:PULS:PER':
+            self.set_frequency(1 / self.clip(self.number(params), 200e-9, 2000.0))
+        elif header == 'FUNC:PULS:PER?':
+            return fmt(1 / self.frequency)
+        elif header.startswith('APPL:') and not header.endswith('?'):
+            function = header[len('APPL:'):]
+            if function not in FUNCTIONS:
+                self.error(-113, "Undefined header")
+            values = [self.number(p) for p in scan(params, b',')[0] if p.strip()] if params else []
+            self.function = function
+            if len(values) > 0:
+                self.set_frequency(values[0])
+            if len(values) > 1:
+                self.command('VOLT', str(values[1]).encode())
+            if len(values) > 2:
+                self.command('VOLT:OFFS', str(values[2]).encode())
+            self.output = 1
+        elif header == 'APPL?':
+            return f'"{self.function} {fmt(self.frequency)},{fmt(self.high - self.low)},{fmt((self.high + self.low) / 2)}"'
+
+        # Burst and trigger
+        elif header in ('BURS:STAT', 'BURS:MODE', 'BURS:NCYC', 'BURS:PHAS', 'BURS:INT:PER'):
+            key = header[len('BURS:'):]
+            if key == 'STAT':
+                self.burst[key] = self.boolean(params)
+            elif key == 'MODE':
+                self.burst[key] = {'GAT': 'GAT', 'GATED': 'GAT'}.get(self.choice(params, ['TRIG', 'GAT', 'GATED', 'TRIGGERED']), 'TRIG')
+            elif key == 'NCYC':
+                self.burst[key] = float(round(self.clip(self.number(params), 1, 50000)))
+            elif key == 'PHAS':
+                self.burst[key] = self.clip(self.number(params), -360, 360)
+            else:
+                self.burst[key] = self.clip(self.number(params), 1e-6, 500)
+        elif header in ('BURS:STAT?', 'BURS:MODE?', 'BURS:NCYC?', 'BURS:PHAS?', 'BURS:INT:PER?'):
+            value = self.burst[header[len('BURS:'):-1]]
+            return value if isinstance(value, str) else (str(value) if header == 'BURS:STAT?' else fmt(value))
+        elif header == 'TRIG:SOUR':
+            self.trigger_source = self.choice(params, ['IMM', 'EXT', 'BUS', 'IMMEDIATE', 'EXTERNAL'])[:3]
+        elif header == 'TRIG:SOUR?':
+            return self.trigger_source
+
+        # Arbitrary waveforms
+        elif header == 'FORM:BORD':
+            self.byte_order = self.choice(params, ['NORM', 'SWAP', 'NORMAL', 'SWAPPED'])[:4]
+        elif header == 'FORM:BORD?':
+            return self.byte_order
+        elif header == 'DATA':
+            args, _ = scan(params, b',')
+            if len(args) < 2 or self.waveform_name(args[0]) != 'VOLATILE':
+                self.error(-224, "Illegal parameter value")
+            try:
+                values = np.array([float(a) for a in args[1:]])
+            except ValueError:
+                self.error(-104, "Data type error")
+            if np.any(np.abs(values) > 1):
+                self.error(-222, "Data out of range;value clipped to upper limit")
+            self.load_volatile(values)
+        elif header == 'DATA:DAC':
+            args, _ = scan(params, b',')
+            if len(args) < 2 or self.waveform_name(args[0]) != 'VOLATILE':
+                self.error(-224, "Illegal parameter value")
+            block = args[1].strip()
+            if block.startswith(b'#'):
+                digits = int(block[1:2])
+                length = int(block[2:2 + digits])
+                payload = block[2 + digits:2 + digits + length]
+                if length % 2:
+                    self.error(-222, "Data out of range;odd number of bytes")
+                dac = np.frombuffer(payload, dtype='>i2' if self.byte_order == 'NORM' else '<i2')
+            else:
+                try:
+                    dac = np.array([int(a) for a in args[1:]])
+                except ValueError:
+                    self.error(-104, "Data type error")
+            if np.any(np.abs(dac) > DAC_MAX):
+                self.error(-222, "Data out of range;value clipped to upper limit")
+            self.load_volatile(dac.astype(float) / DAC_MAX)
+        elif header == 'DATA:VOL:CLE':
+            self.volatile = None
+            if self.user == 'VOLATILE':
+                self.user = 'EXP_RISE'
+        elif header == 'DATA:COPY':
+            args, _ = scan(params, b',')
+            name = self.waveform_name(args[0])
+            if name == 'VOLATILE' or name in BUILTIN_ARBS:
+                self.error(-224, "Illegal parameter value;cannot overwrite this waveform")
+            if self.volatile is None:
+                self.error(-221, "Settings conflict;no volatile waveform")
+            if name not in self.nvol and len(self.nvol) >= MAX_NVOL:
+                self.error(781, "Not enough memory to store new arb waveform; use DATA:DELETE")
+            self.nvol[name] = self.volatile.copy()
+        elif header == 'DATA:DEL':
+            name = self.waveform_name(params)
+            if name not in self.nvol:
+                self.error(-224, "Illegal parameter value;waveform not found")
+            if self.function == 'USER' and self.user == name:
+                self.error(-221, "Settings conflict;cannot delete the active waveform")
+            del self.nvol[name]
+        elif header == 'DATA:CAT?':
+            return ','.join(f'"{name}"' for name in self.arb_names())
+        elif header == 'DATA:NVOL:CAT?':
+            return ','.join(f'"{name}"' for name in self.nvol) or '""'
+        elif header == 'DATA:NVOL:FREE?':
+            return f"{MAX_NVOL - len(self.nvol):+d}"
+        else:
+            self.error(-113, "Undefined header")
+        return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sim = self.server.simulator
+        with sim.lock:
+            sim.stats['connections'] += 1
+        buf = b''
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while True:
+                split = split_message(buf)
+                if split is None:
+                    break
+                message, buf = split
+                if not sim.process(message, self.request):
+                    return
+
+
+class WavegenSimulator:
+    """TCP server of a Simulated33220A."""
+    def __init__(self, host='127.0.0.1', port=5025, latency=0.0, error_rate=0.0, disconnect_rate=0.0, seed=None):
+        """
+        Parameters
+        ----------
+        host, port : str, int
+            Address to listen on; port 0 picks a free port (see .port).
+        latency : float
+            Processing time per command in seconds.
+        error_rate : float
+            Fraction of commands rejected with "-310,System error" (queries are not answered).
+        disconnect_rate : float
+            Fraction of program messages after which the connection is closed unanswered.
+        """
+        self.instrument = Simulated33220A()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'messages': 0, 'commands': 0, 'bytes': 0,
+                      'injected_errors': 0, 'disconnects': 0}
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), _Handler, bind_and_activate=True)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def process(self, message, sock):
+        """Execute one program message from a connection; returns False to close it."""
+        with self.lock:
+            self.stats['messages'] += 1
+            self.stats['bytes'] += len(message) + 1
+            if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+                self.stats['disconnects'] += 1
+                return False
+            commands = len(scan(message, b';')[0])
+            self.stats['commands'] += commands
+            if self.latency:
+                time.sleep(self.latency * commands)
+            if self.error_rate and self.rng.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                self.instrument.errors.append('-310,"System error"')
+                return True
+            response = self.instrument.execute(message)
+        if response is not None:
+            try:
+                sock.sendall(response.encode() + b'\n')
+            except OSError:
+                return False
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate an Agilent 33220A waveform generator on a TCP port.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (0.0.0.0 for all interfaces)")
+    parser.add_argument('--port', type=int, default=5025)
+    parser.add_argument('--latency', type=float, default=0.0, help="processing time per command in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of commands rejected with an error")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0,
+                        help="fraction of messages after which the connection is dropped")
+    args = parser.parse_args()
+
+    sim = WavegenSimulator(args.host, args.port, args.latency, args.error_rate, args.disconnect_rate)
+    sim.start()
+    print(f"Simulating the 33220A on {args.host}:{sim.port}")
+    try:
+        while True:
+            time.sleep(10)
+            inst = sim.instrument
+            print(f"output {inst.output}, {inst.function}, {inst.frequency:g} Hz, "
+                  f"levels {inst.high:g}/{inst.low:g} V, burst {inst.burst['STAT']}; {sim.stats}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()